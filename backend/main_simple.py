@@ -4,16 +4,88 @@ import uuid
 import os
 import shutil
 from datetime import datetime, timedelta
-from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File
+from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Header, Response, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel
-from typing import Optional, List
+from pydantic import BaseModel, Field
+from typing import Optional, List, Dict
 import hashlib
+import hmac
+import ipaddress
 import jwt
+import copy
+import re
+import asyncio
+import atexit
+import queue
+import threading
+import time
+import csv
+import io
+import math
+import bisect
+import contextvars
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from passlib.context import CryptContext
+from collections import OrderedDict, deque
+from fastapi.encoders import jsonable_encoder
 
-app = FastAPI(title="Auth Prototype API", version="1.0.0")
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ==================== Fast JSON ====================
+
+class RawJSON:
+    """已序列化的 JSON 文本（如数据库中保存的 config_data），响应时原样拼接，不再解析和重新编码"""
+    __slots__ = ("text",)
+
+    def __init__(self, text: Optional[str], default: str = "{}"):
+        self.text = text or default
+
+def dumps_json(content) -> bytes:
+    """
+    序列化响应：优先使用 orjson，未安装时退回标准库 json
+    RawJSON 先编码为带随机前缀的占位字符串，序列化后再替换为原始文本
+    """
+    raws = []
+    nonce = uuid.uuid4().hex[:8]
+
+    def default(value):
+        if isinstance(value, RawJSON):
+            raws.append(value.text)
+            return f"\x00{nonce}:{len(raws) - 1}\x00"
+        # 其余类型（datetime、set、Pydantic 模型等）按 FastAPI 的规则转换
+        return jsonable_encoder(value)
+
+    if orjson is not None:
+        body = orjson.dumps(content, default=default, option=orjson.OPT_NON_STR_KEYS)
+    else:
+        body = json.dumps(content, default=default, ensure_ascii=False, allow_nan=False,
+                          separators=(",", ":")).encode("utf-8")
+    if raws:
+        # 两种编码器都把 \x00 转义为 \u0000
+        placeholder = re.compile(rb'"\\u0000' + nonce.encode() + rb':(\d+)\\u0000"')
+        body = placeholder.sub(lambda match: raws[int(match.group(1))].encode("utf-8"), body)
+    return body
+
+class FastJSONResponse(JSONResponse):
+    """默认响应类：使用 dumps_json 序列化"""
+
+    def render(self, content) -> bytes:
+        return dumps_json(content)
+
+def json_response(content, status_code: int = 200, headers: Optional[dict] = None) -> FastJSONResponse:
+    """
+    直接返回响应对象，跳过 FastAPI 对返回值的 jsonable_encoder 遍历
+    （内容包含 RawJSON 时必须使用）
+    """
+    return FastJSONResponse(content, status_code=status_code, headers=headers)
+
+app = FastAPI(title="Auth Prototype API", version="1.0.0", default_response_class=FastJSONResponse)
 
 # CORS配置 - 支持局域网访问
 # 定义允许的来源列表
@@ -33,12 +105,832 @@ app.add_middleware(
     CORSMiddleware,
     allow_origins=allowed_origins,
     allow_credentials=True,
-    allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+    allow_methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
     allow_headers=["*"],
     expose_headers=["*"],
     max_age=3600,  # 预检请求缓存1小时
 )
 
+# 需要让前端读取到的响应头
+EXPOSED_HEADERS = ["ETag", "Retry-After", "X-RateLimit-Limit", "X-RateLimit-Remaining", "X-Query-Summary"]
+
+# ==================== Rate Limiting ====================
+
+# 令牌桶限流：已登录用户按用户ID计数，未登录请求按客户端IP计数
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # memory | sqlite
+# sqlite 后端使用独立的数据库文件，不与业务数据库的写事务争用写锁
+RATE_LIMIT_DB_FILE = os.getenv("RATE_LIMIT_DB_FILE", "rate_limit.db")
+RATE_LIMIT_USER_CAPACITY = float(os.getenv("RATE_LIMIT_USER_CAPACITY", "120"))
+RATE_LIMIT_USER_REFILL = float(os.getenv("RATE_LIMIT_USER_REFILL", "2"))  # 每秒补充的令牌数
+RATE_LIMIT_IP_CAPACITY = float(os.getenv("RATE_LIMIT_IP_CAPACITY", "60"))
+RATE_LIMIT_IP_REFILL = float(os.getenv("RATE_LIMIT_IP_REFILL", "1"))
+# 位于反向代理之后时使用 X-Forwarded-For 的第一个地址
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "0") == "1"
+
+# (方法, 路径正则, 消耗的令牌数)：全量列表、导出和登录比普通请求更贵
+RATE_LIMIT_ROUTE_COSTS = [
+    ("GET", re.compile(r"^/api/requests/?$"), 10),
+    ("GET", re.compile(r"^/api/templates/export$"), 20),
+    ("POST", re.compile(r"^/api/templates/import$"), 20),
+    ("POST", re.compile(r"^/api/templates/[^/]+/instantiate$"), 10),
+    ("POST", re.compile(r"^/api/auth/(login|register|refresh)$"), 5),
+    ("GET", re.compile(r"^/api/debug/benchmark/"), 30),
+]
+RATE_LIMIT_EXEMPT_PATHS = ("/docs", "/redoc", "/openapi.json", "/metrics")
+
+def rate_limit_cost(method: str, path: str) -> int:
+    for route_method, pattern, cost in RATE_LIMIT_ROUTE_COSTS:
+        if route_method == method and pattern.match(path):
+            return cost
+    return 1
+
+class InMemoryRateLimitBackend:
+    """
+    进程内令牌桶（单进程部署和测试使用）
+    clock 可以替换为可控的时钟，便于测试
+    """
+    blocking = False
+    
+    def __init__(self, clock=time.monotonic, max_keys: int = 10000):
+        self.clock = clock
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+    
+    def consume(self, key: str, cost: float, capacity: float, refill: float):
+        """扣除令牌，返回 (是否允许, 剩余令牌, 需要等待的秒数)"""
+        with self._lock:
+            now = self.clock()
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * refill)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now, capacity, refill)
+        retry_after = 0 if allowed else (cost - tokens) / refill if refill > 0 else 60
+        return allowed, tokens, retry_after
+    
+    def _prune(self, now: float, capacity: float, refill: float):
+        # 已经补满的桶与不存在的桶等价，可以直接丢弃
+        for key in [k for k, (tokens, updated) in self._buckets.items()
+                    if tokens + (now - updated) * refill >= capacity]:
+            del self._buckets[key]
+    
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+class SQLiteRateLimitBackend:
+    """
+    共享令牌桶：多个工作进程通过同一个 SQLite 文件共享限流状态
+    每次扣除是一个 BEGIN IMMEDIATE 事务，使用墙上时钟以便跨进程比较
+    限流状态丢失最近几次扣除也无妨，因此使用 WAL + synchronous=NORMAL，提交时不做 fsync
+    """
+    blocking = True
+    
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self._local = threading.local()
+    
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, isolation_level=None, timeout=SQLITE_BUSY_TIMEOUT_SECONDS)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+            ''')
+            self._local.conn = conn
+        return conn
+    
+    def consume(self, key: str, cost: float, capacity: float, refill: float):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated FROM rate_limit_buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens = min(capacity, tokens + max(0.0, now - updated) * refill)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            conn.execute('''
+                INSERT INTO rate_limit_buckets (key, tokens, updated) VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated
+            ''', (key, tokens, now))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        retry_after = 0 if allowed else (cost - tokens) / refill if refill > 0 else 60
+        return allowed, tokens, retry_after
+    
+    def reset(self):
+        self._connection().execute("DELETE FROM rate_limit_buckets")
+
+def create_rate_limit_backend(name: str):
+    if name == "sqlite":
+        return SQLiteRateLimitBackend(RATE_LIMIT_DB_FILE)
+    if name == "memory":
+        return InMemoryRateLimitBackend()
+    raise RuntimeError(f"Unknown rate limit backend: {name}")
+
+rate_limit_backend = None
+
+def rate_limit_identity(request: Request):
+    """限流键和桶参数：携带有效令牌时按用户，否则按IP"""
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        try:
+            payload = jwt.decode(authorization[7:], JWT_SECRET, algorithms=[JWT_ALGORITHM])
+            user_key = payload.get("uid") or payload.get("sub")
+            if user_key:
+                return f"user:{user_key}", RATE_LIMIT_USER_CAPACITY, RATE_LIMIT_USER_REFILL
+        except jwt.PyJWTError:
+            pass
+    client_ip = request.client.host if request.client else "unknown"
+    if RATE_LIMIT_TRUST_PROXY and request.headers.get("x-forwarded-for"):
+        client_ip = request.headers["x-forwarded-for"].split(",")[0].strip()
+    return f"ip:{client_ip}", RATE_LIMIT_IP_CAPACITY, RATE_LIMIT_IP_REFILL
+
+@app.middleware("http")
+async def rate_limit_middleware(request: Request, call_next):
+    """令牌桶限流，超出时返回 429 和 Retry-After"""
+    global rate_limit_backend
+    path = request.url.path
+    if not RATE_LIMIT_ENABLED or request.method == "OPTIONS" or path.startswith(RATE_LIMIT_EXEMPT_PATHS):
+        return await call_next(request)
+    if rate_limit_backend is None:
+        rate_limit_backend = create_rate_limit_backend(RATE_LIMIT_BACKEND)
+    
+    key, capacity, refill = rate_limit_identity(request)
+    cost = rate_limit_cost(request.method, path)
+    if rate_limit_backend.blocking:
+        allowed, remaining, retry_after = await asyncio.to_thread(
+            rate_limit_backend.consume, key, cost, capacity, refill)
+    else:
+        allowed, remaining, retry_after = rate_limit_backend.consume(key, cost, capacity, refill)
+    
+    if not allowed:
+        print(f"⚠️ Rate limit exceeded: {key} {request.method} {path}")
+        return JSONResponse(status_code=429, content={"detail": "Rate limit exceeded"}, headers={
+            "Retry-After": str(max(1, math.ceil(retry_after))),
+            "X-RateLimit-Limit": str(int(capacity)),
+            "X-RateLimit-Remaining": str(int(remaining))
+        })
+    
+    response = await call_next(request)
+    response.headers["X-RateLimit-Limit"] = str(int(capacity))
+    response.headers["X-RateLimit-Remaining"] = str(int(remaining))
+    return response
+
+# ==================== Response Compression ====================
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 小于阈值的响应不压缩（压缩收益抵不过开销）
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "5"))
+# 超过此大小时在线程池中压缩，避免阻塞事件循环
+COMPRESSION_THREAD_MIN_SIZE = 64 * 1024
+COMPRESSION_CACHE_MAX_BYTES = int(os.getenv("COMPRESSION_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+COMPRESSIBLE_MEDIA_TYPES = ("application/json", "application/x-ndjson", "text/", "application/javascript")
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """根据 Accept-Encoding（含 q 值）选择 br 或 gzip，同等优先级时优先 br；都不可接受时返回 None"""
+    qualities = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            qualities[name.strip().lower()] = quality
+    best, best_quality = None, 0.0
+    for encoding in (["br"] if brotli is not None else []) + ["gzip"]:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+    compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+class StreamCompressor:
+    """流式压缩（NDJSON 导出和导入进度）：每个分块都刷新输出，客户端可以逐行读取"""
+    
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+    
+    def compress(self, chunk: bytes) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.process(chunk) + self._compressor.flush()
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+    
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+class CompressedBodyCache:
+    """
+    已压缩响应体的 LRU（按总字节数限制）
+    不可变的响应（模板历史版本，Cache-Control 含 immutable）按 (编码, 路径, ETag) 缓存，
+    其他响应的 ETag 不一定随全部内容变化（如模板的 usageCount），按响应体摘要缓存，同一内容只压缩一次
+    """
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+    
+    def put(self, key, body: bytes):
+        if len(body) > self.max_bytes // 4:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= len(previous)
+            self._entries[key] = body
+            self.bytes += len(body)
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= len(evicted)
+    
+    def record(self, original: int, compressed: int):
+        with self._lock:
+            self.bytes_in += original
+            self.bytes_out += compressed
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRatio": round(self.hits / total, 4) if total else None,
+                "bytesIn": self.bytes_in,
+                "bytesOut": self.bytes_out,
+                "ratio": round(self.bytes_out / self.bytes_in, 4) if self.bytes_in else None
+            }
+
+compressed_bodies = CompressedBodyCache(COMPRESSION_CACHE_MAX_BYTES)
+
+def _add_vary(headers):
+    vary = headers.get("vary")
+    if not vary:
+        headers["vary"] = "Accept-Encoding"
+    elif "accept-encoding" not in vary.lower():
+        headers["vary"] = f"{vary}, Accept-Encoding"
+
+def _weaken_etag(headers):
+    """压缩后的字节与原始响应体不同，强 ETag 改为弱 ETag（etag_matches 比较时忽略 W/ 前缀，两种形式都能命中）"""
+    etag = headers.get("etag")
+    if etag and not etag.startswith("W/"):
+        headers["etag"] = f"W/{etag}"
+
+async def _replay_stream(head: list, body_iterator):
+    for chunk in head:
+        yield chunk
+    async for chunk in body_iterator:
+        yield chunk
+
+async def _compress_stream(body_iterator, encoding: str):
+    compressor = StreamCompressor(encoding)
+    async for chunk in body_iterator:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        data = compressor.compress(chunk)
+        compressed_bodies.record(len(chunk), len(data))
+        if data:
+            yield data
+    yield compressor.finish()
+
+@app.middleware("http")
+async def compression_middleware(request: Request, call_next):
+    """按 Accept-Encoding 压缩 JSON / NDJSON / 文本响应；固定长度的响应体压缩结果会被缓存"""
+    encoding = negotiate_encoding(request.headers.get("accept-encoding", ""))
+    response = await call_next(request)
+    if encoding is None or request.method == "HEAD" or response.status_code in (204, 304):
+        return response
+    if "content-encoding" in response.headers:
+        return response
+    if not response.headers.get("content-type", "").startswith(COMPRESSIBLE_MEDIA_TYPES):
+        return response
+    
+    content_length = response.headers.get("content-length")
+    if content_length is None:
+        # 流式响应：先读到 COMPRESSION_MIN_SIZE 字节，整个响应都不到这个大小时原样返回
+        head, size = [], 0
+        async for chunk in response.body_iterator:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            head.append(chunk)
+            size += len(chunk)
+            if size >= COMPRESSION_MIN_SIZE:
+                break
+        else:
+            body = b"".join(head)
+            short_response = Response(content=body, status_code=response.status_code)
+            short_response.raw_headers = [(key, value) for key, value in response.raw_headers if key != b"content-length"] + [
+                (b"content-length", str(len(body)).encode("latin-1"))
+            ]
+            return short_response
+        # 其余部分边生成边压缩
+        response.body_iterator = _compress_stream(_replay_stream(head, response.body_iterator), encoding)
+        response.headers["content-encoding"] = encoding
+        _add_vary(response.headers)
+        _weaken_etag(response.headers)
+        return response
+    if int(content_length) < COMPRESSION_MIN_SIZE:
+        return response
+    
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    etag = response.headers.get("etag")
+    if etag and "immutable" in response.headers.get("cache-control", ""):
+        cache_key = (encoding, request.url.path, etag)
+    else:
+        cache_key = (encoding, hashlib.blake2b(body, digest_size=16).digest())
+    compressed = compressed_bodies.get(cache_key)
+    if compressed is None:
+        if len(body) >= COMPRESSION_THREAD_MIN_SIZE:
+            compressed = await asyncio.to_thread(compress_body, body, encoding)
+        else:
+            compressed = compress_body(body, encoding)
+        compressed_bodies.put(cache_key, compressed)
+    compressed_bodies.record(len(body), len(compressed))
+    
+    headers = [(key, value) for key, value in response.raw_headers if key not in (b"content-length", b"content-encoding")]
+    compressed_response = Response(content=compressed, status_code=response.status_code)
+    compressed_response.raw_headers = headers + [
+        (b"content-length", str(len(compressed)).encode("latin-1")),
+        (b"content-encoding", encoding.encode("latin-1"))
+    ]
+    _add_vary(compressed_response.headers)
+    _weaken_etag(compressed_response.headers)
+    return compressed_response
+
+# ==================== Metrics ====================
+
+# 耗时直方图的桶（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+             for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """单调递增计数器，按标签值元组分别计数"""
+    kind = "counter"
+    
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+    
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, "", value) for labels, value in self._values.items()]
+
+class Gauge(Counter):
+    """可增可减的当前值"""
+    kind = "gauge"
+    
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self.inc(labels, -amount)
+    
+    def set(self, labels: tuple, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+class Histogram:
+    """累积桶直方图：observe 只更新一个桶，输出时再累加"""
+    kind = "histogram"
+    
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, labels: tuple, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+    
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        samples = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                samples.append((f"{self.name}_bucket", labels, f'le="{le}"', cumulative))
+            samples.append((f"{self.name}_sum", labels, "", total))
+            samples.append((f"{self.name}_count", labels, "", cumulative))
+        return samples
+
+class MetricsRegistry:
+    """
+    指标注册表：热路径上只更新内存中的计数，
+    队列深度、缓存命中等现有状态由 collector 在抓取时读取
+    """
+    
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+    
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+    
+    def collector(self, func):
+        """注册抓取时调用的函数，返回 [(名称, 类型, 说明, 标签名, [(标签值, 值)])]"""
+        self.collectors.append(func)
+        return func
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, extra, value in metric.samples():
+                lines.append(f"{name}{_format_labels(metric.labelnames, labels, extra)} {value}")
+        for collect in self.collectors:
+            try:
+                families = collect()
+            except Exception as e:
+                print(f"⚠️ Metrics collector {collect.__name__} failed: {e}")
+                continue
+            for name, kind, documentation, labelnames, values in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in values:
+                    lines.append(f"{name}{_format_labels(labelnames, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+http_requests_total = metrics.register(Counter(
+    "app_http_requests_total", "HTTP requests by route and status", ("method", "route", "status")))
+http_request_duration = metrics.register(Histogram(
+    "app_http_request_duration_seconds", "HTTP request latency by route", ("method", "route")))
+http_requests_in_flight = metrics.register(Gauge(
+    "app_http_requests_in_flight", "HTTP requests currently being handled"))
+db_queries_total = metrics.register(Counter(
+    "app_db_queries_total", "SQLite statements executed by query name", ("query",)))
+db_query_duration = metrics.register(Histogram(
+    "app_db_query_duration_seconds", "SQLite statement latency by query name", ("query",), QUERY_BUCKETS))
+db_connections_opened = metrics.register(Counter(
+    "app_db_connections_opened_total", "SQLite connections opened"))
+upload_bytes_total = metrics.register(Counter(
+    "app_upload_bytes_total", "Bytes received by file uploads"))
+uploads_total = metrics.register(Counter(
+    "app_uploads_total", "Files received by file uploads"))
+password_tasks_queued = metrics.register(Gauge(
+    "app_password_hash_tasks", "Password hash tasks waiting for or running in the executor"))
+
+# 语句名称：动词 + 主表（如 "SELECT requests"），标签基数保持在几十个以内
+QUERY_TABLE_PATTERN = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?|ON)\s+([A-Za-z_]\w*)", re.I)
+_query_names = {}
+
+def query_name(sql: str) -> str:
+    name = _query_names.get(sql)
+    if name is None:
+        stripped = sql.lstrip()
+        verb = stripped.split(None, 1)[0].upper() if stripped else "EMPTY"
+        match = QUERY_TABLE_PATTERN.search(stripped)
+        name = f"{verb} {match.group(1)}" if match and verb not in ("PRAGMA", "BEGIN", "COMMIT", "ROLLBACK") else verb
+        # 动态拼接的 SQL 可能很多，超过上限时清空重建
+        if len(_query_names) > 4096:
+            _query_names.clear()
+        _query_names[sql] = name
+    return name
+
+class MeteredCursor(sqlite3.Cursor):
+    """记录每条语句的次数和耗时；在请求上下文中还记录指纹、绑定参数个数和返回的行数"""
+    _trace_entry = None
+    
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record(sql, parameters, len(parameters), time.perf_counter() - start)
+    
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._record(sql, seq_of_parameters[0] if seq_of_parameters else (),
+                         sum(len(parameters) for parameters in seq_of_parameters), time.perf_counter() - start)
+    
+    def _record(self, sql: str, parameters, binds: int, elapsed: float):
+        name = query_name(sql)
+        db_queries_total.inc((name,))
+        db_query_duration.observe((name,), elapsed)
+        trace = query_trace.get()
+        if trace is not None:
+            # SELECT 的 rowcount 为 -1，返回的行数在读取时累加
+            self._trace_entry = [query_fingerprint(sql), binds, elapsed, max(self.rowcount, 0)]
+            trace.append(self._trace_entry)
+        if elapsed * 1000 >= SLOW_QUERY_THRESHOLD_MS:
+            log_slow_query(self.connection, sql, parameters, elapsed)
+    
+    def _count_rows(self, count: int):
+        if self._trace_entry is not None:
+            self._trace_entry[3] += count
+    
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self._count_rows(1)
+        return row
+    
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._count_rows(len(rows))
+        return rows
+    
+    def fetchall(self):
+        rows = super().fetchall()
+        self._count_rows(len(rows))
+        return rows
+    
+    def __next__(self):
+        row = super().__next__()
+        self._count_rows(1)
+        return row
+
+class MeteredConnection(sqlite3.Connection):
+    """
+    get_db_connection 使用的连接类型：cursor() 和快捷 execute() 都经过 MeteredCursor
+    after_commit 登记的回调在事务提交成功后执行，回滚时丢弃
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pending_callbacks = []
+    
+    def after_commit(self, callback):
+        self.pending_callbacks.append(callback)
+    
+    def commit(self):
+        super().commit()
+        self.run_pending_callbacks()
+    
+    def rollback(self):
+        super().rollback()
+        self.pending_callbacks.clear()
+    
+    def run_pending_callbacks(self):
+        callbacks, self.pending_callbacks = self.pending_callbacks, []
+        for callback in callbacks:
+            callback()
+    
+    def cursor(self, factory=MeteredCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def route_label(request: Request) -> str:
+    """路由模板（如 /api/requests/{request_id}）；未匹配的路径统一归为 unmatched，避免标签爆炸"""
+    route = request.scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    """记录每个路由的请求数、耗时和正在处理的请求数"""
+    start = time.perf_counter()
+    http_requests_in_flight.inc()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        http_requests_in_flight.dec()
+        route = route_label(request)
+        http_requests_total.inc((request.method, route, str(status_code)))
+        http_request_duration.observe((request.method, route), time.perf_counter() - start)
+
+# /metrics 只对抓取方开放：来源地址在允许的网段内（默认只有本机），或携带 METRICS_TOKEN
+# 来源地址取直连的对端地址，不看 X-Forwarded-For
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_ALLOWED_NETWORKS = [ipaddress.ip_network(network.strip()) for network in
+                            os.getenv("METRICS_ALLOWED_NETWORKS", "127.0.0.1/32,::1/128").split(",") if network.strip()]
+
+def metrics_access_allowed(request: Request) -> bool:
+    authorization = request.headers.get("authorization", "")
+    if METRICS_TOKEN and authorization.lower().startswith("bearer "):
+        return hmac.compare_digest(authorization[7:].encode(), METRICS_TOKEN.encode())
+    try:
+        client_ip = ipaddress.ip_address(request.client.host if request.client else "")
+    except ValueError:
+        return False
+    return any(client_ip in network for network in METRICS_ALLOWED_NETWORKS)
+
+@app.get("/metrics")
+async def prometheus_metrics(request: Request):
+    """Prometheus 文本格式的指标（需要在允许的网段内或携带 METRICS_TOKEN）"""
+    if not metrics_access_allowed(request):
+        raise HTTPException(status_code=403, detail="Metrics are not available from this address")
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@metrics.collector
+def collect_runtime_metrics():
+    """抓取时读取写入队列、缓冲区、事件总线和各缓存的现有计数"""
+    families = [
+        ("app_db_write_queue_depth", "gauge", "Work units waiting for the group commit writer", (),
+         [((), activity_writer._queue.qsize())]),
+        ("app_db_write_batches_total", "counter", "Transactions committed by the group commit writer", (),
+         [((), activity_writer.batches)]),
+        ("app_db_write_units_total", "counter", "Work units committed by the group commit writer", (),
+         [((), activity_writer.units)]),
+        ("app_template_usage_pending", "gauge", "Template usage records buffered but not yet written", (),
+         [((), template_usage_buffer.pending())]),
+        ("app_cluster_events_backlog", "gauge", "Cluster events published by other workers and not yet applied", (),
+         [((), cluster_bus.backlog())]),
+        ("app_cluster_events_total", "counter", "Cluster events published and received by this worker", ("direction",),
+         [(("published",), cluster_bus.published), (("received",), cluster_bus.received)]),
+    ]
+    
+    caches = {
+        "compiled_templates": compiled_templates,
+        "template_bodies": template_bodies,
+        "my_templates": my_templates_cache,
+    }
+    hits = [((name,), cache.hits) for name, cache in caches.items()]
+    misses = [((name,), cache.misses) for name, cache in caches.items()]
+    entries = [((name,), len(cache)) for name, cache in caches.items()]
+    responses = response_cache.snapshot()
+    for route, counts in responses["routes"].items():
+        hits.append(((f"response:{route}",), counts["hits"]))
+        misses.append(((f"response:{route}",), counts["misses"]))
+    entries.append((("response",), responses["size"]))
+    compression = compressed_bodies.snapshot()
+    hits.append((("compressed_bodies",), compression["hits"]))
+    misses.append((("compressed_bodies",), compression["misses"]))
+    entries.append((("compressed_bodies",), compression["entries"]))
+    families += [
+        ("app_cache_hits_total", "counter", "Cache hits by cache", ("cache",), hits),
+        ("app_cache_misses_total", "counter", "Cache misses by cache", ("cache",), misses),
+        ("app_cache_entries", "gauge", "Entries currently held by each cache", ("cache",), entries),
+        ("app_response_compression_bytes_total", "counter", "Response bytes before and after compression", ("stage",),
+         [(("in",), compression["bytesIn"]), (("out",), compression["bytesOut"])]),
+    ]
+    return families
+
+# ==================== Query Tracing ====================
+
+# 超过阈值的语句记录到慢查询日志，并附带 EXPLAIN QUERY PLAN
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "100"))
+# 同一语句指纹在此间隔内只执行一次 EXPLAIN
+SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS = float(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS", "60"))
+# 开启后每个响应都带 X-Query-Summary 头（语句数、总耗时、耗时最多的语句指纹），只建议在调试环境使用
+QUERY_DEBUG_HEADER = os.getenv("QUERY_DEBUG_HEADER", "0") == "1"
+QUERY_SUMMARY_TOP = 5
+EXPLAINABLE_VERBS = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+# 当前请求的语句记录：[指纹, 绑定参数个数, 耗时(秒), 返回/影响的行数]
+query_trace = contextvars.ContextVar("query_trace", default=None)
+slow_queries = deque(maxlen=100)
+_explained_at = {}
+_query_fingerprints = {}
+
+def query_fingerprint(sql: str) -> str:
+    """语句指纹：去掉字面量、合并 IN (?, ?, ...) 列表和空白，同一类语句得到相同的指纹"""
+    fingerprint = _query_fingerprints.get(sql)
+    if fingerprint is None:
+        normalized = re.sub(r"'(?:[^']|'')*'", "?", sql)
+        normalized = re.sub(r"\b\d+(?:\.\d+)?\b", "?", normalized)
+        normalized = " ".join(normalized.split())
+        fingerprint = re.sub(r"\(\s*\?(?:\s*,\s*\?)+\s*\)", "(?+)", normalized)
+        if len(_query_fingerprints) > 4096:
+            _query_fingerprints.clear()
+        _query_fingerprints[sql] = fingerprint
+    return fingerprint
+
+def log_slow_query(conn, sql: str, parameters, elapsed: float):
+    """记录慢查询；同一指纹按间隔附带一次执行计划（用于发现全表扫描）"""
+    fingerprint = query_fingerprint(sql)
+    plan = None
+    now = time.monotonic()
+    verb = fingerprint.split(" ", 1)[0].upper()
+    if verb in EXPLAINABLE_VERBS and now - _explained_at.get(fingerprint, -SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS) >= SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS:
+        _explained_at[fingerprint] = now
+        try:
+            # 普通游标，不再经过计时和慢查询记录
+            plan = [row[3] for row in sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()]
+        except sqlite3.Error as e:
+            plan = [f"EXPLAIN failed: {e}"]
+    slow_queries.append({
+        "fingerprint": fingerprint,
+        "ms": round(elapsed * 1000, 2),
+        "binds": len(parameters),
+        "at": datetime.utcnow().isoformat(timespec="seconds"),
+        "plan": plan
+    })
+    print(f"🐢 Slow query ({elapsed * 1000:.1f}ms): {fingerprint[:300]}")
+    for detail in plan or []:
+        print(f"   ↳ {detail}")
+
+def summarize_query_trace(trace: list) -> dict:
+    """按指纹汇总一个请求执行的语句，按总耗时取前几条"""
+    totals = {}
+    for fingerprint, binds, elapsed, rows in trace:
+        entry = totals.setdefault(fingerprint, [0, 0, 0.0, 0])
+        entry[0] += 1
+        entry[1] += binds
+        entry[2] += elapsed
+        entry[3] += rows
+    top = sorted(totals.items(), key=lambda item: item[1][2], reverse=True)[:QUERY_SUMMARY_TOP]
+    return {
+        "count": len(trace),
+        "ms": round(sum(item[2] for item in trace) * 1000, 3),
+        "rows": sum(item[3] for item in trace),
+        "top": [{"sql": fingerprint[:160], "n": n, "binds": binds, "ms": round(elapsed * 1000, 3), "rows": rows}
+                for fingerprint, (n, binds, elapsed, rows) in top]
+    }
+
+@app.middleware("http")
+async def query_trace_middleware(request: Request, call_next):
+    """为每个请求建立语句记录；QUERY_DEBUG_HEADER 开启时把汇总放到 X-Query-Summary 头"""
+    trace = []
+    token = query_trace.set(trace)
+    try:
+        response = await call_next(request)
+    finally:
+        query_trace.reset(token)
+    if QUERY_DEBUG_HEADER and trace:
+        response.headers["X-Query-Summary"] = json.dumps(summarize_query_trace(trace), separators=(",", ":"))
+    return response
+
 # 添加CORS调试中间件
 @app.middleware("http")
 async def cors_debug_middleware(request, call_next):
@@ -70,7 +962,7 @@ async def cors_debug_middleware(request, call_next):
             status_code=200,
             headers={
                 "Access-Control-Allow-Origin": allow_origin,
-                "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
+                "Access-Control-Allow-Methods": "GET, POST, PUT, PATCH, DELETE, OPTIONS",
                 "Access-Control-Allow-Headers": "*",
                 "Access-Control-Max-Age": "3600"
             }
@@ -89,18 +981,34 @@ async def cors_debug_middleware(request, call_next):
     else:
         response.headers["Access-Control-Allow-Origin"] = origin
     
-    response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
+    response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, PATCH, DELETE, OPTIONS"
     response.headers["Access-Control-Allow-Headers"] = "*"
+    response.headers["Access-Control-Expose-Headers"] = ", ".join(EXPOSED_HEADERS)
     
     print(f"✅ CORS响应已添加头部")
     return response
 
 # 数据库文件
 DB_FILE = "auth_prototype.db"
+SQLITE_BUSY_TIMEOUT_SECONDS = float(os.getenv("SQLITE_BUSY_TIMEOUT_SECONDS", "5"))
+
+def get_db_connection(**kwargs) -> sqlite3.Connection:
+    """
+    打开数据库连接：遇到写锁时等待而不是立即报 database is locked
+    （多个工作进程共用同一个数据库文件时尤其重要）
+    """
+    conn = sqlite3.connect(DB_FILE, timeout=SQLITE_BUSY_TIMEOUT_SECONDS, factory=MeteredConnection, **kwargs)
+    db_connections_opened.inc()
+    # WAL 模式下 NORMAL 同步级别不会损坏数据库，只可能丢失最后一次提交
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
 
 # JWT配置
 JWT_SECRET = "your-secret-key-change-in-production"
 JWT_ALGORITHM = "HS256"
+# 访问令牌短期有效，过期后用刷新令牌换取新的访问令牌
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "7"))
 security = HTTPBearer()
 
 # 文件存储目录
@@ -108,6 +1016,782 @@ UPLOAD_DIR = "uploads"
 if not os.path.exists(UPLOAD_DIR):
     os.makedirs(UPLOAD_DIR)
 
+# 写入合并配置：单批最多合并的写操作数，以及等待更多写操作的最长时间（毫秒）
+WRITE_BATCH_MAX = int(os.getenv("WRITE_BATCH_MAX", "64"))
+WRITE_BATCH_WINDOW_MS = float(os.getenv("WRITE_BATCH_WINDOW_MS", "2"))
+
+class GroupCommitWriter:
+    """
+    写入合并器（group commit）
+    各请求把「主数据修改 + 活动记录」作为一个工作单元提交到后台写线程，
+    写线程把同一时间窗口内的多个工作单元合并到一个事务中，只做一次 COMMIT（一次 fsync）。
+    每个工作单元运行在独立的 SAVEPOINT 中：单元内部保持原子性，失败只回滚自身。
+    """
+
+    def __init__(self, db_file: str, max_batch: int = WRITE_BATCH_MAX, window_ms: float = WRITE_BATCH_WINDOW_MS):
+        self.db_file = db_file
+        self.max_batch = max_batch
+        self.window = window_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.units = 0
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="group-commit-writer", daemon=True)
+            self._thread.start()
+
+    def submit(self, work) -> Future:
+        """提交工作单元，work(cursor) 在写事务中执行，返回值通过 Future 传回"""
+        future = Future()
+        self._ensure_started()
+        # 在提交方的上下文中执行，语句记录归入对应的请求
+        context = contextvars.copy_context()
+        self._queue.put((lambda cursor: context.run(work, cursor), future))
+        return future
+
+    async def run(self, work):
+        """在异步处理函数中提交工作单元并等待其提交完成"""
+        return await asyncio.wrap_future(self.submit(work))
+
+    def stop(self):
+        """停止写线程（先把队列中已有的工作单元提交完）"""
+        if self._thread and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+    def _collect_batch(self, first):
+        batch = [first]
+        stopping = False
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                # 先取走已经排队的，再在时间窗口内等待新的写操作
+                timeout = deadline - time.monotonic()
+                item = self._queue.get_nowait() if timeout <= 0 else self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+        return batch, stopping
+
+    def _run(self):
+        # isolation_level=None：事务由写线程显式控制
+        conn = get_db_connection(isolation_level=None, check_same_thread=False)
+        try:
+            while True:
+                first = self._queue.get()
+                if first is None:
+                    break
+                batch, stopping = self._collect_batch(first)
+                self._commit_batch(conn, batch)
+                if stopping:
+                    break
+        finally:
+            conn.close()
+
+    def _commit_batch(self, conn, batch):
+        cursor = conn.cursor()
+        outcomes = []
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for work, future in batch:
+                cursor.execute("SAVEPOINT unit")
+                # 回滚的工作单元登记的提交后回调一并丢弃
+                mark = len(conn.pending_callbacks)
+                try:
+                    result = work(cursor)
+                    cursor.execute("RELEASE SAVEPOINT unit")
+                    outcomes.append((future, result, None))
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT unit")
+                    cursor.execute("RELEASE SAVEPOINT unit")
+                    del conn.pending_callbacks[mark:]
+                    outcomes.append((future, None, e))
+            cursor.execute("COMMIT")
+        except Exception as e:
+            # 整批提交失败：所有工作单元都视为失败
+            print(f"❌ Group commit failed: {e}")
+            if conn.in_transaction:
+                conn.rollback()
+            conn.pending_callbacks.clear()
+            outcomes = [(future, None, e) for _, future in batch]
+        else:
+            # 先执行提交后回调（本进程的缓存失效等），再唤醒等待的请求
+            conn.run_pending_callbacks()
+        self.batches += 1
+        self.units += len(batch)
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+activity_writer = GroupCommitWriter(DB_FILE)
+atexit.register(activity_writer.stop)
+
+def insert_activities(cursor, rows):
+    """批量写入活动记录，rows 为 (request_id, user_id, activity_type, description) 列表"""
+    if rows:
+        cursor.executemany('''
+            INSERT INTO activities (request_id, user_id, activity_type, description)
+            VALUES (?, ?, ?, ?)
+        ''', rows)
+
+def rollup_template_usage(cursor) -> int:
+    """
+    增量汇总 template_usage：只处理上次水位线之后的新记录，
+    更新按模板、按天、按用户的汇总表
+    """
+    cursor.execute("SELECT last_id FROM rollup_state WHERE name = 'template_usage'")
+    row = cursor.fetchone()
+    last_id = row[0] if row else 0
+    cursor.execute("SELECT MAX(id) FROM template_usage")
+    max_id = cursor.fetchone()[0]
+    if not max_id or max_id <= last_id:
+        return 0
+    
+    # SELECT 中保留 WHERE 子句，避免 SQLite upsert 的语法歧义
+    cursor.execute('''
+        INSERT INTO template_usage_totals (template_id, use_count, last_used_at)
+        SELECT template_id, COUNT(*), MAX(used_at) FROM template_usage
+        WHERE id > ? AND id <= ? GROUP BY template_id
+        ON CONFLICT (template_id) DO UPDATE SET
+            use_count = use_count + excluded.use_count,
+            last_used_at = MAX(last_used_at, excluded.last_used_at)
+    ''', (last_id, max_id))
+    cursor.execute('''
+        INSERT INTO template_usage_daily (template_id, day, use_count)
+        SELECT template_id, date(used_at), COUNT(*) FROM template_usage
+        WHERE id > ? AND id <= ? GROUP BY template_id, date(used_at)
+        ON CONFLICT (template_id, day) DO UPDATE SET use_count = use_count + excluded.use_count
+    ''', (last_id, max_id))
+    cursor.execute('''
+        INSERT INTO template_usage_by_user (template_id, used_by, use_count, last_used_at)
+        SELECT template_id, used_by, COUNT(*), MAX(used_at) FROM template_usage
+        WHERE id > ? AND id <= ? GROUP BY template_id, used_by
+        ON CONFLICT (template_id, used_by) DO UPDATE SET
+            use_count = use_count + excluded.use_count,
+            last_used_at = MAX(last_used_at, excluded.last_used_at)
+    ''', (last_id, max_id))
+    cursor.execute('''
+        INSERT INTO rollup_state (name, last_id) VALUES ('template_usage', ?)
+        ON CONFLICT (name) DO UPDATE SET last_id = excluded.last_id
+    ''', (max_id,))
+    return max_id - last_id
+
+USAGE_FLUSH_INTERVAL_SECONDS = float(os.getenv("USAGE_FLUSH_INTERVAL_SECONDS", "5"))
+
+class TemplateUsageBuffer:
+    """
+    模板使用计数缓冲
+    apply_template 只在内存中累加计数和使用记录，后台线程定期把合并后的增量
+    通过写入合并器一次性写入（usage_count 为最终一致）
+    """
+    
+    def __init__(self, writer: GroupCommitWriter, interval: float = USAGE_FLUSH_INTERVAL_SECONDS):
+        self.writer = writer
+        self.interval = interval
+        self._counts = {}
+        self._rows = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+    
+    def record(self, template_id: str, user_id: int, variables_used: dict, template_version: Optional[int] = None):
+        with self._lock:
+            self._counts[template_id] = self._counts.get(template_id, 0) + 1
+            self._rows.append((template_id, user_id, json.dumps(variables_used), template_version))
+        self._ensure_started()
+    
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._rows)
+    
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="template-usage-flusher", daemon=True)
+            self._thread.start()
+    
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"⚠️ Template usage flush failed, will retry: {e}")
+    
+    def _take(self):
+        with self._lock:
+            counts, rows = self._counts, self._rows
+            self._counts, self._rows = {}, []
+        return counts, rows
+    
+    def _restore(self, counts: dict, rows: list):
+        with self._lock:
+            for template_id, count in counts.items():
+                self._counts[template_id] = self._counts.get(template_id, 0) + count
+            self._rows = rows + self._rows
+    
+    def flush(self):
+        """把缓冲的计数和使用记录写入数据库，失败时放回缓冲等待下次重试"""
+        counts, rows = self._take()
+        if not rows:
+            return 0
+        
+        def write_usage(cursor):
+            cursor.executemany("UPDATE templates SET usage_count = usage_count + ? WHERE template_id = ?",
+                               [(count, template_id) for template_id, count in counts.items()])
+            # 模板在缓冲期间被删除时不再写入使用记录
+            cursor.executemany('''
+                INSERT INTO template_usage (template_id, used_by, variables_used, template_version)
+                SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM templates WHERE template_id = ?)
+            ''', [row + (row[0],) for row in rows])
+            # 同一事务中增量更新使用统计汇总
+            rollup_template_usage(cursor)
+        
+        try:
+            self.writer.submit(write_usage).result()
+        except Exception:
+            self._restore(counts, rows)
+            raise
+        # 最近使用列表和按使用次数排序的模板列表随之变化
+        invalidate_my_templates({row[1] for row in rows})
+        invalidate_responses("template_usage")
+        return len(rows)
+
+template_usage_buffer = TemplateUsageBuffer(activity_writer)
+# 进程退出时先写入缓冲的使用记录（atexit 按注册的逆序执行，早于写线程停止）
+atexit.register(template_usage_buffer.flush)
+
+# ==================== Cluster Event Bus ====================
+
+# 多工作进程部署：__main__ 通过 APP_WORKERS 环境变量告诉每个工作进程
+APP_WORKERS = int(os.getenv("APP_WORKERS", "1"))
+CLUSTER_BUS_ENABLED = os.getenv("CLUSTER_BUS", "1" if APP_WORKERS > 1 else "0") == "1"
+CLUSTER_BUS_POLL_INTERVAL = float(os.getenv("CLUSTER_BUS_POLL_INTERVAL", "0.5"))
+CLUSTER_EVENT_RETENTION_SECONDS = 600
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+class ClusterEventBus:
+    """
+    基于 SQLite 的跨进程事件总线，用于缓存失效和令牌吊销的广播
+    publish 在本进程执行处理函数，并写入 cluster_events；
+    其他工作进程的轮询线程读取新事件并执行同样的处理函数
+    未启用时（单进程部署）只在本进程执行，不写数据库
+    """
+    
+    def __init__(self, db_file: str, enabled: bool, interval: float = CLUSTER_BUS_POLL_INTERVAL):
+        self.db_file = db_file
+        self.enabled = enabled
+        self.interval = interval
+        self.worker_id = WORKER_ID
+        self.handlers = {}
+        self.published = 0
+        self.received = 0
+        self._last_id = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+    
+    def on(self, kind: str):
+        """注册事件处理函数（装饰器）"""
+        def register(handler):
+            self.handlers.setdefault(kind, []).append(handler)
+            return handler
+        return register
+    
+    def publish(self, kind: str, payload: Optional[dict] = None, cursor=None):
+        """
+        发布事件；传入 cursor 时事件与调用方的修改在同一事务中写入
+        （调用方持有写锁时必须这样做，否则另开的连接会等待写锁），
+        本进程的处理函数在该事务提交后才执行，回滚时不执行；
+        不传 cursor 时调用方应在自己的修改提交之后再发布
+        """
+        payload = payload or {}
+        if cursor is not None:
+            cursor.connection.after_commit(lambda: self._dispatch(kind, payload))
+        else:
+            self._dispatch(kind, payload)
+        if not self.enabled:
+            return
+        row = (self.worker_id, kind, json.dumps(payload), time.time())
+        sql = "INSERT INTO cluster_events (origin, kind, payload, created_at) VALUES (?, ?, ?, ?)"
+        if cursor is not None:
+            cursor.execute(sql, row)
+        else:
+            conn = get_db_connection()
+            try:
+                conn.execute(sql, row)
+                conn.commit()
+            finally:
+                conn.close()
+        self.published += 1
+    
+    def _dispatch(self, kind: str, payload: dict):
+        for handler in self.handlers.get(kind, []):
+            try:
+                handler(payload)
+            except Exception as e:
+                print(f"⚠️ Cluster event handler failed for {kind}: {e}")
+    
+    def start(self):
+        """启动轮询线程（只处理启动之后发布的事件）"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            conn = get_db_connection()
+            try:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS cluster_events (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        origin TEXT NOT NULL,
+                        kind TEXT NOT NULL,
+                        payload TEXT,
+                        created_at REAL NOT NULL
+                    )
+                ''')
+                conn.commit()
+                self._last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM cluster_events").fetchone()[0]
+            finally:
+                conn.close()
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="cluster-event-bus", daemon=True)
+            self._thread.start()
+            print(f"📡 Cluster event bus started for worker {self.worker_id}")
+    
+    def stop(self):
+        self._stopping.set()
+
+    def backlog(self) -> int:
+        """已写入但本进程尚未处理的事件数"""
+        if not self.enabled:
+            return 0
+        conn = get_db_connection()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM cluster_events WHERE id > ?", (self._last_id,)).fetchone()[0]
+        finally:
+            conn.close()
+    
+    def _run(self):
+        conn = get_db_connection()
+        polls = 0
+        try:
+            while not self._stopping.wait(self.interval):
+                try:
+                    rows = conn.execute('''
+                        SELECT id, origin, kind, payload FROM cluster_events WHERE id > ? ORDER BY id
+                    ''', (self._last_id,)).fetchall()
+                    for event_id, origin, kind, payload in rows:
+                        self._last_id = event_id
+                        if origin != self.worker_id:
+                            self.received += 1
+                            self._dispatch(kind, json.loads(payload) if payload else {})
+                    polls += 1
+                    # 定期清理过期事件（所有进程都已经读取过）
+                    if polls % 120 == 0:
+                        conn.execute("DELETE FROM cluster_events WHERE created_at < ?",
+                                     (time.time() - CLUSTER_EVENT_RETENTION_SECONDS,))
+                        conn.commit()
+                except sqlite3.Error as e:
+                    print(f"⚠️ Cluster event poll failed, will retry: {e}")
+        finally:
+            conn.close()
+
+cluster_bus = ClusterEventBus(DB_FILE, CLUSTER_BUS_ENABLED)
+atexit.register(cluster_bus.stop)
+
+@app.on_event("startup")
+def start_cluster_bus():
+    cluster_bus.start()
+
+# ==================== Response Cache ====================
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+
+class ResponseCache:
+    """
+    接口结果缓存：键为 (路由, 参数, 可见范围)，LRU 淘汰
+    每个条目记录所依赖数据的标签（如 "request:REQ123"、"templates"），
+    写操作只使包含相应标签的条目失效
+    """
+    
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.clock = 0
+        self._floor = 0
+        self._entries = OrderedDict()
+        self._tag_keys = {}
+        self._tag_invalidated = {}
+        self._stats = {}
+        self._evictions = 0
+        self._invalidations = 0
+        self._lock = threading.Lock()
+    
+    def _route_stats(self, route: str) -> dict:
+        return self._stats.setdefault(route, {"hits": 0, "misses": 0})
+    
+    def get(self, route: str, key):
+        with self._lock:
+            entry = self._entries.get((route, key))
+            if entry is None:
+                self._route_stats(route)["misses"] += 1
+                return None
+            self._entries.move_to_end((route, key))
+            self._route_stats(route)["hits"] += 1
+            return entry[0]
+    
+    def put(self, route: str, key, value, tags: list, since: int):
+        """
+        写入结果；since 为未命中时读取的 clock，
+        计算期间任一标签被失效则丢弃该结果（避免缓存写操作之前读到的旧数据）
+        """
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if since < self._floor or any(self._tag_invalidated.get(tag, 0) > since for tag in tags):
+                return
+            self._remove((route, key))
+            self._entries[(route, key)] = (value, tags)
+            for tag in tags:
+                self._tag_keys.setdefault(tag, set()).add((route, key))
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+    
+    def _remove(self, entry_key):
+        entry = self._entries.pop(entry_key, None)
+        if entry is None:
+            return
+        for tag in entry[1]:
+            keys = self._tag_keys.get(tag)
+            if keys is not None:
+                keys.discard(entry_key)
+                if not keys:
+                    del self._tag_keys[tag]
+    
+    def invalidate(self, tags: list):
+        with self._lock:
+            self.clock += 1
+            for tag in tags:
+                self._tag_invalidated[tag] = self.clock
+                for entry_key in list(self._tag_keys.get(tag, ())):
+                    self._remove(entry_key)
+                    self._invalidations += 1
+            # 失效记录过多时整体清空，之前开始的计算结果一律不再写入
+            if len(self._tag_invalidated) > self.max_size * 4:
+                self._tag_invalidated.clear()
+                self._floor = self.clock
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            routes = {}
+            for route, counts in self._stats.items():
+                total = counts["hits"] + counts["misses"]
+                routes[route] = dict(counts, hitRatio=round(counts["hits"] / total, 4) if total else None)
+            hits = sum(counts["hits"] for counts in self._stats.values())
+            misses = sum(counts["misses"] for counts in self._stats.values())
+            return {
+                "size": len(self._entries),
+                "maxSize": self.max_size,
+                "hits": hits,
+                "misses": misses,
+                "hitRatio": round(hits / (hits + misses), 4) if hits + misses else None,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations,
+                "routes": routes
+            }
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+
+@cluster_bus.on("responses_changed")
+def _on_responses_changed(payload: dict):
+    response_cache.invalidate(payload["tags"])
+
+def invalidate_responses(*tags: str):
+    """写操作提交后调用，使依赖这些数据的缓存结果失效（所有工作进程）"""
+    cluster_bus.publish("responses_changed", {"tags": list(tags)})
+
+# ==================== Config Schema ====================
+
+# 网关配置 JSON Schema（只使用 type / properties / required / additionalProperties /
+# items / enum / minimum / maximum / maxLength / pattern 这些关键字）
+# 规则保持宽松：只约束前端 filter*Config 依赖的结构和类型，未知字段一律允许
+CONFIG_SCHEMA_VERSION = int(os.getenv("CONFIG_SCHEMA_VERSION", "1"))
+CONFIG_SCHEMA_MAX_ERRORS = 50
+
+_NULLABLE_STRING = {"type": ["string", "null"]}
+_NULLABLE_BOOLEAN = {"type": ["boolean", "null"]}
+_STRING_LIST = {"type": ["array", "null"], "items": {"type": ["string", "null"]}}
+# 表单中的端口可能是字符串：允许空值，数字部分限定在 0-65535
+_PORT = {"type": ["string", "integer", "null"],
+         "pattern": r"^\s*0*([0-9]{1,4}|[1-5][0-9]{4}|6[0-4][0-9]{3}|65[0-4][0-9]{2}|655[0-2][0-9]|6553[0-5])?\s*$",
+         "minimum": 0, "maximum": 65535}
+_FILE_REF = {
+    "type": ["object", "null"],
+    "properties": {"name": _NULLABLE_STRING, "size": {"type": ["number", "null"]}}
+}
+_WAN_LINK = {
+    "type": ["object", "null"],
+    "properties": {
+        "enabled": _NULLABLE_BOOLEAN,
+        "trackingMethod": _NULLABLE_STRING,
+        "trackingAddresses": _STRING_LIST
+    }
+}
+
+GATEWAY_CONFIG_SCHEMAS = {
+    1: {
+        "type": "object",
+        "properties": {
+            "general": {
+                "type": ["object", "null"],
+                "properties": {
+                    "rakId": _NULLABLE_STRING,
+                    "customerName": _NULLABLE_STRING,
+                    "gatewayModel": _NULLABLE_STRING,
+                    # 表单中是可自由输入的文本框（datalist 只给出 high / medium / low 建议），不限定取值
+                    "priority": _NULLABLE_STRING
+                }
+            },
+            "network": {
+                "type": ["object", "null"],
+                "properties": {
+                    "wan": {
+                        "type": ["object", "null"],
+                        "properties": {
+                            "priority": {
+                                "type": ["array", "null"],
+                                "items": {"enum": ["ethernet", "wifi", "cellular"]}
+                            },
+                            "ethernet": _WAN_LINK,
+                            "wifi": _WAN_LINK,
+                            "cellular": _WAN_LINK
+                        }
+                    },
+                    "lan": {
+                        "type": ["object", "null"],
+                        "properties": {
+                            "ethernet": _NULLABLE_BOOLEAN,
+                            "wifiAp": {
+                                "type": ["object", "null"],
+                                "properties": {"enabled": _NULLABLE_BOOLEAN, "ssid": {"type": ["string", "null"], "maxLength": 32}}
+                            }
+                        }
+                    }
+                }
+            },
+            "lora": {
+                "type": ["object", "null"],
+                "properties": {
+                    "mode": _NULLABLE_STRING,
+                    "whitelist": {
+                        "type": ["object", "null"],
+                        "properties": {
+                            "enabled": _NULLABLE_BOOLEAN,
+                            "ouiList": _STRING_LIST,
+                            "networkIdList": _STRING_LIST
+                        }
+                    },
+                    "basicStation": {
+                        "type": ["object", "null"],
+                        "properties": {
+                            "serverUrl": _NULLABLE_STRING,
+                            "serverPort": _PORT,
+                            "ztp": _NULLABLE_BOOLEAN,
+                            "batchTtn": _NULLABLE_BOOLEAN,
+                            "batchAwsIot": _NULLABLE_BOOLEAN,
+                            "trustCaCertificate": _FILE_REF,
+                            "clientCertificate": _FILE_REF,
+                            "clientKey": _FILE_REF
+                        }
+                    },
+                    "packetForwarder": {
+                        "type": ["object", "null"],
+                        "properties": {
+                            "submode": _NULLABLE_STRING,
+                            "udpGwmp": {
+                                "type": ["object", "null"],
+                                "properties": {
+                                    "serverAddress": _NULLABLE_STRING,
+                                    "portUp": _PORT,
+                                    "portDown": _PORT,
+                                    "autoDataRecovery": _NULLABLE_BOOLEAN
+                                }
+                            },
+                            "mqttBridge": {
+                                "type": ["object", "null"],
+                                "properties": {
+                                    "brokerAddress": _NULLABLE_STRING,
+                                    "brokerPort": _PORT,
+                                    "caCertificate": _FILE_REF,
+                                    "clientCertificate": _FILE_REF,
+                                    "clientKey": _FILE_REF
+                                }
+                            }
+                        }
+                    }
+                }
+            },
+            "system": {
+                "type": ["object", "null"],
+                "properties": {
+                    "wisdmEnabled": _NULLABLE_BOOLEAN,
+                    "wisdmConnect": _NULLABLE_BOOLEAN,
+                    "shareLog": _NULLABLE_BOOLEAN,
+                    "ntpEnabled": _NULLABLE_BOOLEAN,
+                    "ntpServers": _STRING_LIST,
+                    "gatewayName": _NULLABLE_STRING,
+                    "sshDisable": _NULLABLE_BOOLEAN
+                }
+            },
+            "extensions": {
+                "type": ["object", "null"],
+                "properties": {"extensionFiles": {"type": ["array", "null"]}}
+            },
+            "other": {
+                "type": ["object", "null"],
+                "properties": {"configFiles": {"type": ["array", "null"]}}
+            }
+        }
+    }
+}
+
+_SCHEMA_PY_TYPES = {
+    "string": (str,),
+    "boolean": (bool,),
+    "null": (type(None),),
+    "object": (dict,),
+    "array": (list,),
+    # bool 是 int 的子类，按 type() 精确匹配可以把它排除
+    "number": (int, float),
+    "integer": (int,)
+}
+
+class ConfigSchemaError(Exception):
+    """schema 本身不合法（使用了不支持的关键字）"""
+    pass
+
+def _compile_schema_node(schema: dict, allow_placeholders: bool):
+    """把一个 schema 节点编译成 validate(value, path, errors) 闭包，关键字只在编译时解析一次"""
+    unsupported = set(schema) - {"type", "properties", "required", "additionalProperties", "items",
+                                 "enum", "minimum", "maximum", "maxLength", "pattern"}
+    if unsupported:
+        raise ConfigSchemaError(f"Unsupported schema keywords: {sorted(unsupported)}")
+    
+    type_names = schema.get("type")
+    if isinstance(type_names, str):
+        type_names = [type_names]
+    allowed_types = frozenset(t for name in type_names for t in _SCHEMA_PY_TYPES[name]) if type_names else None
+    expected = " or ".join(type_names) if type_names else ""
+    
+    enum = schema.get("enum")
+    minimum, maximum = schema.get("minimum"), schema.get("maximum")
+    max_length = schema.get("maxLength")
+    pattern = re.compile(schema["pattern"]) if "pattern" in schema else None
+    properties = {key: _compile_schema_node(child, allow_placeholders)
+                  for key, child in schema.get("properties", {}).items()}
+    required = schema.get("required", [])
+    additional = schema.get("additionalProperties", True)
+    items = _compile_schema_node(schema["items"], allow_placeholders) if "items" in schema else None
+    
+    def validate(value, path, errors):
+        if len(errors) >= CONFIG_SCHEMA_MAX_ERRORS:
+            return
+        value_type = type(value)
+        # 模板中的占位符在渲染前可以出现在任何类型的位置
+        if allow_placeholders and value_type is str and "{{" in value and PLACEHOLDER_PATTERN.search(value):
+            return
+        if allowed_types is not None and value_type not in allowed_types:
+            errors.append({"path": path or "/", "message": f"Expected {expected}"})
+            return
+        if enum is not None and value not in enum:
+            errors.append({"path": path or "/", "message": f"Must be one of {enum}"})
+            return
+        if value_type is dict:
+            for key in required:
+                if key not in value:
+                    errors.append({"path": f"{path}/{key}", "message": "Required property is missing"})
+            for key, child in properties.items():
+                if key in value:
+                    child(value[key], f"{path}/{key}", errors)
+            if additional is False:
+                for key in value:
+                    if key not in properties:
+                        errors.append({"path": f"{path}/{key}", "message": "Unknown property"})
+        elif value_type is list:
+            if items is not None:
+                for index, item in enumerate(value):
+                    items(item, f"{path}/{index}", errors)
+        elif value_type is str:
+            if max_length is not None and len(value) > max_length:
+                errors.append({"path": path or "/", "message": f"Longer than {max_length} characters"})
+            if pattern is not None and not pattern.search(value):
+                errors.append({"path": path or "/", "message": f"Does not match {pattern.pattern}"})
+        elif value_type is int or value_type is float:
+            if minimum is not None and value < minimum:
+                errors.append({"path": path or "/", "message": f"Less than {minimum}"})
+            if maximum is not None and value > maximum:
+                errors.append({"path": path or "/", "message": f"Greater than {maximum}"})
+    
+    return validate
+
+# 编译结果按 (schema 版本, 是否允许占位符) 缓存
+_config_validators = {}
+_config_validators_lock = threading.Lock()
+
+def get_config_validator(version: int = CONFIG_SCHEMA_VERSION, allow_placeholders: bool = False):
+    key = (version, allow_placeholders)
+    validator = _config_validators.get(key)
+    if validator is None:
+        with _config_validators_lock:
+            validator = _config_validators.get(key)
+            if validator is None:
+                if version not in GATEWAY_CONFIG_SCHEMAS:
+                    raise ConfigSchemaError(f"Unknown config schema version {version}")
+                validator = _compile_schema_node(GATEWAY_CONFIG_SCHEMAS[version], allow_placeholders)
+                _config_validators[key] = validator
+    return validator
+
+def validate_config_data(config_data, allow_placeholders: bool = False, version: int = CONFIG_SCHEMA_VERSION) -> list:
+    """按网关配置 schema 校验 configData，返回 [{path, message}]（JSON Pointer 路径）"""
+    errors = []
+    get_config_validator(version, allow_placeholders)(config_data, "", errors)
+    return errors
+
+def check_config_data(config_data, allow_placeholders: bool = False):
+    """写入前校验 configData，不符合 schema 时返回 422 和出错的路径"""
+    errors = validate_config_data(config_data, allow_placeholders)
+    if errors:
+        raise HTTPException(status_code=422, detail={
+            "message": "configData does not match the gateway config schema",
+            "schemaVersion": CONFIG_SCHEMA_VERSION,
+            "errors": errors
+        })
+
+@app.get("/api/config/schema")
+async def get_config_schema(version: Optional[int] = None):
+    """获取网关配置 JSON Schema（默认当前版本）"""
+    version = version or CONFIG_SCHEMA_VERSION
+    if version not in GATEWAY_CONFIG_SCHEMAS:
+        raise HTTPException(status_code=404, detail=f"Config schema version {version} not found")
+    return {"version": version, "current": version == CONFIG_SCHEMA_VERSION, "schema": GATEWAY_CONFIG_SCHEMAS[version]}
+
 # 数据模型
 class UserCreate(BaseModel):
     email: str
@@ -152,25 +1836,208 @@ class TemplateUpdate(BaseModel):
     tags: Optional[List[str]] = None
     isPublic: Optional[bool] = None
 
-# 简单的密码哈希（仅用于演示）
+# ==================== Password Hashing ====================
+
+def _available_password_schemes() -> list:
+    """按优先级列出可用的哈希算法：argon2 / bcrypt 需要额外的后端库，pbkdf2_sha256 始终可用"""
+    schemes = []
+    try:
+        import argon2  # noqa: F401
+        schemes.append("argon2")
+    except ImportError:
+        pass
+    try:
+        import bcrypt  # noqa: F401
+        schemes.append("bcrypt")
+    except ImportError:
+        pass
+    return schemes + ["pbkdf2_sha256"]
+
+def build_password_context() -> CryptContext:
+    """
+    创建 passlib 上下文：新密码使用首选算法，旧的无盐 SHA-256 十六进制哈希（hex_sha256）
+    仍可验证，但标记为过时，登录成功后自动重新哈希
+    PASSWORD_HASH_SCHEME 指定算法，PASSWORD_HASH_COST 调整计算成本
+    """
+    schemes = _available_password_schemes()
+    preferred = os.getenv("PASSWORD_HASH_SCHEME") or schemes[0]
+    if preferred not in schemes:
+        raise RuntimeError(f"Password hash scheme {preferred} is not available (available: {schemes})")
+    schemes = [preferred] + [scheme for scheme in schemes if scheme != preferred]
+
+    settings = {}
+    cost = os.getenv("PASSWORD_HASH_COST")
+    if cost:
+        cost_setting = {"argon2": "time_cost", "bcrypt": "rounds", "pbkdf2_sha256": "rounds"}[preferred]
+        settings[f"{preferred}__{cost_setting}"] = int(cost)
+    return CryptContext(schemes=schemes + ["hex_sha256"], default=preferred, deprecated=["hex_sha256"], **settings)
+
+pwd_context = build_password_context()
+
+# 密码校验在有界线程池中执行，避免占用事件循环；信号量限制同时排队的登录数量
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", str(PASSWORD_HASH_WORKERS * 8)))
+PASSWORD_HASH_QUEUE_TIMEOUT = float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT", "5"))
+password_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+password_hash_slots = asyncio.Semaphore(PASSWORD_HASH_MAX_PENDING)
+# 基准测试使用独立线程池，不占用登录的线程池和排队名额
+PASSWORD_BENCHMARK_MAX_LOGINS = 100
+password_benchmark_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS,
+                                                 thread_name_prefix="password-benchmark")
+# 用户不存在时也执行一次校验，响应时间不暴露邮箱是否已注册
+_DUMMY_PASSWORD_HASH = pwd_context.hash(uuid.uuid4().hex)
+
 def get_password_hash(password: str) -> str:
-    """简单的密码哈希，仅用于演示"""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """计算密码哈希（同步，会占用 CPU）"""
+    return pwd_context.hash(password)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """验证密码"""
-    # 使用SHA256哈希验证
-    import hashlib
-    return hashlib.sha256(plain_password.encode()).hexdigest() == hashed_password
+    """验证密码（同步，会占用 CPU）"""
+    try:
+        return pwd_context.verify(plain_password, hashed_password)
+    except (ValueError, TypeError):
+        # 无法识别的哈希格式
+        return False
 
-def create_access_token(data: dict) -> str:
+def _verify_and_update(plain_password: str, hashed_password: Optional[str]):
+    try:
+        return pwd_context.verify_and_update(plain_password, hashed_password or _DUMMY_PASSWORD_HASH)
+    except (ValueError, TypeError):
+        return False, None
+
+async def run_password_task(func, *args):
+    """在密码线程池中执行哈希计算；排队超时返回 503，而不是拖慢其他接口"""
+    password_tasks_queued.inc()
+    try:
+        try:
+            await asyncio.wait_for(password_hash_slots.acquire(), timeout=PASSWORD_HASH_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="Too many concurrent logins, please retry",
+                                headers={"Retry-After": "1"})
+        try:
+            return await asyncio.get_running_loop().run_in_executor(password_hash_executor, func, *args)
+        finally:
+            password_hash_slots.release()
+    finally:
+        password_tasks_queued.dec()
+
+async def verify_password_async(plain_password: str, hashed_password: Optional[str]):
+    """异步验证密码，返回 (是否匹配, 需要保存的新哈希或 None)"""
+    verified, new_hash = await run_password_task(_verify_and_update, plain_password, hashed_password)
+    return (verified and hashed_password is not None), new_hash
+
+async def get_password_hash_async(password: str) -> str:
+    return await run_password_task(get_password_hash, password)
+
+def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """创建JWT令牌"""
     to_encode = data.copy()
-    expire = datetime.utcnow().replace(microsecond=0) + timedelta(hours=24)
+    expire = datetime.utcnow().replace(microsecond=0) + (expires_delta or timedelta(hours=24))
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
+# 令牌吊销：user_id -> 当前有效的最小用户版本（uv），版本更低的令牌一律拒绝
+# 只记录版本被提升过的用户，通常很小
+token_revocations = {}
+token_revocations_lock = threading.Lock()
+
+@cluster_bus.on("tokens_revoked")
+def _on_tokens_revoked(payload: dict):
+    with token_revocations_lock:
+        user_id = payload["user_id"]
+        token_revocations[user_id] = max(token_revocations.get(user_id, 1), payload["version"])
+
+def revoke_user_tokens(cursor, user_id: int) -> int:
+    """
+    提升用户版本（角色变更或停用时调用），该用户所有会话已签发的令牌全部失效
+    吊销事件与版本更新在同一事务中写入，提交后广播到其他工作进程
+    """
+    cursor.execute("UPDATE users SET token_version = COALESCE(token_version, 1) + 1 WHERE id = ?", (user_id,))
+    cursor.execute("SELECT token_version FROM users WHERE id = ?", (user_id,))
+    row = cursor.fetchone()
+    version = row[0] if row else 1
+    cluster_bus.publish("tokens_revoked", {"user_id": user_id, "version": version}, cursor=cursor)
+    return version
+
+# 会话吊销：session_id -> 可以从表中移除的时间（该会话最后一个访问令牌过期之后）
+# 只保留最近登出的会话，访问令牌过期后条目即被清理
+revoked_sessions = {}
+
+@cluster_bus.on("session_revoked")
+def _on_session_revoked(payload: dict):
+    now = time.time()
+    with token_revocations_lock:
+        for session_id in [sid for sid, until in revoked_sessions.items() if until < now]:
+            del revoked_sessions[session_id]
+        revoked_sessions[payload["session_id"]] = payload["until"]
+
+def create_session(cursor, user_id: int):
+    """登录时创建会话，返回 (session_id, 刷新令牌 jti)；顺带清理该用户已过期的会话"""
+    now = time.time()
+    session_id, refresh_jti = uuid.uuid4().hex, uuid.uuid4().hex
+    cursor.execute("DELETE FROM auth_sessions WHERE user_id = ? AND expires_at < ?", (user_id, now))
+    cursor.execute('''
+        INSERT INTO auth_sessions (session_id, user_id, refresh_jti, expires_at)
+        VALUES (?, ?, ?, ?)
+    ''', (session_id, user_id, refresh_jti, now + REFRESH_TOKEN_EXPIRE_DAYS * 86400))
+    return session_id, refresh_jti
+
+def revoke_session(cursor, session_id: str):
+    """
+    吊销单个会话（登出或检测到刷新令牌重放时调用）：刷新令牌不能再使用，
+    该会话已签发的访问令牌被拒绝；其他设备上的会话不受影响
+    """
+    now = time.time()
+    cursor.execute("UPDATE auth_sessions SET revoked_at = ? WHERE session_id = ? AND revoked_at IS NULL",
+                   (now, session_id))
+    cluster_bus.publish("session_revoked", {"session_id": session_id, "until": now + ACCESS_TOKEN_EXPIRE_MINUTES * 60},
+                        cursor=cursor)
+
+def load_token_revocations(cursor):
+    """启动时从 users.token_version 和 auth_sessions 恢复吊销表"""
+    cursor.execute("""
+        SELECT id, COALESCE(token_version, 1), is_active FROM users
+        WHERE token_version > 1 OR is_active = 0
+    """)
+    with token_revocations_lock:
+        for user_id, version, is_active in cursor.fetchall():
+            # 已停用的用户：当前版本签发的令牌也要拒绝
+            minimum = version if is_active else version + 1
+            token_revocations[user_id] = max(token_revocations.get(user_id, 1), minimum)
+    # 访问令牌可能仍未过期的已吊销会话
+    access_lifetime = ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    cursor.execute("SELECT session_id, revoked_at FROM auth_sessions WHERE revoked_at > ?",
+                   (time.time() - access_lifetime,))
+    with token_revocations_lock:
+        for session_id, revoked_at in cursor.fetchall():
+            revoked_sessions[session_id] = revoked_at + access_lifetime
+
+def is_token_revoked(user_id: int, user_version: int, session_id: str) -> bool:
+    if session_id in revoked_sessions:
+        return True
+    minimum = token_revocations.get(user_id)
+    return minimum is not None and user_version < minimum
+
+def issue_tokens(user_id: int, email: str, name: Optional[str], role: str, token_version: int,
+                 session_id: str, refresh_jti: str) -> dict:
+    """签发访问令牌（携带 uid / role / name / uv / sid 声明）和刷新令牌（携带会话当前的 jti）"""
+    access_token = create_access_token(
+        {"sub": email, "uid": user_id, "role": role, "name": name, "uv": token_version, "sid": session_id,
+         "typ": "access"},
+        timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+    refresh_token = create_access_token(
+        {"sub": email, "uid": user_id, "uv": token_version, "sid": session_id, "typ": "refresh", "jti": refresh_jti},
+        timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    )
+    return {
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    }
+
 def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """验证JWT令牌"""
     try:
@@ -184,9 +2051,25 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
 
 def init_database():
     """初始化SQLite数据库"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
+    # WAL：读不阻塞写、写不阻塞读，多个工作进程可以并发读取（设置会保存在数据库文件中）
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # 每个工作进程启动时都会执行初始化：整个过程放在一个写事务中，多个进程依次执行，迁移不会重复
+    cursor.execute("BEGIN IMMEDIATE")
+    
+    # 跨进程事件表（令牌吊销会在初始化事务中发布事件）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cluster_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            origin TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT,
+            created_at REAL NOT NULL
+        )
+    ''')
+    
     # 用户表
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -210,6 +2093,24 @@ def init_database():
         cursor.execute("UPDATE users SET role = 'rakwireless' WHERE email LIKE '%@rakwireless.com'")
         print("✅ Migrated existing RAK Wireless users to 'rakwireless' role")
     
+    # 用户版本：写入令牌的 uv 声明，角色变更或停用时递增
+    if 'token_version' not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN token_version INTEGER DEFAULT 1")
+    
+    # 登录会话：每次登录一行，refresh_jti 是当前唯一有效的刷新令牌，刷新时轮换
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS auth_sessions (
+            session_id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            refresh_jti TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at REAL NOT NULL,
+            revoked_at REAL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_auth_sessions_user ON auth_sessions (user_id)")
+    
     # 请求表
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS requests (
@@ -226,6 +2127,7 @@ def init_database():
             tags TEXT,
             user_id INTEGER,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            version INTEGER DEFAULT 1,
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
@@ -235,17 +2137,21 @@ def init_database():
     columns = [column[1] for column in cursor.fetchall()]
     if 'tags' not in columns:
         cursor.execute("ALTER TABLE requests ADD COLUMN tags TEXT")
+    # 行版本号（乐观并发控制 / ETag）
+    if 'version' not in columns:
+        cursor.execute("ALTER TABLE requests ADD COLUMN version INTEGER DEFAULT 1")
     
     # 迁移现有数据：将'pending'状态更新为'Open'
+    cursor.execute("SAVEPOINT migrate_status")
     try:
         cursor.execute("UPDATE requests SET status = 'Open' WHERE status = 'pending' OR status = 'Pending'")
-        conn.commit()
         updated_count = cursor.rowcount
+        cursor.execute("RELEASE SAVEPOINT migrate_status")
         if updated_count > 0:
             print(f"✅ Migrated {updated_count} requests from 'pending' to 'Open'")
     except Exception as e:
         print(f"⚠️ Migration warning: {e}")
-        conn.rollback()
+        cursor.execute("ROLLBACK TO SAVEPOINT migrate_status")
     
     # 检查并添加created_at字段（如果不存在）
     cursor.execute("PRAGMA table_info(requests)")
@@ -260,7 +2166,7 @@ def init_database():
     admin_user_name = "Admin"
     
     # 检查 admin 用户是否已存在
-    cursor.execute("SELECT id, role FROM users WHERE email = ?", (admin_user_email,))
+    cursor.execute("SELECT id, role, password_hash FROM users WHERE email = ?", (admin_user_email,))
     existing_admin = cursor.fetchone()
     
     if not existing_admin:
@@ -272,13 +2178,18 @@ def init_database():
         ''', (admin_user_email, password_hash, admin_user_name))
         print(f"✅ Created admin user: {admin_user_email}")
     else:
-        # 更新现有用户为 admin 角色，并更新密码
-        password_hash = get_password_hash(admin_user_password)
+        # 更新现有用户为 admin 角色，并更新密码（密码未变且哈希不过时则保留原哈希）
+        password_hash = existing_admin[2]
+        if not verify_password(admin_user_password, password_hash) or pwd_context.needs_update(password_hash):
+            password_hash = get_password_hash(admin_user_password)
         cursor.execute('''
             UPDATE users 
             SET role = 'admin', password_hash = ?, name = ?
             WHERE email = ?
         ''', (password_hash, admin_user_name, admin_user_email))
+        # 角色发生变化时，旧令牌中的角色声明失效
+        if existing_admin[1] != 'admin':
+            revoke_user_tokens(cursor, existing_admin[0])
         print(f"✅ Updated admin user: {admin_user_email} (role: admin, password updated)")
     
     # 模板表
@@ -315,23 +2226,201 @@ def init_database():
             FOREIGN KEY (used_by) REFERENCES users (id)
         )
     ''')
-    
-    # 模板收藏表
+    
+    # 模板收藏表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS template_favorites (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            template_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (template_id) REFERENCES templates (template_id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(template_id, user_id)
+        )
+    ''')
+
+    # 模板版本快照：内容按哈希去重，版本记录只追加不修改
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS template_contents (
+            content_hash TEXT PRIMARY KEY,
+            config_data TEXT NOT NULL,
+            variables TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS template_versions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            template_id TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            content_hash TEXT NOT NULL,
+            name TEXT,
+            description TEXT,
+            category TEXT,
+            tags TEXT,
+            created_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (content_hash) REFERENCES template_contents (content_hash),
+            UNIQUE(template_id, version)
+        )
+    ''')
+    
+    # 使用记录中保存所应用的模板版本
+    cursor.execute("PRAGMA table_info(template_usage)")
+    columns = [col[1] for col in cursor.fetchall()]
+    if 'template_version' not in columns:
+        cursor.execute("ALTER TABLE template_usage ADD COLUMN template_version INTEGER")
+    
+    # 模板使用统计汇总表（由 rollup_template_usage 从 template_usage 增量维护）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS template_usage_totals (
+            template_id TEXT PRIMARY KEY,
+            use_count INTEGER NOT NULL DEFAULT 0,
+            last_used_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS template_usage_daily (
+            template_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            use_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (template_id, day)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS template_usage_by_user (
+            template_id TEXT NOT NULL,
+            used_by INTEGER NOT NULL,
+            use_count INTEGER NOT NULL DEFAULT 0,
+            last_used_at TIMESTAMP,
+            PRIMARY KEY (template_id, used_by)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_template_usage_daily_day ON template_usage_daily (day)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_template_usage_by_user_user ON template_usage_by_user (used_by, last_used_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_template_usage_template ON template_usage (template_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_template_versions_hash ON template_versions (content_hash)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_template_favorites_user ON template_favorites (user_id, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_templates_created_by ON templates (created_by)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_templates_category ON templates (category, is_public)")
+    
+    # 模板标签索引表（templates.tags 的规范化副本，用于服务端按标签过滤和统计）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS template_tags (
+            template_id TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            PRIMARY KEY (template_id, tag)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_template_tags_tag ON template_tags (tag, template_id)")
+    # 补齐已有模板的标签
+    cursor.execute('''
+        INSERT OR IGNORE INTO template_tags (template_id, tag)
+        SELECT t.template_id, j.value FROM templates t, json_each(t.tags) j
+        WHERE json_valid(t.tags) AND json_type(t.tags) = 'array' AND j.type = 'text'
+    ''')
+    # 补齐上次运行之后尚未汇总的使用记录
+    rollup_template_usage(cursor)
+    
+    # 为还没有快照的模板补建当前版本的快照
+    cursor.execute('''
+        SELECT t.template_id, t.created_by FROM templates t
+        WHERE NOT EXISTS (
+            SELECT 1 FROM template_versions v
+            WHERE v.template_id = t.template_id AND v.version = t.version
+        )
+    ''')
+    for template_id, created_by in cursor.fetchall():
+        snapshot_template_version(cursor, template_id, created_by)
+
+    # 评论表与活动流表（此前仅在首次访问时按需创建）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS comments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            request_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            attachments TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (request_id) REFERENCES requests (request_id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS activities (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            request_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            activity_type TEXT NOT NULL,
+            description TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (request_id) REFERENCES requests (request_id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute("PRAGMA table_info(comments)")
+    columns = [col[1] for col in cursor.fetchall()]
+    if 'attachments' not in columns:
+        cursor.execute("ALTER TABLE comments ADD COLUMN attachments TEXT")
+
+    # 上传文件表（此前在首次上传时创建）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS files (
+            id TEXT PRIMARY KEY,
+            filename TEXT,
+            file_path TEXT,
+            file_size INTEGER,
+            user_id INTEGER,
+            upload_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute("PRAGMA table_info(files)")
+    columns = [col[1] for col in cursor.fetchall()]
+    if 'original_name' not in columns:
+        cursor.execute("ALTER TABLE files ADD COLUMN original_name TEXT")
+
+    # 配置补丁历史表（JSON Patch / Merge Patch）
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS template_favorites (
+        CREATE TABLE IF NOT EXISTS request_config_history (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            template_id TEXT NOT NULL,
+            request_id TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            patch_format TEXT NOT NULL,
+            patch TEXT NOT NULL,
             user_id INTEGER NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (template_id) REFERENCES templates (template_id),
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            UNIQUE(template_id, user_id)
+            FOREIGN KEY (request_id) REFERENCES requests (request_id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
+
+    # 详情页按 request_id 读取评论和活动，需要索引
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_comments_request ON comments (request_id, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_activities_request ON activities (request_id, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_config_history_request ON request_config_history (request_id, version)")
     
+    # 恢复令牌吊销表
+    load_token_revocations(cursor)
+
     conn.commit()
     conn.close()
 
+@app.on_event("startup")
+def init_database_on_startup():
+    """
+    每个工作进程启动时执行（uvicorn --workers 和 gunicorn 的工作进程都会重新导入本模块）：
+    确保表结构存在，并从数据库恢复本进程的令牌吊销表
+    在事件总线启动之后执行，两者之间发布的吊销事件不会遗漏
+    """
+    init_database()
+
 # 权限管理函数
 def get_user_role(email: str, db_role: str = None) -> str:
     """
@@ -375,98 +2464,106 @@ def is_rakwireless_user(email: str) -> bool:
         return False
     return email.lower().endswith("@rakwireless.com")
 
+# ETag / 乐观并发控制
+def make_etag(resource_id: str, version) -> str:
+    """根据资源ID和行版本号生成ETag"""
+    return f'"{resource_id}-v{version or 1}"'
+
+def etag_matches(header_value: Optional[str], etag: str) -> bool:
+    """判断 If-Match / If-None-Match 头是否匹配ETag（支持 * 和多个值，忽略弱校验前缀）"""
+    if not header_value:
+        return False
+    for candidate in header_value.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+def user_from_claims(payload: dict) -> Optional[dict]:
+    """
+    从访问令牌的声明构造当前用户（不查询数据库）
+    缺少用户版本（uv）或会话（sid）的令牌无法做吊销检查，返回 None
+    """
+    if payload.get("typ") != "access" or any(claim not in payload for claim in ("uid", "role", "uv", "sid")):
+        return None
+    if is_token_revoked(payload["uid"], payload["uv"], payload["sid"]):
+        raise HTTPException(status_code=401, detail="Token revoked")
+    user_role = get_user_role(payload["sub"], payload["role"])
+    return {
+        "id": payload["uid"],
+        "email": payload["sub"],
+        "name": payload.get("name"),
+        "role": user_role,
+        "is_rakwireless": is_rakwireless(user_role),
+        "session_id": payload["sid"]
+    }
+
 def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """获取当前用户"""
+    """获取当前用户（携带声明的访问令牌直接使用声明，不访问数据库）"""
     try:
-        print(f"=== JWT Token Verification ===")
-        print(f"Token: {credentials.credentials[:50]}...")
-        print(f"Token length: {len(credentials.credentials)}")
-        print(f"JWT Secret: {JWT_SECRET}")
-        print(f"JWT Algorithm: {JWT_ALGORITHM}")
-        
-        # 验证JWT token
         payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        print(f"Decoded payload: {payload}")
-        
-        email: str = payload.get("sub")
-        if email is None:
-            print("❌ No 'sub' field in token")
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        print(f"✅ Token verified for email: {email}")
-        
-        # 从数据库获取用户信息
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, email, name, role FROM users WHERE email = ?", (email,))
-        user = cursor.fetchone()
-        conn.close()
-        
-        if not user:
-            print(f"❌ User not found in database: {email}")
-            raise HTTPException(status_code=401, detail="User not found")
-        
-        print(f"✅ User found: {user}")
-        user_dict = {
-            "id": user[0],
-            "email": user[1], 
-            "name": user[2],
-            "role": user[3] if len(user) > 3 else None  # 兼容旧数据
-        }
-        # 获取用户角色（优先使用数据库值，否则基于邮箱判断）
-        user_role = get_user_role(user[1], user_dict.get("role"))
-        user_dict["role"] = user_role
-        
-        # 向后兼容：保留 is_rakwireless 标识
-        user_dict["is_rakwireless"] = is_rakwireless(user_role)
-        return user_dict
+        if payload.get("typ") == "refresh":
+            raise HTTPException(status_code=401, detail="Refresh token cannot be used for API access")
+        claims_user = user_from_claims(payload)
+        if claims_user is not None:
+            return claims_user
+    except HTTPException:
+        raise
     except jwt.ExpiredSignatureError:
-        print("❌ Token expired")
         raise HTTPException(status_code=401, detail="Token expired")
-    except jwt.InvalidTokenError as e:
-        print(f"❌ Invalid token: {e}")
+    except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
-    except Exception as e:
-        print(f"❌ Unexpected error: {e}")
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=401, detail="Authentication failed")
+    
+    # 旧格式令牌（只有 sub，或缺少 uv / sid）无法检查吊销，一律拒绝，需要重新登录
+    raise HTTPException(status_code=401, detail="Invalid token")
 
 @app.post("/api/auth/login")
 async def login(user_data: UserLogin):
     """用户登录"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
         # 查找用户
-        cursor.execute("SELECT id, email, password_hash, name FROM users WHERE email = ?", (user_data.email,))
+        cursor.execute('''
+            SELECT id, email, password_hash, name, role, COALESCE(token_version, 1), is_active
+            FROM users WHERE email = ?
+        ''', (user_data.email,))
         user = cursor.fetchone()
         
-        if not user:
+        # 验证密码（用户不存在时同样计算一次哈希）
+        print(f"Login attempt: email={user_data.email}")
+        verified, new_hash = await verify_password_async(user_data.password, user[2] if user else None)
+        if not user or not verified:
             raise HTTPException(status_code=401, detail="Invalid credentials")
         
-        user_id, email, password_hash, name = user
+        user_id, email, password_hash, name, role, token_version, is_active = user
         
-        # 验证密码
-        print(f"Login attempt: email={user_data.email}")
-        print(f"Stored hash: {password_hash}")
-        print(f"Input password: {user_data.password}")
-        print(f"Input hash: {get_password_hash(user_data.password)}")
-        print(f"Password match: {verify_password(user_data.password, password_hash)}")
+        if is_active == 0:
+            raise HTTPException(status_code=403, detail="User is deactivated")
         
-        if not verify_password(user_data.password, password_hash):
-            raise HTTPException(status_code=401, detail="Invalid credentials")
+        # 旧格式或成本参数过时的哈希，登录成功后用当前算法重新哈希
+        if new_hash:
+            cursor.execute("UPDATE users SET password_hash = ? WHERE id = ?", (new_hash, user_id))
+            print(f"🔐 Rehashed password for {email} with {pwd_context.default_scheme()}")
         
-        # 创建JWT令牌
-        access_token = create_access_token(data={"sub": email})
+        # 每次登录一个会话，登出只结束这个会话
+        session_id, refresh_jti = create_session(cursor, user_id)
+        conn.commit()
         
         # 如果name为空，使用邮箱的用户名部分（@之前的部分）作为默认显示名称
         display_name = name if name and name.strip() else email.split('@')[0] if email else "User"
         
+        # 创建JWT令牌（访问令牌携带用户声明，后续请求不再查询用户表）
+        tokens = issue_tokens(user_id, email, display_name, get_user_role(email, role), token_version,
+                              session_id, refresh_jti)
+        
         return {
-            "access_token": access_token,
-            "token_type": "bearer",
+            **tokens,
             "user": {
                 "id": user_id,
                 "email": email,
@@ -480,10 +2577,88 @@ async def login(user_data: UserLogin):
     finally:
         conn.close()
 
+class TokenRefresh(BaseModel):
+    refresh_token: str
+
+@app.post("/api/auth/refresh")
+async def refresh_token(token_data: TokenRefresh):
+    """
+    用刷新令牌换取新的访问令牌（同时轮换刷新令牌）
+    每个会话只有最近一次签发的刷新令牌有效；旧的刷新令牌再次出现说明已泄露，整个会话随之吊销
+    """
+    try:
+        payload = jwt.decode(token_data.refresh_token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Refresh token expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    if payload.get("typ") != "refresh" or any(claim not in payload for claim in ("uid", "uv", "sid", "jti")):
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        # 刷新时重新读取用户，角色和显示名称以数据库为准
+        cursor.execute('''
+            SELECT id, email, name, role, COALESCE(token_version, 1), is_active
+            FROM users WHERE id = ?
+        ''', (payload["uid"],))
+        user = cursor.fetchone()
+        if not user or user[5] == 0:
+            raise HTTPException(status_code=401, detail="User not found or deactivated")
+        if payload["uv"] != user[4]:
+            raise HTTPException(status_code=401, detail="Token revoked")
+        
+        # 轮换：只有携带会话当前 jti 的刷新令牌才能换取新令牌
+        session_id, refresh_jti = payload["sid"], uuid.uuid4().hex
+        cursor.execute('''
+            UPDATE auth_sessions SET refresh_jti = ?, expires_at = ?
+            WHERE session_id = ? AND user_id = ? AND refresh_jti = ? AND revoked_at IS NULL AND expires_at > ?
+        ''', (refresh_jti, time.time() + REFRESH_TOKEN_EXPIRE_DAYS * 86400,
+              session_id, payload["uid"], payload["jti"], time.time()))
+        if cursor.rowcount == 0:
+            cursor.execute("SELECT revoked_at FROM auth_sessions WHERE session_id = ? AND user_id = ?",
+                           (session_id, payload["uid"]))
+            session = cursor.fetchone()
+            if session and session[0] is None:
+                revoke_session(cursor, session_id)
+                conn.commit()
+                print(f"⚠️ Refresh token reuse detected, session {session_id} revoked")
+                raise HTTPException(status_code=401, detail="Refresh token reused")
+            raise HTTPException(status_code=401, detail="Session expired or revoked")
+        conn.commit()
+        
+        user_id, email, name, role, token_version, _ = user
+        display_name = name if name and name.strip() else email.split('@')[0]
+        return issue_tokens(user_id, email, display_name, get_user_role(email, role), token_version,
+                            session_id, refresh_jti)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
+@app.post("/api/auth/logout")
+async def logout(current_user: dict = Depends(get_current_user)):
+    """登出：只结束当前会话（其刷新令牌和访问令牌失效），其他设备保持登录"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        revoke_session(cursor, current_user["session_id"])
+        conn.commit()
+        return {"message": "Logged out"}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
 @app.post("/api/auth/register")
 async def register(user_data: UserCreate):
     """用户注册"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -493,7 +2668,7 @@ async def register(user_data: UserCreate):
             raise HTTPException(status_code=400, detail="Email already registered")
         
         # 创建新用户
-        password_hash = get_password_hash(user_data.password)
+        password_hash = await get_password_hash_async(user_data.password)
         # 自动设置角色：@rakwireless.com 邮箱自动设置为 'rakwireless'
         auto_role = get_user_role(user_data.email)
         cursor.execute('''
@@ -502,6 +2677,7 @@ async def register(user_data: UserCreate):
         ''', (user_data.email, password_hash, user_data.name, auto_role))
         
         conn.commit()
+        invalidate_responses("users")
         return {"message": "User created successfully"}
     except HTTPException:
         raise
@@ -518,7 +2694,13 @@ async def get_users(current_user: dict = Depends(get_current_user)):
     if not is_rakwireless(user_role):
         raise HTTPException(status_code=403, detail="Only RAK Wireless employees can access user list")
     
-    conn = sqlite3.connect(DB_FILE)
+    # 只有 RAK Wireless 和 Admin 可以访问，所有调用者看到相同的列表
+    cached = response_cache.get("get_users", "*")
+    if cached is not None:
+        return cached
+    since = response_cache.clock
+    
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -539,6 +2721,7 @@ async def get_users(current_user: dict = Depends(get_current_user)):
                 "role": role  # 添加角色信息
             })
         
+        response_cache.put("get_users", "*", users, ["users"], since)
         return users
     except Exception as e:
         print(f"❌ Error in get_users: {e}")
@@ -553,7 +2736,7 @@ async def get_requests(current_user: dict = Depends(get_current_user)):
     print(f"Current user: {current_user}")
     print(f"Is RAK Wireless user: {current_user.get('is_rakwireless', False)}")
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -599,17 +2782,18 @@ async def get_requests(current_user: dict = Depends(get_current_user)):
                 "submitTime": row[3],
                 "status": row[4],
                 "assignee": row[5],
-                "configData": json.loads(row[6]) if row[6] else {},
-                "changes": json.loads(row[7]) if row[7] else {},
-                "originalConfig": json.loads(row[8]) if row[8] else {},
-                "tags": json.loads(row[9]) if row[9] else [],
+                # 保存的 JSON 原样拼接到响应中
+                "configData": RawJSON(row[6]),
+                "changes": RawJSON(row[7]),
+                "originalConfig": RawJSON(row[8]),
+                "tags": RawJSON(row[9], "[]"),
                 "creatorEmail": row[10]  # 添加创建者邮箱
             })
         
         print(f"Found {len(requests)} requests")
         for req in requests:
             print(f"Request {req['id']}: creator_email = {req.get('creatorEmail', 'NOT_FOUND')}")
-        return requests
+        return json_response(requests)
     except Exception as e:
         print(f"❌ Error in get_requests: {e}")
         print(f"Error type: {type(e)}")
@@ -620,30 +2804,54 @@ async def get_requests(current_user: dict = Depends(get_current_user)):
         conn.close()
 
 @app.get("/api/requests/{request_id}")
-async def get_request(request_id: str, current_user: dict = Depends(get_current_user)):
-    """获取特定请求 - 检查访问权限"""
+async def get_request(
+    request_id: str,
+    if_none_match: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """获取特定请求 - 检查访问权限（支持 If-None-Match 条件请求）"""
     print(f"=== GET REQUEST ===")
     print(f"Request ID: {request_id}")
     print(f"Current user: {current_user}")
     print(f"Is RAK Wireless user: {current_user.get('is_rakwireless', False)}")
     
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute('''
-            SELECT r.request_id, r.company_name, r.rak_id, r.submit_time, r.status, r.assignee, r.config_data, r.changes, r.original_config, r.tags, u.email as creator_email, r.user_id
-            FROM requests r
-            LEFT JOIN users u ON r.user_id = u.id
-            WHERE r.request_id = ?
-        ''', (request_id,))
-        
-        row = cursor.fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Request not found")
+        # 结果与调用者无关，按 request_id 缓存，权限检查使用缓存中的创建者
+        cached = response_cache.get("get_request", request_id)
+        if cached is None:
+            since = response_cache.clock
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT r.request_id, r.company_name, r.rak_id, r.submit_time, r.status, r.assignee, r.config_data, r.changes, r.original_config, r.tags, u.email as creator_email, r.user_id, r.version
+                    FROM requests r
+                    LEFT JOIN users u ON r.user_id = u.id
+                    WHERE r.request_id = ?
+                ''', (request_id,))
+                row = cursor.fetchone()
+            finally:
+                conn.close()
+            if not row:
+                raise HTTPException(status_code=404, detail="Request not found")
+            cached = (row[11], {
+                "id": row[0],
+                "companyName": row[1],
+                "rakId": row[2],
+                "submitTime": row[3],
+                "status": row[4],
+                "assignee": row[5],
+                "configData": RawJSON(row[6]),
+                "changes": RawJSON(row[7]),
+                "originalConfig": RawJSON(row[8]),
+                "tags": RawJSON(row[9], "[]"),
+                "creatorEmail": row[10],
+                "version": row[12] or 1
+            })
+            response_cache.put("get_request", request_id, cached, [f"request:{request_id}"], since)
+        creator_user_id, result = cached
         
         # 权限检查：非 rakwireless/admin 用户只能访问自己创建的请求
-        creator_user_id = row[11]  # user_id
         user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
         
         if not can_view_all(user_role) and creator_user_id != current_user["id"]:
@@ -652,27 +2860,157 @@ async def get_request(request_id: str, current_user: dict = Depends(get_current_
         
         print(f"✅ Permission granted for request {request_id}")
         
-        # 调试：检查返回的数据
-        config_data = json.loads(row[6]) if row[6] else {}
-        print(f"Config Data Keys: {list(config_data.keys()) if config_data else 'None'}")
-        print(f"Config Data Sample: {str(config_data)[:200]}...")
+        # 客户端缓存的版本仍然有效时返回 304
+        etag = make_etag(result["id"], result["version"])
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
         
-        return {
-            "id": row[0],
-            "companyName": row[1],
-            "rakId": row[2],
-            "submitTime": row[3],
-            "status": row[4],
-            "assignee": row[5],
-            "configData": config_data,
-            "changes": json.loads(row[7]) if row[7] else {},
-            "originalConfig": json.loads(row[8]) if row[8] else {},
-            "tags": json.loads(row[9]) if row[9] else [],
-            "creatorEmail": row[10]
-        }
+        return json_response(result, headers={"ETag": etag})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 详情页聚合接口可选择的字段
+BUNDLE_FIELDS = ("request", "diff", "comments", "activities", "users")
+
+def summarize_changes(changes: dict) -> dict:
+    """根据 changes 生成差异摘要（字段数量和字段名列表）"""
+    fields = []
+    for field, change in (changes or {}).items():
+        name = change.get("fieldName", field) if isinstance(change, dict) else field
+        fields.append({"field": field, "fieldName": name})
+    return {"count": len(fields), "fields": fields}
+
+@app.get("/api/requests/{request_id}/bundle")
+async def get_request_bundle(
+    request_id: str,
+    fields: Optional[str] = None,
+    comments_limit: int = 50,
+    activities_limit: int = 50,
+    current_user: dict = Depends(get_current_user)
+):
+    """获取请求详情页所需的全部数据（请求、差异摘要、评论、活动、可分配用户），一次读事务完成"""
+    print(f"=== GET REQUEST BUNDLE ===")
+    print(f"Request ID: {request_id}, Fields: {fields}")
+
+    if fields:
+        selected = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = [f for f in selected if f not in BUNDLE_FIELDS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown bundle fields: {', '.join(unknown)}")
+    else:
+        selected = list(BUNDLE_FIELDS)
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    try:
+        # 在同一个读事务中读取，保证各部分数据是一致的快照
+        cursor.execute("BEGIN")
+
+        cursor.execute('''
+            SELECT r.request_id, r.company_name, r.rak_id, r.submit_time, r.status, r.assignee, r.config_data, r.changes, r.original_config, r.tags, u.email as creator_email, r.user_id, r.version
+            FROM requests r
+            LEFT JOIN users u ON r.user_id = u.id
+            WHERE r.request_id = ?
+        ''', (request_id,))
+
+        row = cursor.fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="Request not found")
+
+        # 权限检查与 get_request 一致
+        user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
+        if not can_view_all(user_role) and row[11] != current_user["id"]:
+            raise HTTPException(status_code=403, detail="You don't have permission to access this request")
+
+        bundle = {"id": row[0]}
+        changes = json.loads(row[7]) if row[7] else {}
+
+        if "request" in selected:
+            bundle["request"] = {
+                "id": row[0],
+                "companyName": row[1],
+                "rakId": row[2],
+                "submitTime": row[3],
+                "status": row[4],
+                "assignee": row[5],
+                "configData": RawJSON(row[6]),
+                "changes": RawJSON(row[7]),
+                "originalConfig": RawJSON(row[8]),
+                "tags": RawJSON(row[9], "[]"),
+                "creatorEmail": row[10],
+                "version": row[12] or 1
+            }
+
+        if "diff" in selected:
+            bundle["diff"] = summarize_changes(changes)
+
+        if "comments" in selected:
+            # 取最近的N条评论，再按时间正序返回（与 get_comments 顺序一致）
+            cursor.execute('''
+                SELECT c.id, c.content, c.attachments, c.created_at, u.name, u.email
+                FROM comments c
+                JOIN users u ON c.user_id = u.id
+                WHERE c.request_id = ?
+                ORDER BY c.created_at DESC, c.id DESC
+                LIMIT ?
+            ''', (request_id, comments_limit))
+            comments = []
+            for c_row in reversed(cursor.fetchall()):
+                try:
+                    attachments = json.loads(c_row[2]) if c_row[2] else []
+                except ValueError:
+                    attachments = []
+                comments.append({
+                    "id": c_row[0],
+                    "content": c_row[1],
+                    "attachments": attachments,
+                    "createdAt": c_row[3],
+                    "authorName": c_row[4] or "Unknown User",
+                    "authorEmail": c_row[5] or "unknown@example.com"
+                })
+            bundle["comments"] = comments
+
+        if "activities" in selected:
+            cursor.execute('''
+                SELECT a.id, a.activity_type, a.description, a.created_at, u.name, u.email
+                FROM activities a
+                JOIN users u ON a.user_id = u.id
+                WHERE a.request_id = ?
+                ORDER BY a.created_at DESC, a.id DESC
+                LIMIT ?
+            ''', (request_id, activities_limit))
+            bundle["activities"] = [{
+                "id": a_row[0],
+                "activityType": a_row[1],
+                "description": a_row[2],
+                "createdAt": a_row[3],
+                "authorName": a_row[4] or "Unknown User",
+                "authorEmail": a_row[5] or "unknown@example.com"
+            } for a_row in cursor.fetchall()]
+
+        # 可分配用户列表仅对 RAK Wireless 和 Admin 可见（与 /api/users 一致）
+        if "users" in selected and is_rakwireless(user_role):
+            cursor.execute('''
+                SELECT id, email, name, role FROM users
+                WHERE is_active = 1
+                ORDER BY email ASC
+            ''')
+            bundle["users"] = [{
+                "id": u_row[0],
+                "email": u_row[1],
+                "name": u_row[2] if u_row[2] else u_row[1].split('@')[0],
+                "role": u_row[3] if u_row[3] else get_user_role(u_row[1])
+            } for u_row in cursor.fetchall()]
+
+        conn.commit()
+        return json_response(bundle)
     except HTTPException:
         raise
     except Exception as e:
+        print(f"❌ Error in get_request_bundle: {e}")
         raise HTTPException(status_code=500, detail=str(e))
     finally:
         conn.close()
@@ -680,9 +3018,7 @@ async def get_request(request_id: str, current_user: dict = Depends(get_current_
 @app.post("/api/requests")
 async def create_request(request_data: RequestCreate, current_user: dict = Depends(get_current_user)):
     """创建新请求"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
+    check_config_data(request_data.configData)
     try:
         request_id = f"REQ{str(uuid.uuid4())[:6].upper()}"
         submit_time = datetime.now().isoformat()
@@ -698,49 +3034,42 @@ async def create_request(request_data: RequestCreate, current_user: dict = Depen
         # 处理tags
         tags_json = json.dumps(request_data.tags if request_data.tags else [])
         
-        # 使用事务：如果后续步骤失败，回滚整个操作
-        cursor.execute('''
-            INSERT INTO requests (request_id, company_name, rak_id, submit_time, status, assignee, config_data, changes, original_config, tags, user_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            request_id,
-            request_data.companyName,
-            request_data.rakId,
-            submit_time,
-            "Open",
-            "",
-            json.dumps(request_data.configData),
-            json.dumps(request_data.changes),
-            json.dumps(request_data.originalConfig),
-            tags_json,
-            current_user["id"]
-        ))
-        
-        # 创建初始活动记录（记录创建者信息）
-        # 如果活动记录创建失败，不影响主请求的创建
-        try:
-            creator_name = current_user.get("name") or current_user.get("email", "Unknown")
+        # 请求和初始活动记录作为一个工作单元：如果插入失败，整个单元回滚
+        def insert_request(cursor):
             cursor.execute('''
-                INSERT INTO activities (request_id, user_id, activity_type, description)
-                VALUES (?, ?, ?, ?)
-            ''', (request_id, current_user["id"], "created", 
-                  f"Request created by {creator_name} for {request_data.companyName}"))
-        except Exception as activity_error:
-            # 活动记录创建失败不影响主请求，只记录日志
-            print(f"⚠️ Warning: Failed to create activity record: {str(activity_error)}")
-        
-        # 一次性提交所有更改
-        conn.commit()
+                INSERT INTO requests (request_id, company_name, rak_id, submit_time, status, assignee, config_data, changes, original_config, tags, user_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                request_id,
+                request_data.companyName,
+                request_data.rakId,
+                submit_time,
+                "Open",
+                "",
+                json.dumps(request_data.configData),
+                json.dumps(request_data.changes),
+                json.dumps(request_data.originalConfig),
+                tags_json,
+                current_user["id"]
+            ))
+            
+            # 创建初始活动记录（记录创建者信息）
+            # 如果活动记录创建失败，不影响主请求的创建
+            try:
+                creator_name = current_user.get("name") or current_user.get("email", "Unknown")
+                insert_activities(cursor, [(request_id, current_user["id"], "created",
+                                            f"Request created by {creator_name} for {request_data.companyName}")])
+            except Exception as activity_error:
+                # 活动记录创建失败不影响主请求，只记录日志
+                print(f"⚠️ Warning: Failed to create activity record: {str(activity_error)}")
+        
+        await activity_writer.run(insert_request)
         
         print(f"✅ Request created successfully: {request_id}")
         return {"message": "Request created successfully", "request_id": request_id}
     except Exception as e:
-        # 如果出错，回滚事务
-        conn.rollback()
         print(f"❌ Error creating request: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        conn.close()
 
 @app.delete("/api/requests/{request_id}")
 async def delete_request(request_id: str, current_user: dict = Depends(get_current_user)):
@@ -750,7 +3079,7 @@ async def delete_request(request_id: str, current_user: dict = Depends(get_curre
     print(f"Current User: {current_user}")
     print(f"Is RAK Wireless user: {current_user.get('is_rakwireless', False)}")
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -785,6 +3114,7 @@ async def delete_request(request_id: str, current_user: dict = Depends(get_curre
         # 删除请求
         cursor.execute("DELETE FROM requests WHERE request_id = ?", (request_id,))
         conn.commit()
+        invalidate_responses(f"request:{request_id}")
         
         return {"message": "Request deleted successfully"}
     except HTTPException:
@@ -794,16 +3124,65 @@ async def delete_request(request_id: str, current_user: dict = Depends(get_curre
     finally:
         conn.close()
 
+def normalize_assignee(value) -> str:
+    """规范化 assignee 值（None、空字符串、前后空格）"""
+    return value.strip() if value and isinstance(value, str) else (value or "")
+
+def resolve_user_names(cursor, emails) -> dict:
+    """一次查询解析邮箱对应的显示名称（name 为空时使用 email）"""
+    emails = sorted({e.strip() for e in emails if e and isinstance(e, str) and e.strip()})
+    if not emails:
+        return {}
+    placeholders = ",".join(["?" for _ in emails])
+    cursor.execute(f"SELECT email, name FROM users WHERE email IN ({placeholders})", emails)
+    return {row[0]: row[1] or row[0] for row in cursor.fetchall()}
+
+def build_update_activities(request_id, current_user, request_data, old_status, old_assignee, user_names) -> list:
+    """根据请求更新前后的 status/assignee 生成活动记录行"""
+    rows = []
+    operator_name = current_user.get("name") or current_user.get("email", "Unknown")
+    
+    # 记录status变化
+    if "status" in request_data and request_data["status"] != old_status:
+        new_status = request_data["status"]
+        rows.append((request_id, current_user["id"], "status_changed",
+                     f"{operator_name} updated workflow process of request {request_id} from '{old_status}' to '{new_status}'"))
+    
+    # 记录assignee变化（处理None和空字符串的情况）
+    if "assignee" in request_data:
+        new_assignee = normalize_assignee(request_data.get("assignee"))
+        old_assignee_value = normalize_assignee(old_assignee)
+        if new_assignee != old_assignee_value:
+            if new_assignee:
+                assignee_name = user_names.get(new_assignee, new_assignee)
+                rows.append((request_id, current_user["id"], "assigned",
+                             f"{operator_name} assigned request {request_id} to {assignee_name}"))
+            else:
+                # 取消分配 - 需要记录被取消分配的用户
+                if old_assignee:
+                    unassignee_name = user_names.get(old_assignee.strip(), old_assignee)
+                    description = f"{operator_name} unassigned request {request_id} from {unassignee_name}"
+                else:
+                    description = f"{operator_name} unassigned this request"
+                rows.append((request_id, current_user["id"], "unassigned", description))
+    return rows
+
 @app.put("/api/requests/{request_id}")
-async def update_request(request_id: str, request_data: dict, current_user: dict = Depends(get_current_user)):
-    """更新请求状态或分配人 - 检查编辑权限"""
+async def update_request(
+    request_id: str,
+    request_data: dict,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """更新请求状态或分配人 - 检查编辑权限（支持 If-Match 乐观并发控制）"""
     print(f"=== UPDATE REQUEST ===")
     print(f"Request ID: {request_id}")
     print(f"Current User: {current_user}")
     print(f"Is RAK Wireless user: {current_user.get('is_rakwireless', False)}")
     print(f"Request Data: {request_data}")
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -856,6 +3235,7 @@ async def update_request(request_id: str, request_data: dict, current_user: dict
             update_values.append(request_data["rakId"])
         
         if "configData" in request_data:
+            check_config_data(request_data["configData"])
             update_fields.append("config_data = ?")
             update_values.append(json.dumps(request_data["configData"]))
         
@@ -867,121 +3247,381 @@ async def update_request(request_id: str, request_data: dict, current_user: dict
             update_fields.append("original_config = ?")
             update_values.append(json.dumps(request_data["originalConfig"]))
         
-        if "tags" in request_data:
-            update_fields.append("tags = ?")
-            update_values.append(json.dumps(request_data["tags"]))
+        if "tags" in request_data:
+            update_fields.append("tags = ?")
+            update_values.append(json.dumps(request_data["tags"]))
+        
+        if not update_fields:
+            raise HTTPException(status_code=400, detail="No fields to update")
+        
+        # 释放读连接，写操作交给写入合并器
+        conn.close()
+        
+        def apply_update(cursor):
+            # 获取当前请求的旧值（用于记录history）- 与UPDATE在同一事务中读取
+            cursor.execute("SELECT status, assignee, version FROM requests WHERE request_id = ?", (request_id,))
+            old_row = cursor.fetchone()
+            if not old_row:
+                raise HTTPException(status_code=404, detail="Request not found")
+            old_status, old_assignee, old_version = old_row
+            print(f"📝 Old values - Status: {old_status}, Assignee: {old_assignee}, Version: {old_version}")
+            
+            # 客户端基于旧版本修改时拒绝写入，避免覆盖他人的修改
+            if if_match and not etag_matches(if_match, make_etag(request_id, old_version)):
+                raise HTTPException(status_code=412, detail="Request has been modified by someone else")
+            
+            cursor.execute(f"""
+                UPDATE requests 
+                SET {', '.join(update_fields)}, version = COALESCE(version, 1) + 1
+                WHERE request_id = ?
+            """, update_values + [request_id])
+            
+            # 自动记录history到activities表（与主更新同一个工作单元，保证原子性）
+            user_names = resolve_user_names(cursor, [request_data.get("assignee"), old_assignee])
+            insert_activities(cursor, build_update_activities(
+                request_id, current_user, request_data, old_status, old_assignee, user_names
+            ))
+            return (old_version or 1) + 1
+        
+        new_version = await activity_writer.run(apply_update)
+        invalidate_responses(f"request:{request_id}")
+        response.headers["ETag"] = make_etag(request_id, new_version)
+        
+        print(f"✅ Request {request_id} updated successfully")
+        return {"message": "Request updated successfully", "version": new_version}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
+# ==================== Config Patch (RFC 6902 / RFC 7396) ====================
+
+JSON_PATCH_MEDIA_TYPE = "application/json-patch+json"
+MERGE_PATCH_MEDIA_TYPE = "application/merge-patch+json"
+
+class PatchError(ValueError):
+    """补丁无法应用（路径不存在、格式错误等）"""
+
+class PatchTestFailed(PatchError):
+    """JSON Patch 的 test 操作不通过"""
+
+_MISSING = object()
+
+def parse_json_pointer(pointer: str) -> list:
+    """解析 RFC 6901 JSON Pointer 为路径片段列表"""
+    if pointer == "":
+        return []
+    if not isinstance(pointer, str) or not pointer.startswith("/"):
+        raise PatchError(f"Invalid JSON pointer: {pointer}")
+    return [part.replace("~1", "/").replace("~0", "~") for part in pointer[1:].split("/")]
+
+def _pointer_parent(doc, parts: list):
+    """返回路径的父容器和最后一个片段"""
+    if not parts:
+        raise PatchError("Operation on document root is not supported")
+    node = doc
+    for part in parts[:-1]:
+        if isinstance(node, dict) and part in node:
+            node = node[part]
+        elif isinstance(node, list) and part.isdigit() and int(part) < len(node):
+            node = node[int(part)]
+        else:
+            raise PatchError(f"Path not found: /{'/'.join(parts)}")
+    return node, parts[-1]
+
+def _pointer_get(doc, parts: list):
+    node = doc
+    for part in parts:
+        if isinstance(node, dict) and part in node:
+            node = node[part]
+        elif isinstance(node, list) and part.isdigit() and int(part) < len(node):
+            node = node[int(part)]
+        else:
+            return _MISSING
+    return node
+
+def _patch_add(doc, parts, value):
+    parent, key = _pointer_parent(doc, parts)
+    if isinstance(parent, dict):
+        parent[key] = value
+    elif isinstance(parent, list):
+        if key == "-":
+            parent.append(value)
+        elif key.isdigit() and int(key) <= len(parent):
+            parent.insert(int(key), value)
+        else:
+            raise PatchError(f"Invalid array index: {key}")
+    else:
+        raise PatchError(f"Cannot add to non-container at /{'/'.join(parts)}")
+
+def _patch_remove(doc, parts):
+    parent, key = _pointer_parent(doc, parts)
+    if isinstance(parent, dict) and key in parent:
+        return parent.pop(key)
+    if isinstance(parent, list) and key.isdigit() and int(key) < len(parent):
+        return parent.pop(int(key))
+    raise PatchError(f"Path not found: /{'/'.join(parts)}")
+
+def apply_json_patch(doc: dict, operations: list):
+    """
+    按 RFC 6902 原地应用 JSON Patch
+    返回 (文档, 被修改的路径列表)
+    """
+    if not isinstance(operations, list):
+        raise PatchError("JSON Patch must be an array of operations")
+    touched = []
+    for op in operations:
+        if not isinstance(op, dict) or "op" not in op or "path" not in op:
+            raise PatchError(f"Invalid patch operation: {op}")
+        name = op["op"]
+        parts = parse_json_pointer(op["path"])
+        if name in ("add", "replace", "test") and "value" not in op:
+            raise PatchError(f"Operation '{name}' requires a value")
+        if name == "add":
+            _patch_add(doc, parts, copy.deepcopy(op["value"]))
+        elif name == "remove":
+            _patch_remove(doc, parts)
+        elif name == "replace":
+            _patch_remove(doc, parts)
+            _patch_add(doc, parts, copy.deepcopy(op["value"]))
+        elif name in ("move", "copy"):
+            source = parse_json_pointer(op.get("from", ""))
+            if name == "move":
+                if parts[:len(source)] == source and len(parts) > len(source):
+                    raise PatchError("Cannot move a value into one of its children")
+                value = _patch_remove(doc, source)
+                touched.append(source)
+            else:
+                value = _pointer_get(doc, source)
+                if value is _MISSING:
+                    raise PatchError(f"Path not found: {op.get('from')}")
+                value = copy.deepcopy(value)
+            _patch_add(doc, parts, value)
+        elif name == "test":
+            if _pointer_get(doc, parts) != op["value"]:
+                raise PatchTestFailed(f"Test failed at {op['path']}")
+            continue
+        else:
+            raise PatchError(f"Unknown patch operation: {name}")
+        if parts and parts[-1] == "-":
+            # 追加到数组末尾时记录实际下标
+            parent, _ = _pointer_parent(doc, parts)
+            parts = parts[:-1] + [str(len(parent) - 1)]
+        touched.append(parts)
+    return doc, touched
+
+def apply_merge_patch(target, patch, path=None, touched=None):
+    """
+    按 RFC 7396 应用 Merge Patch
+    返回 (文档, 被修改的路径列表)
+    """
+    path = path or []
+    touched = [] if touched is None else touched
+    if not isinstance(patch, dict):
+        touched.append(path)
+        return copy.deepcopy(patch), touched
+    if not isinstance(target, dict):
+        target = {}
+    for key, value in patch.items():
+        if value is None:
+            if key in target:
+                del target[key]
+                touched.append(path + [key])
+        elif isinstance(value, dict):
+            target[key], _ = apply_merge_patch(target.get(key), value, path + [key], touched)
+        else:
+            target[key] = copy.deepcopy(value)
+            touched.append(path + [key])
+    return target, touched
+
+def _change_display(value):
+    """changes 中的值供前端直接展示：对象和数组序列化为字符串"""
+    if value is _MISSING or value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+def update_changes_for_paths(changes: dict, original_config: dict, config_data: dict, touched: list) -> dict:
+    """
+    增量更新差异：只重新计算被补丁修改的路径
+    键为点分路径（如 lora.frequency），与原始配置相同时移除该差异
+    返回本次被修改的差异条目（None 表示该差异已移除）
+    """
+    delta = {}
+    
+    def recompute(parts):
+        key = ".".join(parts)
+        original = _pointer_get(original_config, parts)
+        current = _pointer_get(config_data, parts)
+        if original == current:
+            if changes.pop(key, None) is not None:
+                delta[key] = None
+        else:
+            changes[key] = {
+                "fieldName": key,
+                "original": _change_display(original),
+                "current": _change_display(current)
+            }
+            delta[key] = changes[key]
+    
+    for parts in touched:
+        if not parts:
+            continue
+        # 上层路径已有差异条目时（之前被整体替换过），以该条目为单位重新计算
+        for depth in range(1, len(parts)):
+            if ".".join(parts[:depth]) in changes:
+                parts = parts[:depth]
+                break
+        parent = parts[:-1]
+        original_parent = _pointer_get(original_config, parent)
+        current_parent = _pointer_get(config_data, parent)
+        if isinstance(original_parent, list) or isinstance(current_parent, list):
+            # 数组元素的增删会移动后续元素的下标：该数组下的差异全部按新下标重新计算
+            key = ".".join(parent)
+            for stale in [k for k in changes if k == key or k.startswith(key + ".")]:
+                del changes[stale]
+                delta[stale] = None
+            lengths = [len(value) for value in (original_parent, current_parent) if isinstance(value, list)]
+            for index in range(max(lengths)):
+                recompute(parent + [str(index)])
+            continue
+        key = ".".join(parts)
+        # 父路径被整体替换时，清理其下层的旧差异
+        for stale in [k for k in changes if k.startswith(key + ".")]:
+            del changes[stale]
+            delta[stale] = None
+        recompute(parts)
+    return delta
+
+@app.patch("/api/requests/{request_id}/config")
+async def patch_request_config(
+    request_id: str,
+    http_request: Request,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    局部修改请求配置
+    Content-Type: application/json-patch+json（RFC 6902）或 application/merge-patch+json（RFC 7396）
+    """
+    print(f"=== PATCH REQUEST CONFIG ===")
+    print(f"Request ID: {request_id}")
+    
+    content_type = (http_request.headers.get("content-type") or "").split(";")[0].strip().lower()
+    try:
+        patch = json.loads(await http_request.body() or b"null")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Patch body is not valid JSON")
+    
+    # application/json 时根据内容判断：数组为 JSON Patch，对象为 Merge Patch
+    if content_type == JSON_PATCH_MEDIA_TYPE or (content_type == "application/json" and isinstance(patch, list)):
+        patch_format = "json-patch"
+    elif content_type in (MERGE_PATCH_MEDIA_TYPE, "application/json"):
+        patch_format = "merge-patch"
+    else:
+        raise HTTPException(status_code=415, detail=f"Unsupported patch media type: {content_type}")
+    
+    user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
+    
+    def apply_patch(cursor):
+        cursor.execute("SELECT user_id, config_data, changes, original_config, version FROM requests WHERE request_id = ?",
+                       (request_id,))
+        row = cursor.fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="Request not found")
+        
+        # 权限检查与 update_request 一致
+        if not can_view_all(user_role) and row[0] != current_user["id"]:
+            raise HTTPException(status_code=403, detail="You can only edit your own requests")
         
-        if not update_fields:
-            raise HTTPException(status_code=400, detail="No fields to update")
+        old_version = row[4] or 1
+        if if_match and not etag_matches(if_match, make_etag(request_id, old_version)):
+            raise HTTPException(status_code=412, detail="Request has been modified by someone else")
         
-        # 获取当前请求的旧值（用于记录history）- 必须在UPDATE之前获取
-        cursor.execute("SELECT status, assignee FROM requests WHERE request_id = ?", (request_id,))
-        old_row = cursor.fetchone()
-        old_status = old_row[0] if old_row else None
-        old_assignee = old_row[1] if old_row else None
-        print(f"📝 Old values - Status: {old_status}, Assignee: {old_assignee}")
+        config_data = json.loads(row[1]) if row[1] else {}
+        changes = json.loads(row[2]) if row[2] else {}
+        original_config = json.loads(row[3]) if row[3] else {}
         
-        # 执行更新
-        update_values.append(request_id)
+        try:
+            if patch_format == "json-patch":
+                config_data, touched = apply_json_patch(config_data, patch)
+            else:
+                config_data, touched = apply_merge_patch(config_data, patch)
+        except PatchTestFailed as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except PatchError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        if not isinstance(config_data, dict):
+            raise HTTPException(status_code=422, detail="Patched configData must be an object")
+        check_config_data(config_data)
+        
+        delta = update_changes_for_paths(changes, original_config, config_data, touched)
+        new_version = old_version + 1
         
-        cursor.execute(f"""
-            UPDATE requests 
-            SET {', '.join(update_fields)}
+        cursor.execute('''
+            UPDATE requests SET config_data = ?, changes = ?, version = ?
             WHERE request_id = ?
-        """, update_values)
-        
-        conn.commit()
-        
-        # 自动记录history到activities表
-        # 确保activities表存在
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='activities'")
-        activities_table_exists = cursor.fetchone()
-        
-        if not activities_table_exists:
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS activities (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    request_id TEXT NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    activity_type TEXT NOT NULL,
-                    description TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (request_id) REFERENCES requests (request_id),
-                    FOREIGN KEY (user_id) REFERENCES users (id)
-                )
-            ''')
-            conn.commit()
-        
-        # 记录status变化
-        if "status" in request_data and request_data["status"] != old_status:
-            new_status = request_data["status"]
-            operator_name = current_user.get("name") or current_user.get("email", "Unknown")
-            cursor.execute('''
-                INSERT INTO activities (request_id, user_id, activity_type, description)
-                VALUES (?, ?, ?, ?)
-            ''', (request_id, current_user["id"], "status_changed", 
-                  f"{operator_name} updated workflow process of request {request_id} from '{old_status}' to '{new_status}'"))
+        ''', (json.dumps(config_data), json.dumps(changes), new_version, request_id))
         
-        # 记录assignee变化
-        if "assignee" in request_data:
-            # 获取新值（处理None、空字符串等情况）
-            new_assignee_raw = request_data.get("assignee")
-            new_assignee = new_assignee_raw.strip() if new_assignee_raw and isinstance(new_assignee_raw, str) else (new_assignee_raw or "")
-            
-            # 获取旧值（处理None、空字符串等情况）
-            old_assignee_raw = old_assignee
-            old_assignee_value = old_assignee_raw.strip() if old_assignee_raw and isinstance(old_assignee_raw, str) else (old_assignee_raw or "")
-            
-            print(f"📝 Assignee change check - Old: '{old_assignee_value}' (type: {type(old_assignee_raw)}), New: '{new_assignee}' (type: {type(new_assignee_raw)})")
-            
-            # 比较新旧值（处理None和空字符串的情况）
-            if new_assignee != old_assignee_value:
-                print(f"✅ Assignee changed from '{old_assignee_value}' to '{new_assignee}', recording activity...")
-                if new_assignee:
-                    # 获取被分配用户的姓名
-                    cursor.execute("SELECT name, email FROM users WHERE email = ?", (new_assignee,))
-                    assignee_info = cursor.fetchone()
-                    if assignee_info:
-                        # 优先使用name，如果name为空则使用email
-                        assignee_name = assignee_info[0] if assignee_info[0] else assignee_info[1]
-                    else:
-                        assignee_name = new_assignee
-                    
-                    # 获取操作者姓名
-                    operator_name = current_user.get("name") or current_user.get("email", "Unknown")
-                    
-                    description = f"{operator_name} assigned request {request_id} to {assignee_name}"
-                    print(f"📝 Recording assignment: {description}")
-                    cursor.execute('''
-                        INSERT INTO activities (request_id, user_id, activity_type, description)
-                        VALUES (?, ?, ?, ?)
-                    ''', (request_id, current_user["id"], "assigned", description))
-                else:
-                    # 取消分配 - 需要记录被取消分配的用户
-                    operator_name = current_user.get("name") or current_user.get("email", "Unknown")
-                    # 获取被取消分配的用户信息（从旧值中获取）
-                    if old_assignee:
-                        cursor.execute("SELECT name, email FROM users WHERE email = ?", (old_assignee,))
-                        unassignee_info = cursor.fetchone()
-                        if unassignee_info:
-                            unassignee_name = unassignee_info[0] if unassignee_info[0] else unassignee_info[1]
-                        else:
-                            unassignee_name = old_assignee
-                        description = f"{operator_name} unassigned request {request_id} from {unassignee_name}"
-                    else:
-                        description = f"{operator_name} unassigned this request"
-                    print(f"📝 Recording unassignment: {description}")
-                    cursor.execute('''
-                        INSERT INTO activities (request_id, user_id, activity_type, description)
-                        VALUES (?, ?, ?, ?)
-                    ''', (request_id, current_user["id"], "unassigned", description))
-            else:
-                print(f"⚠️ Assignee unchanged (both are '{old_assignee_value}'), skipping activity record")
+        # 记录补丁历史和活动
+        cursor.execute('''
+            INSERT INTO request_config_history (request_id, version, patch_format, patch, user_id)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (request_id, new_version, patch_format, json.dumps(patch), current_user["id"]))
+        operator_name = current_user.get("name") or current_user.get("email", "Unknown")
+        insert_activities(cursor, [(request_id, current_user["id"], "config_patched",
+                                    f"{operator_name} updated {len(touched)} configuration field(s) of request {request_id}")])
+        return new_version, delta
+    
+    try:
+        new_version, delta = await activity_writer.run(apply_patch)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"❌ Error in patch_request_config: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    invalidate_responses(f"request:{request_id}")
+    response.headers["ETag"] = make_etag(request_id, new_version)
+    print(f"✅ Request {request_id} config patched to version {new_version}")
+    # 只返回本次修改的差异条目
+    return {"message": "Request config patched successfully", "version": new_version, "changes": delta}
+
+@app.get("/api/requests/{request_id}/config/history")
+async def get_request_config_history(request_id: str, current_user: dict = Depends(get_current_user)):
+    """获取请求配置的补丁历史"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("SELECT user_id FROM requests WHERE request_id = ?", (request_id,))
+        row = cursor.fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="Request not found")
         
-        conn.commit()
+        user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
+        if not can_view_all(user_role) and row[0] != current_user["id"]:
+            raise HTTPException(status_code=403, detail="You don't have permission to access this request")
         
-        print(f"✅ Request {request_id} updated successfully")
-        return {"message": "Request updated successfully"}
+        cursor.execute('''
+            SELECT h.version, h.patch_format, h.patch, h.created_at, u.name, u.email
+            FROM request_config_history h
+            LEFT JOIN users u ON h.user_id = u.id
+            WHERE h.request_id = ?
+            ORDER BY h.version DESC
+        ''', (request_id,))
+        return [{
+            "version": h_row[0],
+            "format": h_row[1],
+            "patch": json.loads(h_row[2]),
+            "createdAt": h_row[3],
+            "authorName": h_row[4] or "Unknown User",
+            "authorEmail": h_row[5] or "unknown@example.com"
+        } for h_row in cursor.fetchall()]
     except HTTPException:
         raise
     except Exception as e:
@@ -997,7 +3637,7 @@ async def delete_requests_batch(request_data: dict, current_user: dict = Depends
     user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
     print(f"User Role: {user_role}")
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -1037,6 +3677,7 @@ async def delete_requests_batch(request_data: dict, current_user: dict = Depends
             deleted_count = cursor.rowcount
         
         conn.commit()
+        invalidate_responses(*[f"request:{rid}" for rid in request_ids])
         
         print(f"✅ Successfully deleted {deleted_count} request(s) out of {len(request_ids)} requested")
         
@@ -1055,10 +3696,84 @@ async def delete_requests_batch(request_data: dict, current_user: dict = Depends
     finally:
         conn.close()
 
+# 批量更新允许修改的字段
+BATCH_UPDATE_FIELDS = {"status": "status", "assignee": "assignee"}
+BATCH_UPDATE_MAX_IDS = 500
+
+class RequestBatchUpdate(BaseModel):
+    ids: List[str] = Field(min_length=1, max_length=BATCH_UPDATE_MAX_IDS)
+    patch: Dict[str, Optional[str]] = {}
+
+@app.post("/api/requests/batch/update")
+async def update_requests_batch(request_data: RequestBatchUpdate, current_user: dict = Depends(get_current_user)):
+    """批量更新请求状态或分配人 - 一个事务内完成权限检查、更新和活动记录"""
+    print(f"=== BATCH UPDATE REQUESTS ===")
+    print(f"Current User: {current_user}")
+    user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
+    
+    request_ids = list(dict.fromkeys(request_data.ids))
+    patch = request_data.patch
+    if not patch:
+        raise HTTPException(status_code=400, detail="No fields to update")
+    
+    unsupported = [field for field in patch if field not in BATCH_UPDATE_FIELDS]
+    if unsupported:
+        raise HTTPException(status_code=400, detail=f"Unsupported batch update fields: {', '.join(unsupported)}")
+    
+    # 非 rakwireless/admin 用户不能修改状态（workflow）
+    if not is_rakwireless(user_role) and "status" in patch:
+        raise HTTPException(status_code=403, detail="Only RAK Wireless employees can update workflow status")
+    
+    update_fields = [f"{BATCH_UPDATE_FIELDS[field]} = ?" for field in patch]
+    update_values = [patch[field] for field in patch]
+    placeholders = ",".join(["?" for _ in request_ids])
+    
+    def apply_batch_update(cursor):
+        # 一次查询获取所有请求的创建者和旧值，用于权限检查和活动记录
+        cursor.execute(f"SELECT request_id, user_id, status, assignee FROM requests WHERE request_id IN ({placeholders})",
+                       request_ids)
+        rows = {row[0]: row for row in cursor.fetchall()}
+        
+        missing = [rid for rid in request_ids if rid not in rows]
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Requests not found: {', '.join(missing)}")
+        
+        if not can_view_all(user_role):
+            forbidden = [rid for rid, row in rows.items() if row[1] != current_user["id"]]
+            if forbidden:
+                raise HTTPException(status_code=403, detail="You can only edit your own requests")
+        
+        cursor.execute(f"""
+            UPDATE requests
+            SET {', '.join(update_fields)}, version = COALESCE(version, 1) + 1
+            WHERE request_id IN ({placeholders})
+        """, update_values + request_ids)
+        updated_count = cursor.rowcount
+        
+        # 分配人姓名只解析一次，活动记录批量写入
+        user_names = resolve_user_names(cursor, [patch.get("assignee")] + [row[3] for row in rows.values()])
+        activity_rows = []
+        for rid in request_ids:
+            row = rows[rid]
+            activity_rows.extend(build_update_activities(rid, current_user, patch, row[2], row[3], user_names))
+        insert_activities(cursor, activity_rows)
+        return updated_count
+    
+    try:
+        updated_count = await activity_writer.run(apply_batch_update)
+        invalidate_responses(*[f"request:{rid}" for rid in request_ids])
+        print(f"✅ Batch updated {updated_count} request(s)")
+        return {"message": f"Successfully updated {updated_count} request(s)", "updated_count": updated_count}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"❌ Error in update_requests_batch: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/api/debug/users")
 async def debug_users():
     """调试：查看所有用户"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -1078,11 +3793,15 @@ async def debug_users():
         conn.close()
 
 @app.get("/api/debug/hash/{password}")
-async def debug_hash(password: str):
-    """调试：查看密码哈希"""
+async def debug_hash(password: str, current_user: dict = Depends(get_current_user)):
+    """调试（仅 Admin）：查看密码哈希（在密码哈希线程池中计算）"""
+    user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
+    if not is_admin(user_role):
+        raise HTTPException(status_code=403, detail="Only admins can use the password hash debug endpoint")
+    
     return {
         "password": password,
-        "hash": get_password_hash(password)
+        "hash": await get_password_hash_async(password)
     }
 
 @app.get("/api/debug/test-auth")
@@ -1093,10 +3812,188 @@ async def test_auth(current_user: dict = Depends(get_current_user)):
         "user": current_user
     }
 
+# 序列化和校验基准测试在单线程的独立线程池中执行，不阻塞事件循环，同一时间只运行一个
+debug_benchmark_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="debug-benchmark")
+
+@app.get("/api/debug/benchmark/config-validation")
+async def benchmark_config_validation(
+    iterations: int = 1000,
+    request_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """调试（仅 Admin）：测量 configData schema 校验的耗时（默认使用最近一个请求的配置）"""
+    user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
+    if not is_admin(user_role):
+        raise HTTPException(status_code=403, detail="Only admins can run the config validation benchmark")
+    
+    iterations = max(1, min(iterations, 5000))
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        if request_id:
+            cursor.execute("SELECT config_data FROM requests WHERE request_id = ?", (request_id,))
+        else:
+            cursor.execute("SELECT config_data FROM requests ORDER BY id DESC LIMIT 1")
+        row = cursor.fetchone()
+    finally:
+        conn.close()
+    raw_config = row[0] if row and row[0] else "{}"
+    
+    def measure():
+        config_data = json.loads(raw_config)
+        
+        # 编译耗时（不使用缓存）
+        start = time.perf_counter()
+        validator = _compile_schema_node(GATEWAY_CONFIG_SCHEMAS[CONFIG_SCHEMA_VERSION], False)
+        compile_ms = (time.perf_counter() - start) * 1000
+        
+        start = time.perf_counter()
+        for _ in range(iterations):
+            errors = []
+            validator(config_data, "", errors)
+        validate_us = (time.perf_counter() - start) * 1e6 / iterations
+        
+        # 作为对照：同一配置的 JSON 解码耗时
+        start = time.perf_counter()
+        for _ in range(iterations):
+            json.loads(raw_config)
+        decode_us = (time.perf_counter() - start) * 1e6 / iterations
+        return compile_ms, validate_us, decode_us, errors
+    
+    compile_ms, validate_us, decode_us, errors = await asyncio.get_running_loop().run_in_executor(
+        debug_benchmark_executor, measure)
+    
+    return {
+        "schemaVersion": CONFIG_SCHEMA_VERSION,
+        "requestId": request_id,
+        "configBytes": len(raw_config),
+        "iterations": iterations,
+        "compileMs": round(compile_ms, 3),
+        "validateUsPerCall": round(validate_us, 2),
+        "jsonDecodeUsPerCall": round(decode_us, 2),
+        "errors": errors
+    }
+
+@app.get("/api/debug/benchmark/password-hashing")
+async def benchmark_password_hashing(logins: int = 50, current_user: dict = Depends(get_current_user)):
+    """
+    调试（仅 Admin）：按当前哈希配置测量单次校验耗时和登录吞吐量（logins/sec）
+    在独立的同等大小线程池中执行，不占用真实登录的线程池和排队名额
+    """
+    user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
+    if not is_admin(user_role):
+        raise HTTPException(status_code=403, detail="Only admins can run the password hashing benchmark")
+    
+    logins = max(1, min(logins, PASSWORD_BENCHMARK_MAX_LOGINS))
+    loop = asyncio.get_running_loop()
+    password = uuid.uuid4().hex
+    hashed = await loop.run_in_executor(password_benchmark_executor, get_password_hash, password)
+    
+    start = time.perf_counter()
+    await loop.run_in_executor(password_benchmark_executor, verify_password, password, hashed)
+    single_ms = (time.perf_counter() - start) * 1000
+    
+    start = time.perf_counter()
+    results = await asyncio.gather(*[loop.run_in_executor(password_benchmark_executor, verify_password, password, hashed)
+                                     for _ in range(logins)], return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    completed = sum(1 for result in results if result is True)
+    
+    return {
+        "scheme": pwd_context.default_scheme(),
+        "hash": hashed.rsplit("$", 2)[0],
+        "workers": PASSWORD_HASH_WORKERS,
+        "maxPending": PASSWORD_HASH_MAX_PENDING,
+        "verifyMs": round(single_ms, 2),
+        "logins": logins,
+        "completed": completed,
+        "failed": logins - completed,
+        "elapsedSeconds": round(elapsed, 3),
+        "loginsPerSecond": round(completed / elapsed, 1) if elapsed else None
+    }
+
+@app.get("/api/debug/benchmark/json-serialization")
+async def benchmark_json_serialization(limit: int = 200, iterations: int = 20,
+                                       current_user: dict = Depends(get_current_user)):
+    """调试（仅 Admin）：比较请求列表的两种序列化方式——解析后经 jsonable_encoder + json 编码，与 dumps_json 原样拼接"""
+    user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
+    if not is_admin(user_role):
+        raise HTTPException(status_code=403, detail="Only admins can run the JSON serialization benchmark")
+    
+    limit = max(1, min(limit, 500))
+    iterations = max(1, min(iterations, 50))
+    conn = get_db_connection()
+    try:
+        rows = conn.execute('''
+            SELECT request_id, status, config_data, changes, original_config, tags
+            FROM requests ORDER BY id DESC LIMIT ?
+        ''', (limit,)).fetchall()
+    finally:
+        conn.close()
+    
+    def parsed_payload():
+        return [{
+            "id": row[0], "status": row[1],
+            "configData": json.loads(row[2]) if row[2] else {},
+            "changes": json.loads(row[3]) if row[3] else {},
+            "originalConfig": json.loads(row[4]) if row[4] else {},
+            "tags": json.loads(row[5]) if row[5] else []
+        } for row in rows]
+    
+    def raw_payload():
+        return [{
+            "id": row[0], "status": row[1],
+            "configData": RawJSON(row[2]), "changes": RawJSON(row[3]),
+            "originalConfig": RawJSON(row[4]), "tags": RawJSON(row[5], "[]")
+        } for row in rows]
+    
+    def measure():
+        start = time.perf_counter()
+        for _ in range(iterations):
+            baseline = JSONResponse(jsonable_encoder(parsed_payload())).body
+        baseline_ms = (time.perf_counter() - start) * 1000 / iterations
+        
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fast = dumps_json(raw_payload())
+        fast_ms = (time.perf_counter() - start) * 1000 / iterations
+        return len(fast), json.loads(baseline) == json.loads(fast), baseline_ms, fast_ms
+    
+    size, equivalent, baseline_ms, fast_ms = await asyncio.get_running_loop().run_in_executor(
+        debug_benchmark_executor, measure)
+    
+    return {
+        "encoder": "orjson" if orjson is not None else "json",
+        "requests": len(rows),
+        "iterations": iterations,
+        "bytes": size,
+        "equivalent": equivalent,
+        "baselineMs": round(baseline_ms, 3),
+        "fastMs": round(fast_ms, 3),
+        "speedup": round(baseline_ms / fast_ms, 1) if fast_ms else None
+    }
+
+@app.get("/api/debug/cache-stats")
+async def debug_cache_stats(current_user: dict = Depends(get_current_user)):
+    """调试（仅 Admin）：接口结果缓存和压缩缓存的命中率、容量和失效统计"""
+    user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
+    if not is_admin(user_role):
+        raise HTTPException(status_code=403, detail="Only admins can view cache statistics")
+    return {**response_cache.snapshot(), "compression": compressed_bodies.snapshot()}
+
+@app.get("/api/debug/slow-queries")
+async def debug_slow_queries(current_user: dict = Depends(get_current_user)):
+    """调试（仅 Admin）：最近的慢查询（含执行计划）"""
+    user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
+    if not is_admin(user_role):
+        raise HTTPException(status_code=403, detail="Only admins can view slow queries")
+    return {"thresholdMs": SLOW_QUERY_THRESHOLD_MS, "queries": list(slow_queries)[::-1]}
+
 @app.get("/api/debug/test-db")
 async def test_db():
     """调试：测试数据库连接"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -1154,66 +4051,19 @@ async def upload_file(file: UploadFile = File(...), current_user: dict = Depends
             shutil.copyfileobj(file.file, buffer)
         
         print(f"File saved successfully: {file_path}")
+        uploads_total.inc()
+        upload_bytes_total.inc(amount=os.path.getsize(file_path))
         
         # 存储文件信息到数据库
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # 创建表（如果不存在）
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS files (
-                id TEXT PRIMARY KEY,
-                filename TEXT,
-                file_path TEXT,
-                file_size INTEGER,
-                user_id INTEGER,
-                upload_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # 创建comments表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS comments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                request_id TEXT NOT NULL,
-                user_id INTEGER NOT NULL,
-                content TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (request_id) REFERENCES requests (request_id),
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # 创建activities表（活动流）
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS activities (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                request_id TEXT NOT NULL,
-                user_id INTEGER NOT NULL,
-                activity_type TEXT NOT NULL,
-                description TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (request_id) REFERENCES requests (request_id),
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # 检查并添加缺失的列
+        conn = get_db_connection()
         try:
-            cursor.execute("ALTER TABLE files ADD COLUMN original_name TEXT")
-            print("Added original_name column to files table")
-        except sqlite3.OperationalError:
-            # 列已存在，忽略错误
-            print("original_name column already exists")
-        
-        cursor.execute('''
-            INSERT INTO files (id, original_name, filename, file_path, file_size, user_id)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (file_id, file.filename, filename, file_path, file.size, current_user["id"]))
-        
-        conn.commit()
-        conn.close()
+            conn.execute('''
+                INSERT INTO files (id, original_name, filename, file_path, file_size, user_id)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (file_id, file.filename, filename, file_path, file.size, current_user["id"]))
+            conn.commit()
+        finally:
+            conn.close()
         
         print(f"✅ File upload completed successfully: {file_id}")
         return {"fileId": file_id, "filename": file.filename, "size": file.size}
@@ -1238,45 +4088,25 @@ async def download_file(file_id: str, current_user: dict = Depends(get_current_u
         print(f"📁 文件下载请求: {file_id}")
         print(f"👤 用户: {current_user}")
         
-        conn = sqlite3.connect(DB_FILE)
+        conn = get_db_connection()
         cursor = conn.cursor()
-        
-        # 首先尝试查找文件（可能是上传者自己下载）
-        cursor.execute('''
-            SELECT original_name, file_path FROM files 
-            WHERE id = ?
-        ''', (file_id,))
-        
-        row = cursor.fetchone()
-        if not row:
-            print(f"❌ 文件未找到: {file_id}")
-            conn.close()
-            raise HTTPException(status_code=404, detail="File not found")
-        
-        original_name, file_path = row
-        
-        # 检查文件是否在评论附件中（允许任何人下载评论附件）
-        # 或者检查是否是当前用户上传的文件
-        cursor.execute('''
-            SELECT user_id FROM files WHERE id = ?
-        ''', (file_id,))
-        file_owner = cursor.fetchone()
-        
-        # 检查文件是否属于评论附件
-        cursor.execute('''
-            SELECT request_id FROM comments 
-            WHERE attachments LIKE ? OR attachments LIKE ?
-        ''', (f'%{file_id}%', f'%"{file_id}"%'))
-        
-        is_comment_attachment = cursor.fetchone() is not None
-        
-        # 如果是评论附件或者是文件所有者，允许下载
-        if not is_comment_attachment and file_owner and file_owner[0] != current_user["id"]:
-            print(f"❌ 权限不足: 用户 {current_user['id']} 尝试下载文件 {file_id}")
+        try:
+            cursor.execute("SELECT original_name, file_path, user_id FROM files WHERE id = ?", (file_id,))
+            row = cursor.fetchone()
+            if not row:
+                print(f"❌ 文件未找到: {file_id}")
+                raise HTTPException(status_code=404, detail="File not found")
+            
+            original_name, file_path, file_owner = row
+            
+            # 评论附件允许任何人下载，否则只有上传者可以下载
+            if file_owner != current_user["id"]:
+                cursor.execute("SELECT 1 FROM comments WHERE attachments LIKE ? LIMIT 1", (f'%{file_id}%',))
+                if cursor.fetchone() is None:
+                    print(f"❌ 权限不足: 用户 {current_user['id']} 尝试下载文件 {file_id}")
+                    raise HTTPException(status_code=403, detail="You don't have permission to download this file")
+        finally:
             conn.close()
-            raise HTTPException(status_code=403, detail="You don't have permission to download this file")
-        
-        conn.close()
         
         print(f"📄 文件信息: {original_name} -> {file_path}")
         
@@ -1305,7 +4135,7 @@ async def test_db():
     try:
         print(f"=== TEST DB CONNECTION ===")
         print(f"Database file: {DB_FILE}")
-        conn = sqlite3.connect(DB_FILE)
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         # 检查所有表
@@ -1339,66 +4169,27 @@ async def get_comments(request_id: str, current_user: dict = Depends(get_current
     print(f"Request ID: {request_id}")
     print(f"Current User: {current_user}")
     
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
     try:
-        print(f"Connecting to database: {DB_FILE}")
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        print("Database connection successful")
-        
-        # 检查comments表是否存在
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='comments'")
-        table_exists = cursor.fetchone()
-        print(f"Comments table exists: {table_exists}")
-        
-        if not table_exists:
-            print("Comments table does not exist, creating it...")
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS comments (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    request_id TEXT NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    content TEXT NOT NULL,
-                    attachments TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (request_id) REFERENCES requests (request_id),
-                    FOREIGN KEY (user_id) REFERENCES users (id)
-                )
-            ''')
-            conn.commit()
-            print("Comments table created successfully")
-        else:
-            # 检查表结构
-            cursor.execute("PRAGMA table_info(comments)")
-            columns = cursor.fetchall()
-            print(f"Comments table columns: {columns}")
-            
-            # 检查是否有user_id列
-            has_user_id = any(col[1] == 'user_id' for col in columns)
-            print(f"Has user_id column: {has_user_id}")
-            
-            if not has_user_id:
-                print("Adding user_id column to comments table...")
-                cursor.execute("ALTER TABLE comments ADD COLUMN user_id INTEGER")
-                conn.commit()
-                print("user_id column added successfully")
-        
         # 使用JOIN查询获取真实的用户信息
         cursor.execute('''
             SELECT c.id, c.content, c.attachments, c.created_at, u.name, u.email
             FROM comments c
             JOIN users u ON c.user_id = u.id
             WHERE c.request_id = ?
-            ORDER BY c.created_at ASC
+            ORDER BY c.created_at ASC, c.id ASC
         ''', (request_id,))
         
         comments = []
         for row in cursor.fetchall():
             # 解析附件（JSON字符串）
             attachments = []
-            if row[2]:  # attachments列
+            if row[2]:
                 try:
-                    attachments = json.loads(row[2]) if isinstance(row[2], str) else row[2]
-                except:
+                    attachments = json.loads(row[2])
+                except ValueError:
                     attachments = []
             
             comments.append({
@@ -1418,8 +4209,7 @@ async def get_comments(request_id: str, current_user: dict = Depends(get_current
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        if 'conn' in locals():
-            conn.close()
+        conn.close()
 
 @app.post("/api/requests/{request_id}/comments")
 async def create_comment(request_id: str, comment_data: CommentCreate, current_user: dict = Depends(get_current_user)):
@@ -1429,45 +4219,10 @@ async def create_comment(request_id: str, comment_data: CommentCreate, current_u
     print(f"Comment Data: {comment_data}")
     print(f"Current User: {current_user}")
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        # 检查comments表是否存在
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='comments'")
-        table_exists = cursor.fetchone()
-        print(f"Comments table exists: {table_exists}")
-        
-        if not table_exists:
-            print("Comments table does not exist, creating it...")
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS comments (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    request_id TEXT NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    content TEXT NOT NULL,
-                    attachments TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (request_id) REFERENCES requests (request_id),
-                    FOREIGN KEY (user_id) REFERENCES users (id)
-                )
-            ''')
-            conn.commit()
-            print("Comments table created successfully")
-        else:
-            # 检查表结构
-            cursor.execute("PRAGMA table_info(comments)")
-            columns = cursor.fetchall()
-            print(f"Comments table columns: {columns}")
-            
-            # 检查是否有author列
-            has_author = any(col[1] == 'author' for col in columns)
-            print(f"Has author column: {has_author}")
-            
-            if has_author:
-                print("Comments table has author column, this might cause issues")
-                print("Warning: comments table has unexpected 'author' column")
-        
         # 检查请求是否存在
         cursor.execute("SELECT id FROM requests WHERE request_id = ?", (request_id,))
         if not cursor.fetchone():
@@ -1477,96 +4232,28 @@ async def create_comment(request_id: str, comment_data: CommentCreate, current_u
         if not comment_data.content.strip() and (not comment_data.attachments or len(comment_data.attachments) == 0):
             raise HTTPException(status_code=400, detail="Comment must have content or attachments")
         
-        # 插入评论 - 检查表结构来决定INSERT语句
+        # 插入评论 - 检查表结构来决定INSERT语句（兼容带有 author 等旧列的数据库）
         cursor.execute("PRAGMA table_info(comments)")
-        columns = cursor.fetchall()
-        column_names = [col[1] for col in columns]
-        print(f"Available columns: {column_names}")
-        
-        # 检查并添加attachments列（如果不存在）
-        has_attachments = any(col[1] == 'attachments' for col in columns)
-        if not has_attachments:
-            try:
-                cursor.execute("ALTER TABLE comments ADD COLUMN attachments TEXT")
-                conn.commit()
-                print("Added attachments column to comments table")
-                # 重新获取列信息
-                cursor.execute("PRAGMA table_info(comments)")
-                columns = cursor.fetchall()
-                column_names = [col[1] for col in columns]
-            except sqlite3.OperationalError:
-                print("attachments column already exists or failed to add")
-        
-        # 构建动态INSERT语句
-        required_columns = ['request_id', 'user_id', 'content']
-        optional_columns = ['author', 'author_email', 'author_name', 'attachments']
-        
-        # 检查哪些可选列存在
-        existing_optional = [col for col in optional_columns if col in column_names]
-        print(f"Existing optional columns: {existing_optional}")
-        
-        # 构建列名和值
-        insert_columns = required_columns + existing_optional
-        placeholders = ['?' for _ in insert_columns]
-        
-        # 构建值列表
-        values = [request_id, current_user["id"], comment_data.content]
-        
-        # 添加可选列的值
-        if 'author' in existing_optional:
-            values.append(current_user.get("name", "Unknown"))
-        if 'author_email' in existing_optional:
-            values.append(current_user.get("email", "unknown@example.com"))
-        if 'author_name' in existing_optional:
-            values.append(current_user.get("name", "Unknown"))
-        if 'attachments' in existing_optional:
-            # 将附件列表转换为JSON字符串
-            attachments_json = json.dumps(comment_data.attachments or [])
-            values.append(attachments_json)
-        
-        print(f"Insert columns: {insert_columns}")
-        print(f"Insert values: {values}")
-        
-        # 执行动态INSERT
-        insert_sql = f'''
-            INSERT INTO comments ({', '.join(insert_columns)})
-            VALUES ({', '.join(placeholders)})
-        '''
-        print(f"SQL: {insert_sql}")
-        
-        cursor.execute(insert_sql, values)
-        
-        conn.commit()
-        
-        # 检查activities表是否存在
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='activities'")
-        activities_table_exists = cursor.fetchone()
-        print(f"Activities table exists: {activities_table_exists}")
+        column_names = [col[1] for col in cursor.fetchall()]
+        conn.close()
         
-        if not activities_table_exists:
-            print("Activities table does not exist, creating it...")
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS activities (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    request_id TEXT NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    activity_type TEXT NOT NULL,
-                    description TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (request_id) REFERENCES requests (request_id),
-                    FOREIGN KEY (user_id) REFERENCES users (id)
-                )
-            ''')
-            conn.commit()
-            print("Activities table created successfully")
+        values = {"request_id": request_id, "user_id": current_user["id"], "content": comment_data.content}
+        legacy_values = {
+            "author": current_user.get("name", "Unknown"),
+            "author_email": current_user.get("email", "unknown@example.com"),
+            "author_name": current_user.get("name", "Unknown"),
+            "attachments": json.dumps(comment_data.attachments or [])
+        }
+        values.update({column: value for column, value in legacy_values.items() if column in column_names})
+        insert_sql = f"INSERT INTO comments ({', '.join(values)}) VALUES ({', '.join('?' for _ in values)})"
         
-        # 创建活动记录
-        cursor.execute('''
-            INSERT INTO activities (request_id, user_id, activity_type, description)
-            VALUES (?, ?, ?, ?)
-        ''', (request_id, current_user["id"], "comment", f"Added a comment: {comment_data.content[:50]}..."))
+        # 评论和活动记录在同一个工作单元中写入
+        def insert_comment(cursor):
+            cursor.execute(insert_sql, list(values.values()))
+            insert_activities(cursor, [(request_id, current_user["id"], "comment",
+                                        f"Added a comment: {comment_data.content[:50]}...")])
         
-        conn.commit()
+        await activity_writer.run(insert_comment)
         
         print(f"✅ Comment created successfully")
         return {"message": "Comment created successfully"}
@@ -1578,30 +4265,22 @@ async def create_comment(request_id: str, comment_data: CommentCreate, current_u
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        if 'conn' in locals():
-            conn.close()
+        conn.close()
 
 @app.delete("/api/requests/{request_id}/comments/{comment_id}")
 async def delete_comment(request_id: str, comment_id: int, current_user: dict = Depends(get_current_user)):
     """删除评论"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        # 检查评论是否存在且属于当前用户
-        cursor.execute('''
-            SELECT id FROM comments 
-            WHERE id = ? AND request_id = ? AND user_id = ?
-        ''', (comment_id, request_id, current_user["id"]))
-        
-        if not cursor.fetchone():
-            raise HTTPException(status_code=404, detail="Comment not found")
-        
-        # 删除评论
+        # 只能删除自己的评论
         cursor.execute('''
             DELETE FROM comments 
             WHERE id = ? AND request_id = ? AND user_id = ?
         ''', (comment_id, request_id, current_user["id"]))
+        if cursor.rowcount == 0:
+            raise HTTPException(status_code=404, detail="Comment not found")
         
         conn.commit()
         
@@ -1621,39 +4300,17 @@ async def get_activities(request_id: str, current_user: dict = Depends(get_curre
     print(f"Request ID: {request_id}")
     print(f"Current User: {current_user}")
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        # 检查activities表是否存在
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='activities'")
-        table_exists = cursor.fetchone()
-        print(f"Activities table exists: {table_exists}")
-        
-        if not table_exists:
-            print("Activities table does not exist, creating it...")
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS activities (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    request_id TEXT NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    activity_type TEXT NOT NULL,
-                    description TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (request_id) REFERENCES requests (request_id),
-                    FOREIGN KEY (user_id) REFERENCES users (id)
-                )
-            ''')
-            conn.commit()
-            print("Activities table created successfully")
-        
         # 使用JOIN查询获取真实的用户信息
         cursor.execute('''
             SELECT a.id, a.activity_type, a.description, a.created_at, u.name, u.email
             FROM activities a
             JOIN users u ON a.user_id = u.id
             WHERE a.request_id = ?
-            ORDER BY a.created_at DESC
+            ORDER BY a.created_at DESC, a.id DESC
         ''', (request_id,))
         
         activities = []
@@ -1684,7 +4341,7 @@ async def get_my_assignments(current_user: dict = Depends(get_current_user)):
     1. 当前用户创建的request：所有assign和status_changed活动都提醒
     2. 非当前用户创建的request：只有assign/unassigned活动，且assignee是当前用户时才提醒
     """
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -1775,7 +4432,7 @@ async def get_my_assignments(current_user: dict = Depends(get_current_user)):
 @app.post("/api/requests/{request_id}/activities")
 async def create_activity(request_id: str, activity_data: ActivityCreate, current_user: dict = Depends(get_current_user)):
     """创建新活动"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -1784,13 +4441,12 @@ async def create_activity(request_id: str, activity_data: ActivityCreate, curren
         if not cursor.fetchone():
             raise HTTPException(status_code=404, detail="Request not found")
         
-        # 插入活动
-        cursor.execute('''
-            INSERT INTO activities (request_id, user_id, activity_type, description)
-            VALUES (?, ?, ?, ?)
-        ''', (request_id, current_user["id"], activity_data.activity_type, activity_data.description))
+        conn.close()
         
-        conn.commit()
+        # 插入活动（经写入合并器与其他写操作一起提交）
+        await activity_writer.run(lambda cursor: insert_activities(
+            cursor, [(request_id, current_user["id"], activity_data.activity_type, activity_data.description)]
+        ))
         
         return {"message": "Activity created successfully"}
     except HTTPException:
@@ -1800,6 +4456,211 @@ async def create_activity(request_id: str, activity_data: ActivityCreate, curren
     finally:
         conn.close()
 
+# ==================== Compiled Template Engine ====================
+
+PLACEHOLDER_PATTERN = re.compile(r"\{\{([^{}]+)\}\}")
+COMPILED_TEMPLATE_CACHE_SIZE = int(os.getenv("COMPILED_TEMPLATE_CACHE_SIZE", "256"))
+TEMPLATE_BODY_CACHE_SIZE = int(os.getenv("TEMPLATE_BODY_CACHE_SIZE", "512"))
+MY_TEMPLATES_CACHE_SIZE = int(os.getenv("MY_TEMPLATES_CACHE_SIZE", "256"))
+
+class TemplateRenderError(ValueError):
+    """模板变量校验失败（缺少必填变量或传入未定义的变量）"""
+    
+    def __init__(self, missing: list, unknown: list):
+        self.missing = missing
+        self.unknown = unknown
+        super().__init__(f"Missing variables: {missing}, unknown variables: {unknown}")
+
+class CompiledTemplate:
+    """
+    预编译的模板
+    保存时把 configData 中所有 {{变量}} 出现的位置编译成 (路径, 字符串片段) 列表，
+    并保存 configData 的 JSON 编码；应用时解码出一份新的配置，只替换这些位置。
+    """
+    
+    def __init__(self, template_id: str, version: int, config_data: dict, variables: list):
+        self.template_id = template_id
+        self.version = version
+        self.variables = variables or []
+        self.declared = {var.get("name", "") for var in self.variables if var.get("name")}
+        self.required = [var["name"] for var in self.variables if var.get("name") and var.get("required")]
+        self.defaults = {var["name"]: var.get("defaultValue") or "" for var in self.variables if var.get("name")}
+        self.sites = []
+        self._compile(config_data, ())
+        # 每次渲染从编码解出新的对象树，结果不与缓存共享任何可变对象
+        self._encoded = json.dumps(config_data)
+    
+    def _compile(self, node, path):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                self._compile(value, path + (key,))
+        elif isinstance(node, list):
+            for index, value in enumerate(node):
+                self._compile(value, path + (index,))
+        elif isinstance(node, str) and "{{" in node:
+            # 片段列表：(是否变量, 文本或变量名)；未定义的占位符按原文保留
+            segments = []
+            position = 0
+            for match in PLACEHOLDER_PATTERN.finditer(node):
+                if match.group(1) not in self.declared:
+                    continue
+                if match.start() > position:
+                    segments.append((False, node[position:match.start()]))
+                segments.append((True, match.group(1)))
+                position = match.end()
+            if segments:
+                if position < len(node):
+                    segments.append((False, node[position:]))
+                self.sites.append((path, segments))
+    
+    def validate(self, values: dict):
+        missing = [name for name in self.required if not str(values.get(name) or "").strip()]
+        unknown = sorted(name for name in values if name not in self.declared)
+        if missing or unknown:
+            raise TemplateRenderError(missing, unknown)
+    
+    def render(self, values: dict, strict: bool = True) -> dict:
+        """
+        用变量值渲染模板，返回新的配置（调用方可以修改）
+        strict：校验缺少的必填变量和未定义的变量，未传的变量使用 defaultValue；
+        否则保持 apply 接口原来的行为：不校验，未传的变量替换为空字符串
+        """
+        if strict:
+            self.validate(values)
+        resolved = {name: str(values[name]) if values.get(name) is not None else self.defaults[name] if strict else ""
+                    for name in self.declared}
+        root = json.loads(self._encoded)
+        for path, segments in self.sites:
+            node = root
+            for key in path[:-1]:
+                node = node[key]
+            node[path[-1]] = "".join(resolved[text] if is_var else text for is_var, text in segments)
+        return root
+
+class VersionedCache:
+    """
+    按 (template_id, version) 缓存的 LRU：每个模板只保留最新版本，
+    读取时版本号不一致即视为未命中
+    """
+    
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, key: str, version: int):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, key: str, version: int, value):
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+compiled_templates = VersionedCache(COMPILED_TEMPLATE_CACHE_SIZE)
+# 模板正文（解码后的 configData / variables）缓存
+template_bodies = VersionedCache(TEMPLATE_BODY_CACHE_SIZE)
+# 每个用户的"我的模板"视图，版本为模板代数
+my_templates_cache = VersionedCache(MY_TEMPLATES_CACHE_SIZE)
+
+# 模板代数：任何模板新增、修改或删除后递增，依赖模板列表的缓存据此判断是否过期
+template_generation = 0
+template_generation_lock = threading.Lock()
+
+@cluster_bus.on("templates_changed")
+def _on_templates_changed(payload: dict):
+    global template_generation
+    with template_generation_lock:
+        template_generation += 1
+    response_cache.invalidate(["templates"])
+
+@cluster_bus.on("template_changed")
+def _on_template_changed(payload: dict):
+    compiled_templates.invalidate(payload["template_id"])
+    template_bodies.invalidate(payload["template_id"])
+    _on_templates_changed(payload)
+
+@cluster_bus.on("my_templates_changed")
+def _on_my_templates_changed(payload: dict):
+    for user_id in payload["user_ids"]:
+        my_templates_cache.invalidate(user_id)
+
+def bump_template_generation():
+    """模板新增后调用（所有工作进程）"""
+    cluster_bus.publish("templates_changed")
+
+def invalidate_template(template_id: str):
+    """模板修改或删除后清除其所有缓存（所有工作进程）"""
+    cluster_bus.publish("template_changed", {"template_id": template_id})
+
+def invalidate_my_templates(user_ids: list):
+    """收藏或使用记录变化后清除这些用户的"我的模板"缓存（所有工作进程）"""
+    cluster_bus.publish("my_templates_changed", {"user_ids": list(user_ids)})
+
+def load_template_bodies(cursor, versions: dict) -> dict:
+    """
+    获取多个模板的正文，versions 为 {template_id: version}
+    缓存未命中的模板用一次 IN 查询读取并写入缓存
+    """
+    bodies = {}
+    misses = []
+    for template_id, version in versions.items():
+        body = template_bodies.get(template_id, version)
+        if body is None:
+            misses.append(template_id)
+        else:
+            bodies[template_id] = body
+    if misses:
+        placeholders = ",".join(["?" for _ in misses])
+        cursor.execute(f"SELECT template_id, config_data, variables, version FROM templates WHERE template_id IN ({placeholders})",
+                       misses)
+        for row in cursor.fetchall():
+            body = {
+                "configData": json.loads(row[1]) if row[1] else {},
+                "variables": json.loads(row[2]) if row[2] else []
+            }
+            template_bodies.put(row[0], row[3] or 1, body)
+            bodies[row[0]] = body
+    return bodies
+
+def compile_template(template_id: str, version: int, config_data: dict, variables: list) -> CompiledTemplate:
+    """编译模板并放入缓存"""
+    compiled = CompiledTemplate(template_id, version or 1, config_data, variables)
+    compiled_templates.put(template_id, compiled.version, compiled)
+    return compiled
+
+def get_compiled_template(cursor, template_id: str) -> Optional[CompiledTemplate]:
+    """获取模板的编译结果：先查版本号，缓存未命中时再读取配置并编译"""
+    cursor.execute("SELECT version FROM templates WHERE template_id = ?", (template_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    version = row[0] or 1
+    compiled = compiled_templates.get(template_id, version)
+    if compiled is None:
+        body = load_template_bodies(cursor, {template_id: version}).get(template_id)
+        if body is None:
+            return None
+        compiled = compile_template(template_id, version, body["configData"], body["variables"])
+    return compiled
+
 # ==================== Template API ====================
 
 class TemplateCreate(BaseModel):
@@ -1823,7 +4684,8 @@ class TemplateUpdate(BaseModel):
 @app.post("/api/templates")
 async def create_template(template_data: TemplateCreate, current_user: dict = Depends(get_current_user)):
     """创建模板"""
-    conn = sqlite3.connect(DB_FILE)
+    check_config_data(template_data.configData, allow_placeholders=True)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -1843,8 +4705,14 @@ async def create_template(template_data: TemplateCreate, current_user: dict = De
             1 if template_data.isPublic else 0,
             current_user["id"]
         ))
+        snapshot_template_version(cursor, template_id, current_user["id"])
+        sync_template_tags(cursor, template_id, template_data.tags or [])
         
         conn.commit()
+        
+        # 保存时预编译模板
+        compile_template(template_id, 1, template_data.configData, template_data.variables or [])
+        bump_template_generation()
         return {"message": "Template created successfully", "template_id": template_id}
     except Exception as e:
         conn.rollback()
@@ -1854,12 +4722,18 @@ async def create_template(template_data: TemplateCreate, current_user: dict = De
 
 @app.get("/api/templates/categories")
 async def get_template_categories(current_user: dict = Depends(get_current_user)):
-    """获取模板分类列表"""
-    conn = sqlite3.connect(DB_FILE)
+    """获取模板分类列表（缓存到模板发生修改为止）"""
+    cache_key = template_visibility_scope(current_user)
+    cached = response_cache.get("get_template_categories", cache_key)
+    if cached is not None:
+        return cached
+    since = response_cache.clock
+    
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        query = "SELECT DISTINCT category FROM templates WHERE 1=1"
+        query = "SELECT category FROM templates WHERE category IS NOT NULL"
         params = []
         
         user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
@@ -1867,32 +4741,67 @@ async def get_template_categories(current_user: dict = Depends(get_current_user)
             query += " AND (is_public = 1 OR created_by = ?)"
             params.append(current_user["id"])
         
-        cursor.execute(query, params)
+        # 按 idx_templates_category 分组
+        cursor.execute(query + " GROUP BY category", params)
         rows = cursor.fetchall()
         
         categories = [row[0] for row in rows if row[0]]
+        response_cache.put("get_template_categories", cache_key, categories, ["templates"], since)
         return categories
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
         conn.close()
 
+# 模板列表的轻量字段（不含 configData / variables 正文）
+TEMPLATE_SUMMARY_COLUMNS = '''
+    t.template_id, t.name, t.description, t.category, t.tags, t.is_public, t.created_at, t.updated_at,
+    t.version, t.usage_count, u.email as created_by_email, u.name as created_by_name,
+    COALESCE(json_array_length(t.variables), 0) as variable_count, t.created_by
+'''
+
+def template_summary_from_row(row) -> dict:
+    """把 TEMPLATE_SUMMARY_COLUMNS 查询结果转换为模板摘要"""
+    return {
+        "id": row[0],
+        "name": row[1],
+        "description": row[2],
+        "category": row[3],
+        "tags": json.loads(row[4]) if row[4] else [],
+        "isPublic": bool(row[5]),
+        "createdAt": row[6],
+        "updatedAt": row[7],
+        "version": row[8],
+        "usageCount": row[9],
+        "createdBy": row[10] or "Unknown",
+        "createdByName": row[11] or row[10] or "Unknown",
+        "variableCount": row[12]
+    }
+
 @app.get("/api/templates")
 async def get_templates(
     category: Optional[str] = None,
     is_public: Optional[bool] = None,
     search: Optional[str] = None,
+    view: Optional[str] = "full",
     current_user: dict = Depends(get_current_user)
 ):
-    """获取模板列表"""
-    conn = sqlite3.connect(DB_FILE)
+    """获取模板列表（view=summary 时只返回摘要，不含 configData / variables），每个模板带当前用户的 isFavorite"""
+    if view not in ("full", "summary"):
+        raise HTTPException(status_code=400, detail="view must be 'full' or 'summary'")
+    
+    cache_key = (template_visibility_scope(current_user), category, is_public, search, view)
+    cached = response_cache.get("get_templates", cache_key)
+    if cached is not None:
+        return with_favorite_flags(cached, current_user)
+    since = response_cache.clock
+    
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        query = '''
-            SELECT t.template_id, t.name, t.description, t.category, t.config_data, t.variables, 
-                   t.tags, t.is_public, t.created_at, t.updated_at, t.version, t.usage_count,
-                   u.email as created_by_email, u.name as created_by_name
+        query = f'''
+            SELECT {TEMPLATE_SUMMARY_COLUMNS}
             FROM templates t
             LEFT JOIN users u ON t.created_by = u.id
             WHERE 1=1
@@ -1920,44 +4829,582 @@ async def get_templates(
         query += " ORDER BY t.usage_count DESC, t.created_at DESC"
         
         cursor.execute(query, params)
-        rows = cursor.fetchall()
+        templates = [template_summary_from_row(row) for row in cursor.fetchall()]
+        
+        if view == "full":
+            # 正文从缓存读取，只有未命中的模板才查询并解码
+            bodies = load_template_bodies(cursor, {t["id"]: t["version"] or 1 for t in templates})
+            for template in templates:
+                body = bodies.get(template["id"], {"configData": {}, "variables": []})
+                template["configData"] = body["configData"]
+                template["variables"] = body["variables"]
+        
+        # 列表按使用次数排序，使用计数写入后同样失效
+        response_cache.put("get_templates", cache_key, templates, ["templates", "template_usage"], since)
+        return with_favorite_flags(templates, current_user)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
+# ==================== Template Facets ====================
+
+def sync_template_tags(cursor, template_id: str, tags: list):
+    """用模板当前的标签重建 template_tags 中的记录"""
+    cursor.execute("DELETE FROM template_tags WHERE template_id = ?", (template_id,))
+    cursor.executemany("INSERT OR IGNORE INTO template_tags (template_id, tag) VALUES (?, ?)",
+                       [(template_id, tag) for tag in tags if isinstance(tag, str) and tag])
+
+def template_visibility_scope(current_user: dict) -> str:
+    """缓存键中的可见范围：RAK Wireless 用户看到全部模板，其他用户只看到公开和自己的模板"""
+    user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
+    return "*" if is_rakwireless(user_role) else str(current_user["id"])
+
+def template_facet_filters(current_user: dict, category, tags: list, is_public, search) -> list:
+    """返回 (分面名, 条件, 参数) 列表；统计某个分面时跳过该分面自身的条件"""
+    filters = []
+    if template_visibility_scope(current_user) != "*":
+        filters.append(("scope", "(t.is_public = 1 OR t.created_by = ?)", [current_user["id"]]))
+    if category:
+        filters.append(("category", "t.category = ?", [category]))
+    if tags:
+        # 多个标签之间为"且"关系
+        placeholders = ",".join(["?" for _ in tags])
+        filters.append(("tags", f'''t.template_id IN (
+            SELECT template_id FROM template_tags WHERE tag IN ({placeholders})
+            GROUP BY template_id HAVING COUNT(*) = ?
+        )''', list(tags) + [len(tags)]))
+    if is_public is not None:
+        filters.append(("visibility", "t.is_public = ?", [1 if is_public else 0]))
+    if search:
+        filters.append(("search", "(t.name LIKE ? OR t.description LIKE ?)", [f"%{search}%", f"%{search}%"]))
+    return filters
+
+def facet_where(filters: list, skip: Optional[str] = None):
+    clauses = [clause for name, clause, _ in filters if name != skip]
+    params = [param for name, _, values in filters if name != skip for param in values]
+    return (" AND ".join(clauses) if clauses else "1=1"), params
+
+@app.get("/api/templates/facets")
+async def get_template_facets(
+    category: Optional[str] = None,
+    tag: Optional[List[str]] = Query(None),
+    is_public: Optional[bool] = None,
+    search: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    分面模板列表：按分类、标签（可多个）、公开状态过滤，并返回各分面的计数
+    每个分面的计数忽略该分面自身的过滤条件；结果缓存到模板或使用计数发生变化为止
+    """
+    tags = sorted({t for t in (tag or []) if t})
+    cache_key = (template_visibility_scope(current_user), category, tuple(tags), is_public, search)
+    cached = response_cache.get("get_template_facets", cache_key)
+    if cached is not None:
+        return cached
+    since = response_cache.clock
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        filters = template_facet_filters(current_user, category, tags, is_public, search)
         
-        templates = []
-        for row in rows:
-            templates.append({
-                "id": row[0],
-                "name": row[1],
-                "description": row[2],
-                "category": row[3],
-                "configData": json.loads(row[4]) if row[4] else {},
-                "variables": json.loads(row[5]) if row[5] else [],
-                "tags": json.loads(row[6]) if row[6] else [],
-                "isPublic": bool(row[7]),
-                "createdAt": row[8],
-                "updatedAt": row[9],
-                "version": row[10],
-                "usageCount": row[11],
-                "createdBy": row[12] or "Unknown",
-                "createdByName": row[13] or row[12] or "Unknown"
-            })
+        where, params = facet_where(filters)
+        cursor.execute(f'''
+            SELECT {TEMPLATE_SUMMARY_COLUMNS}
+            FROM templates t
+            LEFT JOIN users u ON t.created_by = u.id
+            WHERE {where}
+            ORDER BY t.usage_count DESC, t.created_at DESC
+        ''', params)
+        templates = [template_summary_from_row(row) for row in cursor.fetchall()]
+        
+        where, params = facet_where(filters, skip="category")
+        cursor.execute(f'''
+            SELECT t.category, COUNT(*) FROM templates t
+            WHERE {where} AND t.category IS NOT NULL
+            GROUP BY t.category ORDER BY COUNT(*) DESC, t.category ASC
+        ''', params)
+        categories = [{"value": row[0], "count": row[1]} for row in cursor.fetchall()]
+        
+        # 标签计数包含已选标签的条件，表示与已选标签同时出现的其他标签
+        where, params = facet_where(filters)
+        cursor.execute(f'''
+            SELECT g.tag, COUNT(*) FROM template_tags g
+            JOIN templates t ON t.template_id = g.template_id
+            WHERE {where}
+            GROUP BY g.tag ORDER BY COUNT(*) DESC, g.tag ASC
+        ''', params)
+        tag_counts = [{"value": row[0], "count": row[1], "selected": row[0] in tags} for row in cursor.fetchall()]
+        
+        where, params = facet_where(filters, skip="visibility")
+        cursor.execute(f"SELECT t.is_public, COUNT(*) FROM templates t WHERE {where} GROUP BY t.is_public", params)
+        visibility = {"public": 0, "private": 0}
+        for row in cursor.fetchall():
+            visibility["public" if row[0] else "private"] += row[1]
         
-        return templates
+        result = {
+            "total": len(templates),
+            "templates": templates,
+            "facets": {"categories": categories, "tags": tag_counts, "visibility": visibility}
+        }
+        # 列表包含 usageCount 并按使用次数排序，使用计数写入后同样失效
+        response_cache.put("get_template_facets", cache_key, result, ["templates", "template_usage"], since)
+        return result
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
         conn.close()
 
-@app.get("/api/templates/{template_id}")
-async def get_template(template_id: str, current_user: dict = Depends(get_current_user)):
-    """获取模板详情"""
-    conn = sqlite3.connect(DB_FILE)
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+TEMPLATE_IMPORT_CHUNK_SIZE = 100
+
+@app.get("/api/templates/export")
+async def export_templates(category: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    """以 NDJSON 流导出可见的模板（每行一个模板）"""
+    user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
+    query = '''
+        SELECT t.template_id, t.name, t.description, t.category, t.is_public, t.version,
+               t.config_data, t.variables, t.tags, v.content_hash
+        FROM templates t
+        LEFT JOIN template_versions v ON v.template_id = t.template_id AND v.version = t.version
+        WHERE 1=1
+    '''
+    params = []
+    if not is_rakwireless(user_role):
+        query += " AND (t.is_public = 1 OR t.created_by = ?)"
+        params.append(current_user["id"])
+    if category:
+        query += " AND t.category = ?"
+        params.append(category)
+    query += " ORDER BY t.id ASC"
+    
+    def generate():
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(TEMPLATE_IMPORT_CHUNK_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    meta = json.dumps({
+                        "sourceId": row[0],
+                        "name": row[1],
+                        "description": row[2],
+                        "category": row[3],
+                        "isPublic": bool(row[4]),
+                        "version": row[5],
+                        "contentHash": row[9] or template_content_hash(row[6], row[7])
+                    }, ensure_ascii=False)
+                    # 已存储的JSON正文直接拼接到输出行中，不再解析和序列化
+                    yield (f'{meta[:-1]}, "configData": {row[6] or "{}"}, '
+                           f'"variables": {row[7] or "[]"}, "tags": {row[8] or "[]"}}}\n').encode()
+        finally:
+            conn.close()
+    
+    return StreamingResponse(generate(), media_type=NDJSON_MEDIA_TYPE,
+                             headers={"Content-Disposition": 'attachment; filename="templates.ndjson"'})
+
+def validate_template_record(record) -> dict:
+    """校验导入的模板记录，返回规范化后的字段；不合法时抛出 ValueError"""
+    if not isinstance(record, dict):
+        raise ValueError("Record must be a JSON object")
+    name = record.get("name")
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError("name is required")
+    config_data = record.get("configData")
+    if not isinstance(config_data, dict):
+        raise ValueError("configData must be an object")
+    variables = record.get("variables") or []
+    if not isinstance(variables, list) or not all(isinstance(v, dict) and v.get("name") for v in variables):
+        raise ValueError("variables must be a list of objects with a name")
+    tags = record.get("tags") or []
+    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+        raise ValueError("tags must be a list of strings")
+    description = record.get("description")
+    if description is not None and not isinstance(description, str):
+        raise ValueError("description must be a string")
+    schema_errors = validate_config_data(config_data, allow_placeholders=True)
+    if schema_errors:
+        raise ValueError("configData does not match the gateway config schema: " +
+                         "; ".join(f"{e['path']}: {e['message']}" for e in schema_errors[:5]))
+    config_json = json.dumps(config_data)
+    variables_json = json.dumps(variables)
+    return {
+        "name": name.strip(),
+        "description": description,
+        "category": record.get("category") or "Custom",
+        "config_data": config_json,
+        "variables": variables_json,
+        "tags": json.dumps(tags),
+        "is_public": 1 if record.get("isPublic") else 0,
+        "content_hash": template_content_hash(config_json, variables_json)
+    }
+
+def classify_template_records(cursor, records: list, current_user: dict) -> list:
+    """
+    按内容哈希匹配已有模板，决定每条记录是新建、更新元数据还是保持不变
+    同一批中内容相同的记录只导入一次（按最后一条的元数据），前面的重复记录计为 unchanged
+    返回 (动作, 记录, 匹配到的模板ID) 列表
+    """
+    hashes = sorted({record["content_hash"] for record in records})
+    placeholders = ",".join(["?" for _ in hashes])
+    cursor.execute(f'''
+        SELECT v.content_hash, t.template_id, t.name, t.description, t.category, t.tags, t.is_public, t.created_by
+        FROM templates t
+        JOIN template_versions v ON v.template_id = t.template_id AND v.version = t.version
+        WHERE v.content_hash IN ({placeholders})
+        ORDER BY t.id ASC
+    ''', hashes)
+    user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
+    existing = {}
+    for row in cursor.fetchall():
+        # 优先匹配当前用户可以修改的模板
+        can_update = row[7] == current_user["id"] or is_rakwireless(user_role)
+        if row[0] not in existing or (can_update and not existing[row[0]][1]):
+            existing[row[0]] = (row, can_update)
+    
+    last_index = {record["content_hash"]: index for index, record in enumerate(records)}
+    plan = []
+    for index, record in enumerate(records):
+        if last_index[record["content_hash"]] != index:
+            plan.append(("unchanged", record, None))
+            continue
+        match = existing.get(record["content_hash"])
+        if not match:
+            plan.append(("created", record, None))
+            continue
+        row, can_update = match
+        metadata_same = (row[2], row[3], row[4], row[5] or "[]", row[6]) == (
+            record["name"], record["description"], record["category"], record["tags"], record["is_public"])
+        if metadata_same or not can_update:
+            plan.append(("unchanged", record, row[1]))
+        else:
+            plan.append(("updated", record, row[1]))
+    return plan
+
+def apply_template_import_plan(cursor, plan: list, current_user: dict) -> list:
+    """执行导入计划（在写事务中调用），返回被更新的模板ID"""
+    updated_ids = []
+    for action, record, template_id in plan:
+        if action == "created":
+            template_id = f"TMP{str(uuid.uuid4())[:6].upper()}"
+            cursor.execute('''
+                INSERT INTO templates (template_id, name, description, category, config_data, variables, tags, is_public, created_by)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (template_id, record["name"], record["description"], record["category"], record["config_data"],
+                  record["variables"], record["tags"], record["is_public"], current_user["id"]))
+        elif action == "updated":
+            cursor.execute('''
+                UPDATE templates
+                SET name = ?, description = ?, category = ?, tags = ?, is_public = ?,
+                    updated_at = CURRENT_TIMESTAMP, version = COALESCE(version, 1) + 1
+                WHERE template_id = ?
+            ''', (record["name"], record["description"], record["category"], record["tags"],
+                  record["is_public"], template_id))
+            updated_ids.append(template_id)
+        else:
+            continue
+        snapshot_template_version(cursor, template_id, current_user["id"])
+        sync_template_tags(cursor, template_id, json.loads(record["tags"]))
+    return updated_ids
+
+@app.post("/api/templates/import")
+async def import_templates(
+    http_request: Request,
+    dry_run: bool = False,
+    chunk_size: int = TEMPLATE_IMPORT_CHUNK_SIZE,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    以 NDJSON 导入模板（每行一个模板，格式与导出一致）
+    按内容哈希去重，每个分块一个事务；响应为 NDJSON 进度流
+    """
+    chunk_size = max(1, min(chunk_size, 1000))
+    
+    # 先读完请求体（按行切分），再开始流式返回进度
+    lines = []
+    buffer = b""
+    async for chunk in http_request.stream():
+        buffer += chunk
+        *complete, buffer = buffer.split(b"\n")
+        lines.extend(complete)
+    if buffer.strip():
+        lines.append(buffer)
+    
+    async def generate():
+        totals = {"created": 0, "updated": 0, "unchanged": 0, "invalid": 0}
+        processed = 0
+        try:
+            for chunk_index, start in enumerate(range(0, len(lines), chunk_size)):
+                records, errors = [], []
+                for line_no, raw in enumerate(lines[start:start + chunk_size], start=start + 1):
+                    if not raw.strip():
+                        continue
+                    try:
+                        records.append(validate_template_record(json.loads(raw)))
+                    except ValueError as e:
+                        errors.append({"line": line_no, "error": str(e)})
+                processed += len(records) + len(errors)
+                totals["invalid"] += len(errors)
+                
+                counts = {"created": 0, "updated": 0, "unchanged": 0}
+                if records:
+                    if dry_run:
+                        conn = get_db_connection()
+                        try:
+                            plan = classify_template_records(conn.cursor(), records, current_user)
+                        finally:
+                            conn.close()
+                    else:
+                        def import_chunk(cursor, records=records):
+                            plan = classify_template_records(cursor, records, current_user)
+                            return plan, apply_template_import_plan(cursor, plan, current_user)
+                        plan, updated_ids = await activity_writer.run(import_chunk)
+                        for template_id in updated_ids:
+                            invalidate_template(template_id)
+                        bump_template_generation()
+                    for action, _, _ in plan:
+                        counts[action] += 1
+                        totals[action] += 1
+                
+                yield json.dumps({
+                    "chunk": chunk_index,
+                    "processed": processed,
+                    "total": len(lines),
+                    **counts,
+                    "errors": errors
+                }) + "\n"
+            
+            yield json.dumps({"done": True, "dryRun": dry_run, "processed": processed, **totals}) + "\n"
+        except Exception as e:
+            # 进度行已经以 200 发出，出错时写一行错误再结束，客户端据此判断导入未完成（已提交的分块保留）
+            print(f"❌ Template import failed after {processed} records: {e}")
+            yield json.dumps({"error": str(e), "dryRun": dry_run, "processed": processed, **totals}) + "\n"
+    
+    return StreamingResponse(generate(), media_type=NDJSON_MEDIA_TYPE)
+
+def build_my_templates(cursor, current_user: dict) -> dict:
+    """
+    一次查询取出用户收藏、自己创建和最近使用的模板（三个来源都走索引），
+    再在内存中分组
+    """
+    user_id = current_user["id"]
+    query = f'''
+        SELECT {TEMPLATE_SUMMARY_COLUMNS}, f.created_at as favorited_at, r.last_used_at
+        FROM templates t
+        LEFT JOIN users u ON t.created_by = u.id
+        LEFT JOIN template_favorites f ON f.template_id = t.template_id AND f.user_id = ?
+        LEFT JOIN template_usage_by_user r ON r.template_id = t.template_id AND r.used_by = ?
+        WHERE t.template_id IN (
+            SELECT template_id FROM template_favorites WHERE user_id = ?
+            UNION SELECT template_id FROM templates WHERE created_by = ?
+            UNION SELECT template_id FROM template_usage_by_user WHERE used_by = ?
+        )
+    '''
+    params = [user_id] * 5
+    user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
+    if not is_rakwireless(user_role):
+        query += " AND (t.is_public = 1 OR t.created_by = ?)"
+        params.append(user_id)
+    cursor.execute(query, params)
+    
+    favorites, own, recent = [], [], []
+    for row in cursor.fetchall():
+        template = template_summary_from_row(row)
+        template["isFavorite"] = row[14] is not None
+        template["lastUsedAt"] = row[15]
+        if row[14] is not None:
+            favorites.append((row[14], template))
+        if row[13] == user_id:
+            own.append(template)
+        if row[15] is not None:
+            recent.append(template)
+    favorites.sort(key=lambda item: item[0], reverse=True)
+    own.sort(key=lambda t: t["updatedAt"] or "", reverse=True)
+    recent.sort(key=lambda t: t["lastUsedAt"], reverse=True)
+    return {"favorites": [t for _, t in favorites], "own": own, "recent": recent}
+
+def load_my_templates(current_user: dict) -> dict:
+    """当前用户的"我的模板"（按用户缓存，模板代数变化或收藏、使用记录变化后重建）"""
+    cached = my_templates_cache.get(current_user["id"], template_generation)
+    if cached is None:
+        generation = template_generation
+        conn = get_db_connection()
+        try:
+            cached = build_my_templates(conn.cursor(), current_user)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        finally:
+            conn.close()
+        # 使用查询开始前的代数，查询期间发生的修改会让这条缓存立即过期
+        my_templates_cache.put(current_user["id"], generation, cached)
+    return cached
+
+def with_favorite_flags(templates: list, current_user: dict) -> list:
+    """列表缓存按可见范围共享，收藏标记按用户在返回前加上（不修改缓存中的对象）"""
+    favorite_ids = {t["id"] for t in load_my_templates(current_user)["favorites"]}
+    return [{**t, "isFavorite": t["id"] in favorite_ids} for t in templates]
+
+@app.get("/api/templates/mine")
+async def get_my_templates(recent_limit: int = 10, current_user: dict = Depends(get_current_user)):
+    """模板选择器用的"我的模板"：收藏、自己创建、最近使用（按用户缓存）"""
+    recent_limit = max(0, min(recent_limit, 100))
+    cached = load_my_templates(current_user)
+    return {**cached, "recent": cached["recent"][:recent_limit]}
+
+@app.post("/api/templates/{template_id}/favorite")
+async def favorite_template(template_id: str, current_user: dict = Depends(get_current_user)):
+    """收藏模板"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        check_template_access(cursor, template_id, current_user)
+        cursor.execute('''
+            INSERT OR IGNORE INTO template_favorites (template_id, user_id) VALUES (?, ?)
+        ''', (template_id, current_user["id"]))
+        conn.commit()
+        invalidate_my_templates([current_user["id"]])
+        return {"message": "Template added to favorites", "isFavorite": True}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
+@app.delete("/api/templates/{template_id}/favorite")
+async def unfavorite_template(template_id: str, current_user: dict = Depends(get_current_user)):
+    """取消收藏模板"""
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
         cursor.execute('''
-            SELECT t.template_id, t.name, t.description, t.category, t.config_data, t.variables,
-                   t.tags, t.is_public, t.created_at, t.updated_at, t.version, t.usage_count,
-                   u.email as created_by_email, u.name as created_by_name, t.created_by
+            DELETE FROM template_favorites WHERE template_id = ? AND user_id = ?
+        ''', (template_id, current_user["id"]))
+        conn.commit()
+        invalidate_my_templates([current_user["id"]])
+        return {"message": "Template removed from favorites", "isFavorite": False}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
+@app.get("/api/templates/stats")
+async def get_template_stats(
+    top: int = 10,
+    days: int = 30,
+    template_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """模板使用统计：热门模板和按天趋势（只读取汇总表）"""
+    top = max(1, min(top, 100))
+    days = max(1, min(days, 365))
+    since = (datetime.utcnow() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        # 可见性过滤与模板列表一致
+        user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
+        visibility = ""
+        visibility_params = []
+        if not is_rakwireless(user_role):
+            visibility = " AND (t.is_public = 1 OR t.created_by = ?)"
+            visibility_params.append(current_user["id"])
+        
+        if template_id:
+            check_template_access(cursor, template_id, current_user)
+        
+        # 累计使用最多的模板
+        cursor.execute(f'''
+            SELECT s.template_id, t.name, t.category, s.use_count, s.last_used_at
+            FROM template_usage_totals s
+            JOIN templates t ON s.template_id = t.template_id
+            WHERE 1=1{visibility}
+            ORDER BY s.use_count DESC
+            LIMIT ?
+        ''', visibility_params + [top])
+        top_all_time = [{
+            "id": row[0], "name": row[1], "category": row[2], "useCount": row[3], "lastUsedAt": row[4]
+        } for row in cursor.fetchall()]
+        
+        # 统计周期内使用最多的模板
+        cursor.execute(f'''
+            SELECT d.template_id, t.name, t.category, SUM(d.use_count) as period_count
+            FROM template_usage_daily d
+            JOIN templates t ON d.template_id = t.template_id
+            WHERE d.day >= ?{visibility}
+            GROUP BY d.template_id
+            ORDER BY period_count DESC
+            LIMIT ?
+        ''', [since] + visibility_params + [top])
+        top_in_period = [{
+            "id": row[0], "name": row[1], "category": row[2], "useCount": row[3]
+        } for row in cursor.fetchall()]
+        
+        # 按天趋势（指定模板或全部可见模板）
+        trend_query = f'''
+            SELECT d.day, SUM(d.use_count)
+            FROM template_usage_daily d
+            JOIN templates t ON d.template_id = t.template_id
+            WHERE d.day >= ?{visibility}
+        '''
+        trend_params = [since] + visibility_params
+        if template_id:
+            trend_query += " AND d.template_id = ?"
+            trend_params.append(template_id)
+        cursor.execute(trend_query + " GROUP BY d.day ORDER BY d.day ASC", trend_params)
+        trend = [{"day": row[0], "useCount": row[1]} for row in cursor.fetchall()]
+        
+        result = {"days": days, "top": top_all_time, "topInPeriod": top_in_period, "trend": trend}
+        
+        # 指定模板时，RAK Wireless 用户可以看到使用者排行
+        if template_id and is_rakwireless(user_role):
+            cursor.execute('''
+                SELECT u.email, u.name, s.use_count, s.last_used_at
+                FROM template_usage_by_user s
+                LEFT JOIN users u ON s.used_by = u.id
+                WHERE s.template_id = ?
+                ORDER BY s.use_count DESC
+                LIMIT ?
+            ''', (template_id, top))
+            result["topUsers"] = [{
+                "email": row[0], "name": row[1] or row[0], "useCount": row[2], "lastUsedAt": row[3]
+            } for row in cursor.fetchall()]
+        
+        return result
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
+@app.get("/api/templates/{template_id}")
+async def get_template(
+    template_id: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """获取模板详情（支持 If-None-Match 条件请求，正文从缓存读取）"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(f'''
+            SELECT {TEMPLATE_SUMMARY_COLUMNS}
             FROM templates t
             LEFT JOIN users u ON t.created_by = u.id
             WHERE t.template_id = ?
@@ -1968,30 +5415,28 @@ async def get_template(template_id: str, current_user: dict = Depends(get_curren
             raise HTTPException(status_code=404, detail="Template not found")
         
         # 权限检查
-        is_creator = row[14] == current_user["id"]
-        is_public = bool(row[7])
+        is_creator = row[13] == current_user["id"]
+        is_public = bool(row[5])
         user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
         user_is_rakwireless = is_rakwireless(user_role)
         
         if not is_creator and not is_public and not user_is_rakwireless:
             raise HTTPException(status_code=403, detail="Access denied")
         
-        return {
-            "id": row[0],
-            "name": row[1],
-            "description": row[2],
-            "category": row[3],
-            "configData": json.loads(row[4]) if row[4] else {},
-            "variables": json.loads(row[5]) if row[5] else [],
-            "tags": json.loads(row[6]) if row[6] else [],
-            "isPublic": bool(row[7]),
-            "createdAt": row[8],
-            "updatedAt": row[9],
-            "version": row[10],
-            "usageCount": row[11],
-            "createdBy": row[12] or "Unknown",
-            "createdByName": row[13] or row[12] or "Unknown"
-        }
+        # ETag 只跟随模板版本（usageCount 是统计值，不参与比较）
+        version = row[8] or 1
+        etag = make_etag(row[0], version)
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+        
+        template = template_summary_from_row(row)
+        body = load_template_bodies(cursor, {template_id: version}).get(template_id)
+        if body is None:
+            raise HTTPException(status_code=404, detail="Template not found")
+        template["configData"] = body["configData"]
+        template["variables"] = body["variables"]
+        return template
     except HTTPException:
         raise
     except Exception as e:
@@ -2003,15 +5448,17 @@ async def get_template(template_id: str, current_user: dict = Depends(get_curren
 async def update_template(
     template_id: str,
     template_data: TemplateUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     current_user: dict = Depends(get_current_user)
 ):
-    """更新模板"""
-    conn = sqlite3.connect(DB_FILE)
+    """更新模板（支持 If-Match 乐观并发控制）"""
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
         # 检查模板是否存在和权限
-        cursor.execute("SELECT created_by FROM templates WHERE template_id = ?", (template_id,))
+        cursor.execute("SELECT created_by, version FROM templates WHERE template_id = ?", (template_id,))
         row = cursor.fetchone()
         if not row:
             raise HTTPException(status_code=404, detail="Template not found")
@@ -2020,6 +5467,10 @@ async def update_template(
         if row[0] != current_user["id"] and not is_rakwireless(user_role):
             raise HTTPException(status_code=403, detail="Only template creator can update")
         
+        current_version = row[1] or 1
+        if if_match and not etag_matches(if_match, make_etag(template_id, current_version)):
+            raise HTTPException(status_code=412, detail="Template has been modified by someone else")
+        
         # 构建更新语句
         updates = []
         params = []
@@ -2037,6 +5488,7 @@ async def update_template(
             params.append(template_data.category)
         
         if template_data.configData is not None:
+            check_config_data(template_data.configData, allow_placeholders=True)
             updates.append("config_data = ?")
             params.append(json.dumps(template_data.configData))
         
@@ -2054,14 +5506,32 @@ async def update_template(
         
         if updates:
             updates.append("updated_at = CURRENT_TIMESTAMP")
-            updates.append("version = version + 1")
-            params.append(template_id)
+            updates.append("version = COALESCE(version, 1) + 1")
+            params.extend([template_id, current_version])
             
-            query = f"UPDATE templates SET {', '.join(updates)} WHERE template_id = ?"
+            # 版本号作为写入条件：读取之后被他人修改则不更新（旧数据的 version 可能为 NULL，按 1 处理）
+            query = f"UPDATE templates SET {', '.join(updates)} WHERE template_id = ? AND COALESCE(version, 1) = ?"
             cursor.execute(query, params)
+            if cursor.rowcount == 0:
+                conn.rollback()
+                raise HTTPException(status_code=412, detail="Template has been modified by someone else")
+            # 新版本的不可变快照与更新在同一事务中写入
+            snapshot_template_version(cursor, template_id, current_user["id"])
+            if template_data.tags is not None:
+                sync_template_tags(cursor, template_id, template_data.tags)
             conn.commit()
-        
-        return {"message": "Template updated successfully"}
+            current_version += 1
+            
+            # 新版本保存后重新编译（旧版本的缓存随之失效）
+            invalidate_template(template_id)
+            if template_data.configData is not None or template_data.variables is not None:
+                cursor.execute("SELECT config_data, variables FROM templates WHERE template_id = ?", (template_id,))
+                saved = cursor.fetchone()
+                compile_template(template_id, current_version, json.loads(saved[0]),
+                                 json.loads(saved[1]) if saved[1] else [])
+        
+        response.headers["ETag"] = make_etag(template_id, current_version)
+        return {"message": "Template updated successfully", "version": current_version}
     except HTTPException:
         raise
     except Exception as e:
@@ -2073,7 +5543,7 @@ async def update_template(
 @app.delete("/api/templates/{template_id}")
 async def delete_template(template_id: str, current_user: dict = Depends(get_current_user)):
     """删除模板"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -2090,8 +5560,23 @@ async def delete_template(template_id: str, current_user: dict = Depends(get_cur
         
         cursor.execute("DELETE FROM templates WHERE template_id = ?", (template_id,))
         cursor.execute("DELETE FROM template_favorites WHERE template_id = ?", (template_id,))
+        cursor.execute("DELETE FROM template_tags WHERE template_id = ?", (template_id,))
         cursor.execute("DELETE FROM template_usage WHERE template_id = ?", (template_id,))
+        # 版本内容按哈希在模板之间共享：只删除没有其他模板版本引用的内容
+        cursor.execute('''
+            DELETE FROM template_contents
+            WHERE content_hash IN (SELECT content_hash FROM template_versions WHERE template_id = ?)
+              AND NOT EXISTS (
+                  SELECT 1 FROM template_versions v
+                  WHERE v.content_hash = template_contents.content_hash AND v.template_id != ?
+              )
+        ''', (template_id, template_id))
+        cursor.execute("DELETE FROM template_versions WHERE template_id = ?", (template_id,))
+        cursor.execute("DELETE FROM template_usage_totals WHERE template_id = ?", (template_id,))
+        cursor.execute("DELETE FROM template_usage_daily WHERE template_id = ?", (template_id,))
+        cursor.execute("DELETE FROM template_usage_by_user WHERE template_id = ?", (template_id,))
         conn.commit()
+        invalidate_template(template_id)
         
         return {"message": "Template deleted successfully"}
     except HTTPException:
@@ -2102,6 +5587,196 @@ async def delete_template(template_id: str, current_user: dict = Depends(get_cur
     finally:
         conn.close()
 
+# ==================== Template Versions ====================
+
+def template_content_hash(config_data_json: str, variables_json: Optional[str]) -> str:
+    """模板内容哈希（configData + variables 的规范化JSON），用于快照去重"""
+    canonical = json.dumps({
+        "configData": json.loads(config_data_json) if config_data_json else {},
+        "variables": json.loads(variables_json) if variables_json else []
+    }, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def snapshot_template_version(cursor, template_id: str, user_id: int):
+    """
+    把模板当前内容写入不可变的版本快照
+    内容按哈希去重存入 template_contents，template_versions 只记录版本元数据
+    """
+    cursor.execute('''
+        SELECT version, name, description, category, config_data, variables, tags
+        FROM templates WHERE template_id = ?
+    ''', (template_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    content_hash = template_content_hash(row[4], row[5])
+    cursor.execute('''
+        INSERT OR IGNORE INTO template_contents (content_hash, config_data, variables)
+        VALUES (?, ?, ?)
+    ''', (content_hash, row[4], row[5] or "[]"))
+    cursor.execute('''
+        INSERT OR IGNORE INTO template_versions (template_id, version, content_hash, name, description, category, tags, created_by)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (template_id, row[0] or 1, content_hash, row[1], row[2], row[3], row[6], user_id))
+    return content_hash
+
+def diff_json(old, new, path: str = "") -> list:
+    """比较两个JSON值，返回 JSON Pointer 路径上的 added / removed / changed 列表"""
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes = []
+        for key in sorted(set(old) | set(new), key=str):
+            child = f"{path}/{str(key).replace('~', '~0').replace('/', '~1')}"
+            if key not in new:
+                changes.append({"op": "removed", "path": child, "old": old[key]})
+            elif key not in old:
+                changes.append({"op": "added", "path": child, "new": new[key]})
+            else:
+                changes.extend(diff_json(old[key], new[key], child))
+        return changes
+    if old != new:
+        return [{"op": "changed", "path": path or "/", "old": old, "new": new}]
+    return []
+
+# 版本快照不可变，可以被客户端永久缓存
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+def check_template_access(cursor, template_id: str, current_user: dict):
+    """检查当前用户是否可以查看模板（创建者、公开模板或 RAK Wireless）"""
+    cursor.execute("SELECT created_by, is_public FROM templates WHERE template_id = ?", (template_id,))
+    row = cursor.fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail="Template not found")
+    user_role = current_user.get('role') or get_user_role(current_user.get('email', ''))
+    if row[0] != current_user["id"] and not row[1] and not is_rakwireless(user_role):
+        raise HTTPException(status_code=403, detail="Access denied")
+
+def load_template_version(cursor, template_id: str, version: int) -> dict:
+    cursor.execute('''
+        SELECT v.version, v.content_hash, v.name, v.description, v.category, v.tags, v.created_at,
+               c.config_data, c.variables, u.email
+        FROM template_versions v
+        JOIN template_contents c ON v.content_hash = c.content_hash
+        LEFT JOIN users u ON v.created_by = u.id
+        WHERE v.template_id = ? AND v.version = ?
+    ''', (template_id, version))
+    row = cursor.fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail=f"Template version {version} not found")
+    return {
+        "id": template_id,
+        "version": row[0],
+        "contentHash": row[1],
+        "name": row[2],
+        "description": row[3],
+        "category": row[4],
+        "tags": json.loads(row[5]) if row[5] else [],
+        "createdAt": row[6],
+        "configData": json.loads(row[7]) if row[7] else {},
+        "variables": json.loads(row[8]) if row[8] else [],
+        "createdBy": row[9] or "Unknown"
+    }
+
+@app.get("/api/templates/{template_id}/versions")
+async def get_template_versions(template_id: str, current_user: dict = Depends(get_current_user)):
+    """获取模板的版本列表"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        check_template_access(cursor, template_id, current_user)
+        cursor.execute('''
+            SELECT v.version, v.content_hash, v.name, v.created_at, u.email, u.name
+            FROM template_versions v
+            LEFT JOIN users u ON v.created_by = u.id
+            WHERE v.template_id = ?
+            ORDER BY v.version DESC
+        ''', (template_id,))
+        return [{
+            "version": row[0],
+            "contentHash": row[1],
+            "name": row[2],
+            "createdAt": row[3],
+            "createdBy": row[4] or "Unknown",
+            "createdByName": row[5] or row[4] or "Unknown"
+        } for row in cursor.fetchall()]
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
+@app.get("/api/templates/{template_id}/versions/{version}")
+async def get_template_version(
+    template_id: str,
+    version: int,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """获取模板某个版本的快照（不可变，可永久缓存）"""
+    etag = make_etag(template_id, version)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        check_template_access(cursor, template_id, current_user)
+        if etag_matches(if_none_match, etag):
+            # 只对存在的版本返回 304（If-None-Match: * 或猜测的 ETag 不能掩盖 404）
+            cursor.execute("SELECT 1 FROM template_versions WHERE template_id = ? AND version = ?",
+                           (template_id, version))
+            if not cursor.fetchone():
+                raise HTTPException(status_code=404, detail=f"Template version {version} not found")
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL})
+        snapshot = load_template_version(cursor, template_id, version)
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        return snapshot
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
+@app.get("/api/templates/{template_id}/versions/{version}/diff")
+async def diff_template_versions(
+    template_id: str,
+    version: int,
+    response: Response,
+    against: Optional[int] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """比较模板两个版本（默认与上一个版本比较）"""
+    against = against if against is not None else version - 1
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        check_template_access(cursor, template_id, current_user)
+        new = load_template_version(cursor, template_id, version)
+        old = load_template_version(cursor, template_id, against)
+        # 两个版本都不可变，比较结果同样可以永久缓存
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        return {
+            "id": template_id,
+            "from": against,
+            "to": version,
+            "sameContent": old["contentHash"] == new["contentHash"],
+            "metadata": diff_json(
+                {k: old[k] for k in ("name", "description", "category", "tags")},
+                {k: new[k] for k in ("name", "description", "category", "tags")}
+            ),
+            "configData": [] if old["contentHash"] == new["contentHash"] else diff_json(old["configData"], new["configData"]),
+            "variables": [] if old["contentHash"] == new["contentHash"] else diff_json(old["variables"], new["variables"])
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
 @app.post("/api/templates/{template_id}/apply")
 async def apply_template(
     template_id: str,
@@ -2109,58 +5784,148 @@ async def apply_template(
     current_user: dict = Depends(get_current_user)
 ):
     """应用模板（记录使用次数）"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        # 获取模板
-        cursor.execute("SELECT config_data, variables FROM templates WHERE template_id = ?", (template_id,))
-        row = cursor.fetchone()
-        if not row:
+        # 获取预编译的模板（按版本缓存）
+        compiled = get_compiled_template(cursor, template_id)
+        if compiled is None:
             raise HTTPException(status_code=404, detail="Template not found")
         
-        # 增加使用次数
-        cursor.execute("UPDATE templates SET usage_count = usage_count + 1 WHERE template_id = ?", (template_id,))
+        # 替换变量：只处理占位符所在的位置（兼容原有行为：不校验变量，未传的变量替换为空字符串）
+        config_data_with_values = compiled.render(variable_values, strict=False)
         
-        # 记录使用历史
-        cursor.execute('''
-            INSERT INTO template_usage (template_id, used_by, variables_used)
-            VALUES (?, ?, ?)
-        ''', (template_id, current_user["id"], json.dumps(variable_values)))
-        
-        conn.commit()
+        # 使用次数和使用历史先进入内存缓冲，由后台批量写入（不占用写锁）
+        template_usage_buffer.record(template_id, current_user["id"], variable_values, compiled.version)
         
-        # 返回配置数据（变量已替换）
-        config_data = json.loads(row[0])
-        variables = json.loads(row[1]) if row[1] else []
-        
-        # 替换变量
-        def replace_vars(obj):
-            if isinstance(obj, dict):
-                return {k: replace_vars(v) for k, v in obj.items()}
-            elif isinstance(obj, list):
-                return [replace_vars(item) for item in obj]
-            elif isinstance(obj, str):
-                result = obj
-                for var in variables:
-                    var_name = var.get("name", "")
-                    placeholder = f"{{{{{var_name}}}}}"
-                    if placeholder in result:
-                        result = result.replace(placeholder, variable_values.get(var_name, ""))
-                return result
-            return obj
-        
-        config_data_with_values = replace_vars(config_data)
-        
-        return {"configData": config_data_with_values}
+        return {"configData": config_data_with_values, "version": compiled.version}
     except HTTPException:
         raise
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
     finally:
         conn.close()
 
+INSTANTIATE_MAX_ROWS = int(os.getenv("INSTANTIATE_MAX_ROWS", "1000"))
+INSTANTIATE_CHUNK_SIZE = int(os.getenv("INSTANTIATE_CHUNK_SIZE", "100"))
+# 变量行中的保留列，其余列都作为模板变量
+INSTANTIATE_RESERVED_COLUMNS = ("companyName", "rakId")
+
+def parse_instantiate_body(body: bytes, content_type: str) -> dict:
+    """
+    解析批量实例化的请求体，统一为 {"rows": [...], "companyName", "rakId", "tags"}
+    支持 CSV（首行为列名）、JSON 数组，或带 rows 字段的 JSON 对象
+    """
+    text = body.decode("utf-8-sig")
+    if "csv" in content_type:
+        reader = csv.DictReader(io.StringIO(text))
+        rows = [{(key or "").strip(): (value or "").strip() for key, value in row.items() if key}
+                for row in reader]
+        return {"rows": rows}
+    payload = json.loads(text)
+    if isinstance(payload, list):
+        payload = {"rows": payload}
+    if not isinstance(payload, dict) or not isinstance(payload.get("rows"), list):
+        raise ValueError("Body must be a CSV, a JSON array of rows, or an object with a rows array")
+    if not all(isinstance(row, dict) for row in payload["rows"]):
+        raise ValueError("Each row must be a JSON object")
+    return payload
+
+@app.post("/api/templates/{template_id}/instantiate")
+async def instantiate_template(
+    template_id: str,
+    http_request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    用一个模板批量创建请求：每行变量值渲染出一个请求的配置
+    先校验全部行，再按块插入请求和创建活动（每块一个事务）
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        check_template_access(cursor, template_id, current_user)
+        compiled = get_compiled_template(cursor, template_id)
+        if compiled is None:
+            raise HTTPException(status_code=404, detail="Template not found")
+    finally:
+        conn.close()
+    
+    try:
+        payload = parse_instantiate_body(await http_request.body(), http_request.headers.get("content-type", ""))
+    except (ValueError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid body: {e}")
+    
+    rows = payload["rows"]
+    if not rows:
+        raise HTTPException(status_code=400, detail="No rows to instantiate")
+    if len(rows) > INSTANTIATE_MAX_ROWS:
+        raise HTTPException(status_code=400, detail=f"Too many rows (max {INSTANTIATE_MAX_ROWS})")
+    
+    tags_json = json.dumps(payload.get("tags") or [])
+    submit_time = datetime.now().isoformat()
+    creator_name = current_user.get("name") or current_user.get("email", "Unknown")
+    
+    # 先渲染并校验所有行，任何一行不合法都不创建
+    prepared, errors = [], []
+    for index, row in enumerate(rows):
+        variables = {key: value for key, value in row.items() if key not in INSTANTIATE_RESERVED_COLUMNS}
+        try:
+            config_data = compiled.render(variables)
+        except TemplateRenderError as e:
+            errors.append({"row": index, "missing": e.missing, "unknown": e.unknown})
+            continue
+        schema_errors = validate_config_data(config_data)
+        if schema_errors:
+            errors.append({"row": index, "schemaErrors": schema_errors})
+            continue
+        general = config_data.get("general") or {}
+        company_name = row.get("companyName") or payload.get("companyName") or general.get("customerName") or "Unnamed"
+        rak_id = row.get("rakId") or payload.get("rakId") or general.get("rakId") or ""
+        prepared.append((f"REQ{str(uuid.uuid4())[:6].upper()}", company_name, str(rak_id), config_data, variables))
+    
+    if errors:
+        raise HTTPException(status_code=400, detail={
+            "message": "Invalid template variables",
+            "errors": errors
+        })
+    
+    created = []
+    for start in range(0, len(prepared), INSTANTIATE_CHUNK_SIZE):
+        chunk = prepared[start:start + INSTANTIATE_CHUNK_SIZE]
+        
+        def insert_chunk(cursor, chunk=chunk):
+            cursor.executemany('''
+                INSERT INTO requests (request_id, company_name, rak_id, submit_time, status, assignee, config_data, changes, original_config, tags, user_id)
+                VALUES (?, ?, ?, ?, 'Open', '', ?, '{}', '{}', ?, ?)
+            ''', [(request_id, company_name, rak_id, submit_time, json.dumps(config_data), tags_json, current_user["id"])
+                  for request_id, company_name, rak_id, config_data, _ in chunk])
+            insert_activities(cursor, [
+                (request_id, current_user["id"], "created",
+                 f"Request created by {creator_name} for {company_name} from template {template_id}")
+                for request_id, company_name, _, _, _ in chunk
+            ])
+        
+        try:
+            await activity_writer.run(insert_chunk)
+        except Exception as e:
+            print(f"❌ Error instantiating template {template_id}: {str(e)}")
+            # 已提交的块保留，返回已创建的请求ID
+            raise HTTPException(status_code=500, detail={"message": str(e), "created": created})
+        created.extend(request_id for request_id, _, _, _, _ in chunk)
+        for _, _, _, _, variables in chunk:
+            template_usage_buffer.record(template_id, current_user["id"], variables, compiled.version)
+    
+    print(f"✅ Instantiated template {template_id}: {len(created)} requests")
+    return {
+        "message": f"Created {len(created)} requests from template",
+        "template_id": template_id,
+        "version": compiled.version,
+        "request_ids": created
+    }
+
 # ==================== Admin Management API ====================
 
 class UserRoleUpdate(BaseModel):
@@ -2186,7 +5951,7 @@ async def get_user(user_id: int, current_user: dict = Depends(get_current_user))
     if not is_rakwireless(user_role):
         raise HTTPException(status_code=403, detail="Permission denied")
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -2220,13 +5985,26 @@ async def get_all_users(current_user: dict = Depends(get_current_user)):
     )
 
 if __name__ == "__main__":
+    import argparse
+    
+    # 多工作进程：python main_simple.py --workers 4
+    # 也可以使用 gunicorn（需设置 CLUSTER_BUS=1 和 RATE_LIMIT_BACKEND=sqlite）：
+    #   gunicorn -k uvicorn.workers.UvicornWorker -w 4 -b 0.0.0.0:8000 main_simple:app
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WORKERS", "1")))
+    args = parser.parse_args()
+    workers = max(1, args.workers)
+    # 工作进程重新导入本模块，通过环境变量传递部署模式
+    os.environ["APP_WORKERS"] = str(workers)
+    if workers > 1:
+        os.environ.setdefault("RATE_LIMIT_BACKEND", "sqlite")
+    
     print("Starting Auth Prototype Simple Backend...")
     print("Database: SQLite")
     print("API: http://localhost:8000")
     print("API docs: http://localhost:8000/docs")
     
-    # 初始化数据库
-    init_database()
+    # 数据库在每个工作进程的 startup 事件中初始化（init_database_on_startup）
     
     import uvicorn
     import socket
@@ -2249,9 +6027,11 @@ if __name__ == "__main__":
     print(f"📱 局域网访问地址: http://{local_ip}:8000")
     print(f"📚 API文档地址: http://{local_ip}:8000/docs")
     print(f"🔗 登录接口地址: http://{local_ip}:8000/api/auth/login")
+    print(f"👷 工作进程数: {workers}")
     
     uvicorn.run(
-        app, 
+        app if workers == 1 else "main_simple:app",  # 多进程时必须传入导入字符串
+        workers=workers,
         host="0.0.0.0",  # 绑定到所有网络接口
         port=8000,
         timeout_keep_alive=30,  # 保持连接30秒
@@ -1,6 +1,7 @@
 import React, { useState, useEffect, useRef } from 'react'
 import { MessageCircle, Send, Trash2, User, Paperclip, X, Download } from 'lucide-react'
 import { useAuthStore } from '../stores/authStore'
+import { authFetch } from '../services/api'
 import { useToast } from '../hooks/useToast'
 import ToastContainer from './ToastContainer'
 
@@ -56,9 +57,8 @@ const Comments: React.FC<CommentsProps> = ({ requestId }) => {
     setLoading(true)
     try {
       console.log('Comments - Token:', token ? token.substring(0, 20) + '...' : 'null')
-      const response = await fetch(`${getApiBaseUrl()}/api/requests/${requestId}/comments`, {
+      const response = await authFetch(`${getApiBaseUrl()}/api/requests/${requestId}/comments`, {
         headers: {
-          'Authorization': `Bearer ${token}`,
           'Content-Type': 'application/json'
         }
       })
@@ -97,11 +97,8 @@ const Comments: React.FC<CommentsProps> = ({ requestId }) => {
         const formData = new FormData()
         formData.append('file', file)
 
-        const response = await fetch(`${getApiBaseUrl()}/api/files/upload`, {
+        const response = await authFetch(`${getApiBaseUrl()}/api/files/upload`, {
           method: 'POST',
-          headers: {
-            'Authorization': `Bearer ${token}`
-          },
           body: formData
         })
 
@@ -144,11 +141,7 @@ const Comments: React.FC<CommentsProps> = ({ requestId }) => {
   const handleDownloadFile = async (fileId: string) => {
     try {
       console.log('Downloading file:', fileId)
-      const response = await fetch(`${getApiBaseUrl()}/api/files/${fileId}`, {
-        headers: {
-          'Authorization': `Bearer ${token}`
-        }
-      })
+      const response = await authFetch(`${getApiBaseUrl()}/api/files/${fileId}`)
 
       if (response.ok) {
         const blob = await response.blob()
@@ -198,10 +191,9 @@ const Comments: React.FC<CommentsProps> = ({ requestId }) => {
 
     setSubmitting(true)
     try {
-      const response = await fetch(`${getApiBaseUrl()}/api/requests/${requestId}/comments`, {
+      const response = await authFetch(`${getApiBaseUrl()}/api/requests/${requestId}/comments`, {
         method: 'POST',
         headers: {
-          'Authorization': `Bearer ${token}`,
           'Content-Type': 'application/json'
         },
         body: JSON.stringify({ 
@@ -232,10 +224,9 @@ const Comments: React.FC<CommentsProps> = ({ requestId }) => {
     if (!confirm('Are you sure you want to delete this comment?')) return
 
     try {
-      const response = await fetch(`${getApiBaseUrl()}/api/requests/${requestId}/comments/${commentId}`, {
+      const response = await authFetch(`${getApiBaseUrl()}/api/requests/${requestId}/comments/${commentId}`, {
         method: 'DELETE',
         headers: {
-          'Authorization': `Bearer ${token}`,
           'Content-Type': 'application/json'
         }
       })
@@ -1,6 +1,7 @@
 import React, { useState, useEffect } from 'react'
 import { Clock, User, ArrowRight, CheckCircle, UserPlus, UserMinus, MessageCircle } from 'lucide-react'
 import { useAuthStore } from '../stores/authStore'
+import { authFetch } from '../services/api'
 
 interface HistoryItem {
   id: number
@@ -41,9 +42,8 @@ const History: React.FC<HistoryProps> = ({ requestId }) => {
   const loadHistory = async () => {
     setLoading(true)
     try {
-      const response = await fetch(`${getApiBaseUrl()}/api/requests/${requestId}/activities`, {
+      const response = await authFetch(`${getApiBaseUrl()}/api/requests/${requestId}/activities`, {
         headers: {
-          'Authorization': `Bearer ${token}`,
           'Content-Type': 'application/json'
         }
       })
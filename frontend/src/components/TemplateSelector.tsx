@@ -1,5 +1,5 @@
 import { useState, useEffect } from 'react'
-import { templateAPI, Template } from '../services/api'
+import { templateAPI, Template, TemplateSummary } from '../services/api'
 import { applyTemplateToForm, validateTemplateVariables } from '../utils/templateUtils'
 
 interface TemplateSelectorProps {
@@ -9,7 +9,8 @@ interface TemplateSelectorProps {
 }
 
 const TemplateSelector = ({ isOpen, onClose, onSelect }: TemplateSelectorProps) => {
-  const [templates, setTemplates] = useState<Template[]>([])
+  const [templates, setTemplates] = useState<TemplateSummary[]>([])
+  const [favoriteIds, setFavoriteIds] = useState<Set<string>>(new Set())
   const [loading, setLoading] = useState(false)
   const [selectedTemplate, setSelectedTemplate] = useState<Template | null>(null)
   const [variableValues, setVariableValues] = useState<Record<string, string>>({})
@@ -27,8 +28,10 @@ const TemplateSelector = ({ isOpen, onClose, onSelect }: TemplateSelectorProps)
     try {
       const params: any = {}
       if (searchQuery) params.search = searchQuery
-      const data = await templateAPI.getTemplates(params)
+      // 摘要列表已带收藏标记，打开选择器只需一次请求
+      const data = await templateAPI.getTemplateSummaries(params)
       setTemplates(data)
+      setFavoriteIds(new Set(data.filter(t => t.isFavorite).map(t => t.id)))
     } catch (err: any) {
       setError(err.message || 'Failed to load templates')
     } finally {
@@ -36,15 +39,38 @@ const TemplateSelector = ({ isOpen, onClose, onSelect }: TemplateSelectorProps)
     }
   }
 
-  const handleTemplateSelect = (template: Template) => {
-    setSelectedTemplate(template)
-    // 初始化变量值
-    const initialValues: Record<string, string> = {}
-    template.variables.forEach(variable => {
-      initialValues[variable.name] = variable.defaultValue || ''
-    })
-    setVariableValues(initialValues)
+  const handleTemplateSelect = async (summary: TemplateSummary) => {
     setError('')
+    try {
+      // 列表只有摘要，选中后再获取完整模板
+      const template: Template = await templateAPI.getTemplate(summary.id)
+      setSelectedTemplate(template)
+      // 初始化变量值
+      const initialValues: Record<string, string> = {}
+      template.variables.forEach(variable => {
+        initialValues[variable.name] = variable.defaultValue || ''
+      })
+      setVariableValues(initialValues)
+    } catch (err: any) {
+      setError(err.message || 'Failed to load template')
+    }
+  }
+
+  const toggleFavorite = async (e: React.MouseEvent, templateId: string) => {
+    e.stopPropagation()
+    const isFavorite = favoriteIds.has(templateId)
+    try {
+      if (isFavorite) {
+        await templateAPI.unfavoriteTemplate(templateId)
+      } else {
+        await templateAPI.favoriteTemplate(templateId)
+      }
+      const next = new Set(favoriteIds)
+      isFavorite ? next.delete(templateId) : next.add(templateId)
+      setFavoriteIds(next)
+    } catch (err: any) {
+      setError(err.message || 'Failed to update favorite')
+    }
   }
 
   const handleApply = async () => {
@@ -83,7 +109,7 @@ const TemplateSelector = ({ isOpen, onClose, onSelect }: TemplateSelectorProps)
       )
     }
     return true
-  })
+  }).sort((a, b) => Number(favoriteIds.has(b.id)) - Number(favoriteIds.has(a.id)))
 
   if (!isOpen) return null
 
@@ -183,9 +209,25 @@ const TemplateSelector = ({ isOpen, onClose, onSelect }: TemplateSelectorProps)
                       e.currentTarget.style.boxShadow = 'none'
                     }}
                   >
-                    <h3 style={{ margin: '0 0 8px 0', fontSize: '16px', fontWeight: '600' }}>
-                      {template.name}
-                    </h3>
+                    <div style={{ display: 'flex', justifyContent: 'space-between', alignItems: 'flex-start' }}>
+                      <h3 style={{ margin: '0 0 8px 0', fontSize: '16px', fontWeight: '600' }}>
+                        {template.name}
+                      </h3>
+                      <button
+                        onClick={(e) => toggleFavorite(e, template.id)}
+                        title={favoriteIds.has(template.id) ? 'Remove from favorites' : 'Add to favorites'}
+                        style={{
+                          background: 'transparent',
+                          border: 'none',
+                          cursor: 'pointer',
+                          fontSize: '18px',
+                          lineHeight: 1,
+                          color: favoriteIds.has(template.id) ? '#f59e0b' : '#d1d5db'
+                        }}
+                      >
+                        ★
+                      </button>
+                    </div>
                     {template.description && (
                       <p style={{ margin: '0 0 8px 0', fontSize: '14px', color: '#6b7280' }}>
                         {template.description}
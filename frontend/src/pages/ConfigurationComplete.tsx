@@ -1,6 +1,6 @@
 import React, { useState, useEffect, useCallback } from 'react'
 import { useNavigate, useSearchParams } from 'react-router-dom'
-import { requestAPI, templateAPI } from '../services/api'
+import { requestAPI, templateAPI, authAPI, authFetch } from '../services/api'
 import { useAuthStore } from '../stores/authStore'
 import { useQuery } from 'react-query'
 import { X, Edit2, Plus } from 'lucide-react'
@@ -938,11 +938,8 @@ const ConfigurationComplete = () => {
         const formData = new FormData();
         formData.append('file', file);
         
-        const response = await fetch('http://localhost:8000/api/files/upload', {
+        const response = await authFetch('http://localhost:8000/api/files/upload', {
           method: 'POST',
-          headers: {
-            'Authorization': `Bearer ${useAuthStore.getState().token}`
-          },
           body: formData
         });
         
@@ -982,11 +979,8 @@ const ConfigurationComplete = () => {
         const formData = new FormData();
         formData.append('file', file);
         
-        const response = await fetch('http://localhost:8000/api/files/upload', {
+        const response = await authFetch('http://localhost:8000/api/files/upload', {
           method: 'POST',
-          headers: {
-            'Authorization': `Bearer ${useAuthStore.getState().token}`
-          },
           body: formData
         });
         
@@ -1026,11 +1020,8 @@ const ConfigurationComplete = () => {
         const formData = new FormData();
         formData.append('file', file);
         
-        const response = await fetch('http://localhost:8000/api/files/upload', {
+        const response = await authFetch('http://localhost:8000/api/files/upload', {
           method: 'POST',
-          headers: {
-            'Authorization': `Bearer ${useAuthStore.getState().token}`
-          },
           body: formData
         });
         
@@ -1070,11 +1061,8 @@ const ConfigurationComplete = () => {
         const formData = new FormData();
         formData.append('file', file);
         
-        const response = await fetch('http://localhost:8000/api/files/upload', {
+        const response = await authFetch('http://localhost:8000/api/files/upload', {
           method: 'POST',
-          headers: {
-            'Authorization': `Bearer ${useAuthStore.getState().token}`
-          },
           body: formData
         });
         
@@ -1114,11 +1102,8 @@ const ConfigurationComplete = () => {
         const formData = new FormData();
         formData.append('file', file);
         
-        const response = await fetch('http://localhost:8000/api/files/upload', {
+        const response = await authFetch('http://localhost:8000/api/files/upload', {
           method: 'POST',
-          headers: {
-            'Authorization': `Bearer ${useAuthStore.getState().token}`
-          },
           body: formData
         });
         
@@ -1159,11 +1144,8 @@ const ConfigurationComplete = () => {
         const formData = new FormData();
         formData.append('file', file);
         
-        const response = await fetch('http://localhost:8000/api/files/upload', {
+        const response = await authFetch('http://localhost:8000/api/files/upload', {
           method: 'POST',
-          headers: {
-            'Authorization': `Bearer ${useAuthStore.getState().token}`
-          },
           body: formData
         });
         
@@ -1203,11 +1185,8 @@ const ConfigurationComplete = () => {
         const formData = new FormData();
         formData.append('file', file);
         
-        const response = await fetch('http://localhost:8000/api/files/upload', {
+        const response = await authFetch('http://localhost:8000/api/files/upload', {
           method: 'POST',
-          headers: {
-            'Authorization': `Bearer ${useAuthStore.getState().token}`
-          },
           body: formData
         });
         
@@ -1247,11 +1226,8 @@ const ConfigurationComplete = () => {
         const formData = new FormData();
         formData.append('file', file);
         
-        const response = await fetch('http://localhost:8000/api/files/upload', {
+        const response = await authFetch('http://localhost:8000/api/files/upload', {
           method: 'POST',
-          headers: {
-            'Authorization': `Bearer ${useAuthStore.getState().token}`
-          },
           body: formData
         });
         
@@ -1890,8 +1866,8 @@ const ConfigurationComplete = () => {
               })()}
             </span>
             <button
-              onClick={() => {
-                useAuthStore.getState().logout()
+              onClick={async () => {
+                await authAPI.logout()
                 navigate('/login')
               }}
               style={{
@@ -6216,11 +6192,8 @@ const ConfigurationComplete = () => {
                               const formDataObj = new FormData();
                               formDataObj.append('file', file);
                               
-                              const response = await fetch(`${getApiBaseUrl()}/api/files/upload`, {
+                              const response = await authFetch(`${getApiBaseUrl()}/api/files/upload`, {
                                 method: 'POST',
-                                headers: {
-                                  'Authorization': `Bearer ${useAuthStore.getState().token}`
-                                },
                                 body: formDataObj
                               });
                               
@@ -6442,11 +6415,8 @@ const ConfigurationComplete = () => {
                               const formData = new FormData();
                               formData.append('file', file);
                               
-                              const response = await fetch('http://localhost:8000/api/files/upload', {
+                              const response = await authFetch('http://localhost:8000/api/files/upload', {
                                 method: 'POST',
-                                headers: {
-                                  'Authorization': `Bearer ${useAuthStore.getState().token}`
-                                },
                                 body: formData
                               });
                               
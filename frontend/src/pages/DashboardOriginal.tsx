@@ -1,7 +1,7 @@
 import { useState, useEffect } from 'react'
 import { useAuthStore } from '../stores/authStore'
 import { useNavigate } from 'react-router-dom'
-import { requestAPI } from '../services/api'
+import { requestAPI, authAPI } from '../services/api'
 import AssignmentNotification from '../components/AssignmentNotification'
 import AdvancedSearch, { AdvancedSearchConfig } from '../components/AdvancedSearch'
 import { matchesSearchConfig } from '../utils/searchUtils'
@@ -37,7 +37,7 @@ const DashboardOriginal = () => {
   // 标签筛选状态
   const [selectedTags, setSelectedTags] = useState<Set<string>>(new Set())
   const [isExporting, setIsExporting] = useState(false)
-  const { user, logout } = useAuthStore()
+  const { user } = useAuthStore()
   const navigate = useNavigate()
   const { toasts, showError, removeToast } = useToast()
 
@@ -294,8 +294,8 @@ const DashboardOriginal = () => {
     }
   }
 
-  const handleLogout = () => {
-    logout()
+  const handleLogout = async () => {
+    await authAPI.logout()
     navigate('/login')
   }
 
@@ -40,7 +40,7 @@ const LoginOriginal = () => {
       } else {
         // 登录现有用户
         const response = await authAPI.login({ email, password })
-        login(response.access_token, response.user)
+        login(response.access_token, response.user, response.refresh_token)
       }
     } catch (err: any) {
       setError(err.response?.data?.detail || (isRegisterMode ? 'Registration failed' : 'Login failed'))
@@ -1,6 +1,6 @@
 import { useParams, useNavigate } from 'react-router-dom'
 import { useQuery } from 'react-query'
-import { requestAPI, Request } from '../services/api'
+import { requestAPI, RequestBundle, authFetch } from '../services/api'
 import { useAuthStore } from '../stores/authStore'
 import Comments from '../components/Comments'
 import History from '../components/History'
@@ -30,37 +30,27 @@ import {
   User,
   FileDown
 } from 'lucide-react'
-import { useState, useEffect } from 'react'
+import { useState } from 'react'
 
 const RequestDetails = () => {
   const { id } = useParams<{ id: string }>()
   const navigate = useNavigate()
   const { toasts, showError, showSuccess, removeToast } = useToast()
   const [activeSection, setActiveSection] = useState('overview')
-  const [users, setUsers] = useState<any[]>([])
   const [isExporting, setIsExporting] = useState(false)
 
-  const { data: request, isLoading, error } = useQuery<Request>(
-    ['request', id],
-    () => requestAPI.getRequest(id!),
+  // 一次请求获取请求详情和可分配用户列表
+  const { data: bundle, isLoading, error } = useQuery<RequestBundle>(
+    ['requestBundle', id],
+    () => requestAPI.getRequestBundle(id!, ['request', 'users']),
     { 
       enabled: !!id,
       retry: false // 不重试403错误
     }
   )
-
-  // 加载用户列表（用于显示分配人员）
-  useEffect(() => {
-    const loadUsers = async () => {
-      try {
-        const data = await requestAPI.getUsers()
-        setUsers(data)
-      } catch (error) {
-        console.error('Failed to load users:', error)
-      }
-    }
-    loadUsers()
-  }, [])
+  const request = bundle?.request
+  // 非 RAK Wireless 用户不返回用户列表
+  const users: any[] = bundle?.users || []
 
   // 获取分配人员显示名称
   const getAssigneeDisplay = () => {
@@ -375,10 +365,9 @@ const RequestDetails = () => {
         return null
       }
       
-      const response = await fetch(`${getApiBaseUrl()}/api/files/${fileId}`, {
+      const response = await authFetch(`${getApiBaseUrl()}/api/files/${fileId}`, {
         method: 'GET',
         headers: {
-          'Authorization': `Bearer ${token}`,
           'Content-Type': 'application/json'
         }
       })
@@ -2171,10 +2160,9 @@ const RequestDetails = () => {
                                           return
                                         }
                                         
-                                        const response = await fetch(`http://localhost:8000/api/files/${config.lora.basicStation.trustCaCertificate.id}`, {
+                                        const response = await authFetch(`http://localhost:8000/api/files/${config.lora.basicStation.trustCaCertificate.id}`, {
                                           method: 'GET',
                                           headers: {
-                                            'Authorization': `Bearer ${token}`,
                                             'Content-Type': 'application/json'
                                           }
                                         });
@@ -2221,10 +2209,9 @@ const RequestDetails = () => {
                                           return
                                         }
                                         
-                                        const response = await fetch(`http://localhost:8000/api/files/${config.lora.basicStation.clientCertificate.id}`, {
+                                        const response = await authFetch(`http://localhost:8000/api/files/${config.lora.basicStation.clientCertificate.id}`, {
                                           method: 'GET',
                                           headers: {
-                                            'Authorization': `Bearer ${token}`,
                                             'Content-Type': 'application/json'
                                           }
                                         });
@@ -2271,10 +2258,9 @@ const RequestDetails = () => {
                                           return
                                         }
                                         
-                                        const response = await fetch(`http://localhost:8000/api/files/${config.lora.basicStation.clientKey.id}`, {
+                                        const response = await authFetch(`http://localhost:8000/api/files/${config.lora.basicStation.clientKey.id}`, {
                                           method: 'GET',
                                           headers: {
-                                            'Authorization': `Bearer ${token}`,
                                             'Content-Type': 'application/json'
                                           }
                                         });
@@ -2330,10 +2316,9 @@ const RequestDetails = () => {
                                           return
                                         }
                                         
-                                        const response = await fetch(`http://localhost:8000/api/files/${config.lora.basicStation.batchTtnFile.id}`, {
+                                        const response = await authFetch(`http://localhost:8000/api/files/${config.lora.basicStation.batchTtnFile.id}`, {
                                           method: 'GET',
                                           headers: {
-                                            'Authorization': `Bearer ${token}`,
                                             'Content-Type': 'application/json'
                                           }
                                         });
@@ -2380,10 +2365,9 @@ const RequestDetails = () => {
                                           return
                                         }
                                         
-                                        const response = await fetch(`http://localhost:8000/api/files/${config.lora.basicStation.batchAwsFile.id}`, {
+                                        const response = await authFetch(`http://localhost:8000/api/files/${config.lora.basicStation.batchAwsFile.id}`, {
                                           method: 'GET',
                                           headers: {
-                                            'Authorization': `Bearer ${token}`,
                                             'Content-Type': 'application/json'
                                           }
                                         });
@@ -2651,10 +2635,9 @@ const RequestDetails = () => {
                               try {
                                 const token = useAuthStore.getState().token;
                                 const apiBaseUrl = getApiBaseUrl();
-                                const response = await fetch(`${apiBaseUrl}/api/files/${file.id}`, {
+                                const response = await authFetch(`${apiBaseUrl}/api/files/${file.id}`, {
                                   method: 'GET',
                                   headers: {
-                                    'Authorization': `Bearer ${token}`,
                                     'Content-Type': 'application/json'
                                   }
                                 });
@@ -2738,10 +2721,9 @@ const RequestDetails = () => {
                                         }
                                         
                                         // 使用API服务下载文件
-                                        const response = await fetch(`http://localhost:8000/api/files/${file.id}`, {
+                                        const response = await authFetch(`http://localhost:8000/api/files/${file.id}`, {
                                           method: 'GET',
                                           headers: {
-                                            'Authorization': `Bearer ${token}`,
                                             'Content-Type': 'application/json'
                                           }
                                         });
@@ -54,18 +54,80 @@ api.interceptors.request.use(
   }
 )
 
+// 访问令牌过期时用刷新令牌换取新令牌（并发请求共用同一次刷新）
+let refreshPromise: Promise<string | null> | null = null
+
+const refreshAccessToken = async (): Promise<string | null> => {
+  const { refreshToken, setTokens } = useAuthStore.getState()
+  if (!refreshToken) return null
+  try {
+    const response = await axios.post(`${API_BASE_URL}/api/auth/refresh`, { refresh_token: refreshToken })
+    setTokens(response.data.access_token, response.data.refresh_token)
+    return response.data.access_token
+  } catch {
+    return null
+  }
+}
+
+const refreshOnce = (): Promise<string | null> => {
+  refreshPromise = refreshPromise || refreshAccessToken().finally(() => { refreshPromise = null })
+  return refreshPromise
+}
+
+const redirectToLogin = () => {
+  useAuthStore.getState().logout()
+  window.location.href = '/login'
+}
+
+// 登录、注册、刷新本身返回 401 时不再尝试刷新；登出需要有效令牌才能吊销，允许刷新后重试
+const canRefresh = (url?: string) => !url?.startsWith('/api/auth/') || url === '/api/auth/logout'
+
 // 响应拦截器 - 处理认证错误
 api.interceptors.response.use(
   (response) => response,
-  (error) => {
+  async (error) => {
+    const original = error.config
+    if (error.response?.status === 401 && original && !original._retry && canRefresh(original.url)) {
+      original._retry = true
+      const token = await refreshOnce()
+      if (token) {
+        original.headers.Authorization = `Bearer ${token}`
+        return api(original)
+      }
+    }
     if (error.response?.status === 401) {
-      useAuthStore.getState().logout()
-      window.location.href = '/login'
+      redirectToLogin()
     }
     return Promise.reject(error)
   }
 )
 
+// 直接使用 fetch 的请求（文件上传下载、评论、历史）：携带当前令牌，
+// 401 时与 axios 拦截器共用同一次刷新，换到新令牌后重试一次
+export const authFetch = async (url: string, init: RequestInit = {}): Promise<Response> => {
+  const send = (token: string | null) => {
+    const headers = new Headers(init.headers)
+    if (token) {
+      headers.set('Authorization', `Bearer ${token}`)
+    }
+    return fetch(url, { ...init, headers })
+  }
+  
+  const response = await send(useAuthStore.getState().token)
+  if (response.status !== 401) {
+    return response
+  }
+  const token = await refreshOnce()
+  if (token) {
+    const retried = await send(token)
+    if (retried.status !== 401) {
+      return retried
+    }
+  }
+  redirectToLogin()
+  return response
+}
+
 // API接口定义
 export interface User {
   id: number
@@ -80,6 +142,8 @@ export interface LoginRequest {
 
 export interface LoginResponse {
   access_token: string
+  refresh_token: string
+  expires_in: number
   token_type: string
   user: User
 }
@@ -95,10 +159,21 @@ export interface Request {
   changes: Record<string, any>
   originalConfig: Record<string, any>
   creatorEmail?: string
+  version?: number  // 行版本号（ETag）
   user: string
   tags?: Array<{ type: string; value: string; label: string }>
 }
 
+// 请求详情页聚合数据（/api/requests/{id}/bundle）
+export interface RequestBundle {
+  id: string
+  request?: Request
+  diff?: { count: number; fields: Array<{ field: string; fieldName: string }> }
+  comments?: any[]
+  activities?: any[]
+  users?: any[]
+}
+
 export interface CreateRequestRequest {
   companyName: string
   rakId: string
@@ -127,6 +202,17 @@ export const authAPI = {
     const response = await api.post('/api/auth/register', data)
     return response.data
   },
+  
+  logout: async () => {
+    // 服务端提升用户版本，已签发的访问令牌和刷新令牌全部失效；请求失败时也清除本地登录状态
+    try {
+      await api.post('/api/auth/logout')
+    } catch (error) {
+      console.error('API: Logout error:', error)
+    } finally {
+      useAuthStore.getState().logout()
+    }
+  },
 }
 
 // 请求API
@@ -141,6 +227,13 @@ export const requestAPI = {
     return response.data
   },
   
+  getRequestBundle: async (id: string, fields?: string[]): Promise<RequestBundle> => {
+    const response = await api.get(`/api/requests/${id}/bundle`, {
+      params: fields ? { fields: fields.join(',') } : undefined,
+    })
+    return response.data
+  },
+  
   createRequest: async (data: CreateRequestRequest): Promise<Request> => {
     const response = await api.post('/api/requests', data)
     return response.data
@@ -151,6 +244,23 @@ export const requestAPI = {
     return response.data
   },
   
+  patchRequestConfig: async (id: string, patch: Record<string, any> | Array<Record<string, any>>, etag?: string) => {
+    // 数组按 JSON Patch（RFC 6902）发送，对象按 Merge Patch（RFC 7396）发送
+    const contentType = Array.isArray(patch) ? 'application/json-patch+json' : 'application/merge-patch+json'
+    const headers: Record<string, string> = { 'Content-Type': contentType }
+    if (etag) {
+      headers['If-Match'] = etag
+    }
+    const response = await api.patch(`/api/requests/${id}/config`, patch, { headers })
+    return response.data
+  },
+  
+  updateRequests: async (ids: string[], patch: { status?: string; assignee?: string }) => {
+    // 批量更新状态或分配人（单个事务）
+    const response = await api.post('/api/requests/batch/update', { ids, patch })
+    return response.data
+  },
+  
   getUsers: async () => {
     const response = await api.get('/api/users')
     return response.data
@@ -227,6 +337,38 @@ export interface Template {
   createdByName: string
 }
 
+// 模板摘要（列表用，不含 configData / variables）
+export type TemplateSummary = Omit<Template, 'configData' | 'variables'> & {
+  variableCount: number
+  isFavorite?: boolean  // /api/templates 列表带当前用户的收藏标记
+}
+
+// 模板选择器用的"我的模板"（/api/templates/mine）
+export type MyTemplate = TemplateSummary & { isFavorite: boolean; lastUsedAt?: string }
+
+// 分面模板列表（/api/templates/facets）
+export interface FacetCount {
+  value: string
+  count: number
+  selected?: boolean
+}
+
+export interface TemplateFacets {
+  total: number
+  templates: TemplateSummary[]
+  facets: {
+    categories: FacetCount[]
+    tags: FacetCount[]
+    visibility: { public: number; private: number }
+  }
+}
+
+export interface MyTemplates {
+  favorites: MyTemplate[]
+  own: MyTemplate[]
+  recent: MyTemplate[]
+}
+
 export interface CreateTemplateRequest {
   name: string
   description?: string
@@ -269,6 +411,32 @@ export const templateAPI = {
     return response.data
   },
   
+  getTemplateSummaries: async (params?: { category?: string; is_public?: boolean; search?: string }): Promise<TemplateSummary[]> => {
+    const response = await api.get('/api/templates', { params: { ...params, view: 'summary' } })
+    return response.data
+  },
+  
+  getTemplateFacets: async (params?: { category?: string; tag?: string[]; is_public?: boolean; search?: string }): Promise<TemplateFacets> => {
+    // 多个标签按 tag=a&tag=b 传递
+    const response = await api.get('/api/templates/facets', { params, paramsSerializer: { indexes: null } })
+    return response.data
+  },
+  
+  getMyTemplates: async (recentLimit?: number): Promise<MyTemplates> => {
+    const response = await api.get('/api/templates/mine', { params: { recent_limit: recentLimit } })
+    return response.data
+  },
+  
+  favoriteTemplate: async (id: string) => {
+    const response = await api.post(`/api/templates/${id}/favorite`)
+    return response.data
+  },
+  
+  unfavoriteTemplate: async (id: string) => {
+    const response = await api.delete(`/api/templates/${id}/favorite`)
+    return response.data
+  },
+  
   getTemplate: async (id: string): Promise<Template> => {
     const response = await api.get(`/api/templates/${id}`)
     return response.data
@@ -294,10 +462,33 @@ export const templateAPI = {
     return response.data
   },
   
+  instantiateTemplate: async (id: string, rows: Array<Record<string, string>> | File, defaults?: { companyName?: string; rakId?: string; tags?: Array<{ type: string; value: string; label: string }> }) => {
+    // 传入 File 时按 CSV 上传（首行为列名），否则按 JSON 行数组发送
+    const response = rows instanceof File
+      ? await api.post(`/api/templates/${id}/instantiate`, rows, { headers: { 'Content-Type': 'text/csv' } })
+      : await api.post(`/api/templates/${id}/instantiate`, { ...defaults, rows })
+    return response.data as { message: string; template_id: string; version: number; request_ids: string[] }
+  },
+  
   getCategories: async (): Promise<string[]> => {
     const response = await api.get('/api/templates/categories')
     return response.data
   },
+  
+  exportTemplates: async (category?: string): Promise<Blob> => {
+    const response = await api.get('/api/templates/export', { params: { category }, responseType: 'blob' })
+    return response.data
+  },
+  
+  // 返回 NDJSON 进度行，最后一行为汇总（done）；中途出错时最后一行为 { error }，之前的分块已提交
+  importTemplates: async (file: File, dryRun = false): Promise<Array<Record<string, any>>> => {
+    const response = await api.post('/api/templates/import', file, {
+      params: { dry_run: dryRun },
+      headers: { 'Content-Type': 'application/x-ndjson' },
+      responseType: 'text',
+    })
+    return String(response.data).split('\n').filter(Boolean).map((line: string) => JSON.parse(line))
+  },
 }
 
 export default api
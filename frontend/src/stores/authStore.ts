@@ -10,8 +10,10 @@ interface User {
 interface AuthState {
   user: User | null
   token: string | null
+  refreshToken: string | null
   isAuthenticated: boolean
-  login: (token: string, user: User) => void
+  login: (token: string, user: User, refreshToken?: string) => void
+  setTokens: (token: string, refreshToken: string) => void
   logout: () => void
 }
 
@@ -20,12 +22,16 @@ export const useAuthStore = create<AuthState>()(
     (set) => ({
       user: null,
       token: null,
+      refreshToken: null,
       isAuthenticated: false,
-      login: (token: string, user: User) => {
-        set({ token, user, isAuthenticated: true })
+      login: (token: string, user: User, refreshToken?: string) => {
+        set({ token, user, refreshToken: refreshToken || null, isAuthenticated: true })
+      },
+      setTokens: (token: string, refreshToken: string) => {
+        set({ token, refreshToken })
       },
       logout: () => {
-        set({ token: null, user: null, isAuthenticated: false })
+        set({ token: null, refreshToken: null, user: null, isAuthenticated: false })
       },
     }),
     {